@@ -0,0 +1,123 @@
+'''
+A module to encode metadata as canonical JSON: compact, with sorted keys, and
+thus deterministic bytes for the same metadata.
+
+Metadata is mostly made of sub-objects that do not change between versions
+(e.g. the metadata of every project in a bundle, or every target in project
+metadata), so any sub-object may be given as a Fragment of JSON that was
+already encoded, which is then copied as is instead of encoded again.
+'''
+
+
+# 1st-party
+import json
+import re
+
+
+# NOTE: Fragments are encoded as strings with this prefix, and then replaced
+# with their JSON. The prefix is a NUL character, which never appears in our
+# metadata, and which JSON always escapes.
+FRAGMENT_PREFIX = '\x00'
+FRAGMENT_PATTERN = re.compile(br'"\\u0000(\d+)"')
+
+_ENCODER_OPTIONS = {
+  'indent': None,
+  'separators': (',', ':'),
+  'sort_keys': True
+}
+
+
+class Fragment:
+
+
+  '''
+  A value that has already been encoded as canonical JSON.
+  '''
+
+
+  __slots__ = ('json',)
+
+
+  def __init__(self, json):
+    assert isinstance(json, bytes)
+    self.json = json
+
+
+  def __eq__(self, other):
+    return isinstance(other, Fragment) and self.json == other.json
+
+
+  def __hash__(self):
+    return hash(self.json)
+
+
+  def __len__(self):
+    return len(self.json)
+
+
+  def __repr__(self):
+    return 'Fragment({!r})'.format(self.json)
+
+
+class FragmentCache:
+
+
+  '''
+  A dict-like cache of Fragments, where the value under a key must never
+  change (e.g. because the key is made of the value itself).
+  '''
+
+
+  def __init__(self):
+    # key: Fragment
+    self.__fragments = {}
+
+
+  def __contains__(self, key):
+    return key in self.__fragments
+
+
+  def __len__(self):
+    return len(self.__fragments)
+
+
+  def discard(self, key):
+    self.__fragments.pop(key, None)
+
+
+  def get(self, key, value):
+    '''Return the Fragment of this value, encoding it only if it is not
+    already cached under this key.'''
+
+    fragment = self.__fragments.get(key)
+
+    if fragment is None:
+      fragment = Fragment(encode(value))
+      self.__fragments[key] = fragment
+
+    return fragment
+
+
+def encode(metadata):
+  '''Return the canonical JSON of this metadata in bytes, which is exactly
+  json.dumps(metadata, separators=(',', ':'), sort_keys=True) in UTF-8, except
+  that every Fragment is replaced by its JSON.'''
+
+  fragments = []
+
+  def encode_fragment(value):
+    if isinstance(value, Fragment):
+      fragments.append(value.json)
+      return '{}{}'.format(FRAGMENT_PREFIX, len(fragments)-1)
+    else:
+      raise TypeError('{!r} is not JSON serializable'.format(value))
+
+  metadata_json = json.dumps(metadata, default=encode_fragment,
+                             **_ENCODER_OPTIONS).encode('utf-8')
+
+  if fragments:
+    metadata_json = \
+            FRAGMENT_PATTERN.sub(lambda match: fragments[int(match.group(1))],
+                                 metadata_json)
+
+  return metadata_json
@@ -110,6 +110,7 @@ import argparse
 import calendar
 import collections
 import datetime
+import hashlib
 import operator
 import os
 import re
@@ -230,6 +231,19 @@ class ChangeLogReader(object):
                                 if since <= timestamp and timestamp < until]
 
 
+  def get_fingerprint(self, since=None, until=None):
+    '''Return the SHA-256 hex digest of the changes filtered between since
+    and until, which changes whenever they do.'''
+
+    fingerprint = hashlib.sha256()
+
+    for change, timestamp in self.filter_changes(since=since, until=until):
+      fingerprint.update('{!r} {}\n'.format(change, timestamp)\
+                         .encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
   def handle_add_file(self, change, action_match):
     name, version, timestamp, action, serial = change
     pyversion, filename = action_match.groups()
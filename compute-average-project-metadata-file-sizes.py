@@ -9,21 +9,21 @@ import sys
 
 
 # 2nd-party
+import metadatadiff
 from nouns import METADATA_DIRECTORY, TUF_DIRECTORY
+import snapshotindex
 
 
-# 3rd-party
-import jsonpatch
+# The packfile of TUF metadata, if the metadata has been packed, or None.
+TUF_PACKFILE = snapshotindex.open_packfile(TUF_DIRECTORY)
 
 
 # Find the project with a recurring cost closest to the given average.
 def find_project_with_avg_recurring_cost(FIRST_SNAPSHOT_FILEPATH,
                                          LAST_SNAPSHOT_FILEPATH,
                                          AVG_RECURRING_COST):
-  with open(FIRST_SNAPSHOT_FILEPATH) as first_snapshot_file, \
-       open(LAST_SNAPSHOT_FILEPATH) as last_snapshot_file:
-    first_snapshot = json.load(first_snapshot_file)
-    last_snapshot = json.load(last_snapshot_file)
+  first_snapshot = get_snapshot_metadata(FIRST_SNAPSHOT_FILEPATH)
+  last_snapshot = get_snapshot_metadata(LAST_SNAPSHOT_FILEPATH)
 
   first_projects = first_snapshot['signed']['meta']
   last_projects = last_snapshot['signed']['meta']
@@ -60,8 +60,7 @@ def find_project_with_avg_recurring_cost(FIRST_SNAPSHOT_FILEPATH,
 # number of projects.
 def get_avg_initial_cost(LAST_SNAPSHOT_FILEPATH,
                          output_filename='avg_initial_cost.txt'):
-  with open(LAST_SNAPSHOT_FILEPATH) as last_snapshot_file:
-    last_snapshot = json.load(last_snapshot_file)
+  last_snapshot = get_snapshot_metadata(LAST_SNAPSHOT_FILEPATH)
 
   projects = last_snapshot['signed']['meta']
   total_project_metadata_file_size = 0
@@ -91,10 +90,8 @@ def get_avg_initial_cost(LAST_SNAPSHOT_FILEPATH,
 # between the first and last snapshots.
 def get_avg_recurring_cost(FIRST_SNAPSHOT_FILEPATH, LAST_SNAPSHOT_FILEPATH,
                            output_filename='avg_recurring_cost.txt'):
-  with open(FIRST_SNAPSHOT_FILEPATH) as first_snapshot_file, \
-       open(LAST_SNAPSHOT_FILEPATH) as last_snapshot_file:
-    first_snapshot = json.load(first_snapshot_file)
-    last_snapshot = json.load(last_snapshot_file)
+  first_snapshot = get_snapshot_metadata(FIRST_SNAPSHOT_FILEPATH)
+  last_snapshot = get_snapshot_metadata(LAST_SNAPSHOT_FILEPATH)
 
   first_projects = first_snapshot['signed']['meta']
   last_projects = last_snapshot['signed']['meta']
@@ -136,15 +133,8 @@ def get_avg_recurring_cost(FIRST_SNAPSHOT_FILEPATH, LAST_SNAPSHOT_FILEPATH,
 
 
 def get_delta_size(prev, curr):
-  patch = jsonpatch.make_patch(prev, curr)
-
-  patch_str = str(patch)
-  patch_str_length = len(patch_str)
-  compressed_patch_str = bz2.compress(patch_str.encode('utf-8'))
-  compressed_patch_str_length = len(compressed_patch_str)
-
-  # If the patch is small enough, compression may increase bandwidth cost.
-  return min(patch_str_length, compressed_patch_str_length)
+  patch = metadatadiff.make_patch(prev, curr)
+  return metadatadiff.get_patch_length(patch)
 
 
 def get_project_metadata_bytes(project_metadata_filepath,
@@ -165,10 +155,18 @@ def get_project_metadata_str(project_metadata_filepath,
   project_metadata_filepath = '{}.{}{}'.format(project_metadata_filepath[:-5],
                                                project_metadata_identifier,
                                                '.json')
-  project_metadata_filepath = os.path.join(TUF_DIRECTORY,
-                                           project_metadata_filepath)
-  with open(project_metadata_filepath) as project_metadata_file:
-    return project_metadata_file.read()
+  return snapshotindex.read_metadata_str(TUF_DIRECTORY,
+                                         project_metadata_filepath,
+                                         TUF_PACKFILE)
+
+
+# Return snapshot metadata, even if it is stored as a delta.
+def get_snapshot_metadata(snapshot_filepath):
+  metadata_directory, snapshot_metadata_relpath = \
+                                                os.path.split(snapshot_filepath)
+  return snapshotindex.read_snapshot_metadata(metadata_directory,
+                                              snapshot_metadata_relpath,
+                                              TUF_PACKFILE)
 
 
 if __name__ == '__main__':
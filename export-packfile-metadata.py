@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+'''
+Write every version of metadata in the packfile of every scheme to its own
+file, exactly as writers without packfiles would.
+'''
+
+
+# 1st-party
+import logging
+import os
+
+
+# 2nd-party
+from nouns import LOG_FORMAT, MERCURY_DIRECTORY, MERCURY_NOHASH_DIRECTORY, \
+                  METADATA_DIRECTORY, TUF_DIRECTORY
+import packfile
+
+
+if __name__ == '__main__':
+  log_filename = os.path.join(METADATA_DIRECTORY,
+                              'export-packfile-metadata.log')
+  logging.basicConfig(filename=log_filename, level=logging.DEBUG,
+                      filemode='w', format=LOG_FORMAT)
+
+  try:
+    for metadata_directory in (MERCURY_DIRECTORY, MERCURY_NOHASH_DIRECTORY,
+                               TUF_DIRECTORY):
+      packfile.export(metadata_directory)
+
+  except:
+    logging.exception('OOPS!')
+    raise
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+'''
+Index the snapshot metadata of every scheme, so that readers memory-map it
+instead of parsing every snapshot metadata file.
+'''
+
+
+# 1st-party
+import logging
+import os
+
+
+# 2nd-party
+from nouns import LOG_FORMAT, MERCURY_DIRECTORY, MERCURY_NOHASH_DIRECTORY, \
+                  METADATA_DIRECTORY, TUF_DIRECTORY
+import snapshotindex
+
+
+if __name__ == '__main__':
+  log_filename = os.path.join(METADATA_DIRECTORY,
+                              'index-snapshot-metadata.log')
+  logging.basicConfig(filename=log_filename, level=logging.DEBUG,
+                      filemode='w', format=LOG_FORMAT)
+
+  try:
+    for metadata_directory in (MERCURY_DIRECTORY, MERCURY_NOHASH_DIRECTORY,
+                               TUF_DIRECTORY):
+      snapshotindex.write(metadata_directory)
+
+  except:
+    logging.exception('OOPS!')
+    raise
@@ -0,0 +1,246 @@
+'''
+A module featuring caches of metadata that are shared by utilities that read,
+for example, TUF or Mercury metadata.
+'''
+
+
+# 1st-party
+import collections
+import json
+import logging
+import os
+import sqlite3
+
+
+class LRUCache:
+
+
+  '''
+  A dict-like cache of metadata in memory, bounded by a budget in bytes.
+
+  Every value is stored with its weight in bytes (e.g. the length of the file
+  it was read from). Once the total weight exceeds the budget, the least
+  recently used values are evicted, except for those that are pinned. A key
+  may be pinned before its value is even stored.
+  '''
+
+
+  def __init__(self, capacity_in_bytes):
+    assert capacity_in_bytes > 0
+    self.__capacity_in_bytes = capacity_in_bytes
+    self.__size_in_bytes = 0
+
+    # str (key): (value, int (weight))
+    # Unpinned values, from the least to the most recently used.
+    self.__unpinned = collections.OrderedDict()
+    # Pinned values, which are never evicted.
+    self.__pinned = {}
+    # str (key): int (number of pins > 0)
+    self.__pins = collections.Counter()
+
+
+  def __evict(self):
+    while self.__size_in_bytes > self.__capacity_in_bytes and self.__unpinned:
+      key, (value, weight) = self.__unpinned.popitem(last=False)
+      self.__size_in_bytes -= weight
+      logging.debug('EVICT {}'.format(key))
+
+
+  def __contains__(self, key):
+    return key in self.__unpinned or key in self.__pinned
+
+
+  def __getitem__(self, key):
+    entry = self.__pinned.get(key)
+
+    if entry is None:
+      # Raises KeyError, if there is no such key.
+      entry = self.__unpinned[key]
+      self.__unpinned.move_to_end(key)
+
+    return entry[0]
+
+
+  def __len__(self):
+    return len(self.__unpinned) + len(self.__pinned)
+
+
+  @property
+  def size_in_bytes(self):
+    return self.__size_in_bytes
+
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+
+  def get_weight(self, key):
+    # Raises KeyError, if there is no such key.
+    entry = self.__pinned.get(key)
+    if entry is None:
+      entry = self.__unpinned[key]
+    return entry[1]
+
+
+  def pin(self, key):
+    self.__pins[key] += 1
+
+    if self.__pins[key] == 1 and key in self.__unpinned:
+      self.__pinned[key] = self.__unpinned.pop(key)
+
+
+  def put(self, key, value, weight):
+    assert weight >= 0
+    assert key not in self
+
+    if key in self.__pins:
+      self.__pinned[key] = (value, weight)
+    else:
+      self.__unpinned[key] = (value, weight)
+
+    self.__size_in_bytes += weight
+    self.__evict()
+
+
+  def unpin(self, key):
+    assert self.__pins[key] > 0
+    self.__pins[key] -= 1
+
+    if self.__pins[key] == 0:
+      del self.__pins[key]
+
+      # Make it the most recently used value, and evict others if need be.
+      if key in self.__pinned:
+        self.__unpinned[key] = self.__pinned.pop(key)
+        self.__evict()
+
+
+class PersistentCache:
+
+
+  '''
+  A dict-like cache of JSON values on disk, backed by SQLite.
+
+  Every value is committed as soon as it is stored, so that nothing is lost
+  if a run crashes, and looked up only on demand, so that opening the cache
+  does not parse it all at once.
+  '''
+
+
+  def __init__(self, filepath):
+    self.__filepath = filepath
+    self.__connection = None
+    self.__pid = None
+    self.__connect()
+
+
+  def __connect(self):
+    # NOTE: An SQLite connection must not be used across a fork, so every
+    # process opens its own connection to the same database.
+    self.__pid = os.getpid()
+    # Wait for other processes to commit, rather than fail.
+    self.__connection = sqlite3.connect(self.__filepath, timeout=60)
+    # Commits to the write-ahead log survive the process crashing, without
+    # the cost of syncing the whole database on every commit.
+    self.__connection.execute('PRAGMA journal_mode=WAL')
+    self.__connection.execute('PRAGMA synchronous=NORMAL')
+    self.__connection.execute('CREATE TABLE IF NOT EXISTS cache '\
+                              '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    self.__connection.commit()
+    logging.debug('OPEN {}'.format(self.__filepath))
+
+
+  @property
+  def __database(self):
+    if self.__pid != os.getpid():
+      self.__connect()
+    return self.__connection
+
+
+  def __contains__(self, key):
+    cursor = self.__database.execute('SELECT 1 FROM cache WHERE key = ?',
+                                     (key,))
+    return cursor.fetchone() is not None
+
+
+  def __getitem__(self, key):
+    cursor = self.__database.execute('SELECT value FROM cache WHERE key = ?',
+                                     (key,))
+    row = cursor.fetchone()
+
+    if row is None:
+      raise KeyError(key)
+    else:
+      return json.loads(row[0])
+
+
+  def __len__(self):
+    return self.__database.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+  def __setitem__(self, key, value):
+    self.__database.execute('INSERT OR REPLACE INTO cache VALUES (?, ?)',
+                            (key, json.dumps(value, sort_keys=True)))
+    self.__database.commit()
+
+
+  @property
+  def last_rowid(self):
+    '''Return the rowid of the last value stored, or 0 if there is none.
+    Every value stored later, even under an old key, has a larger rowid.'''
+
+    return self.__database.execute('SELECT COALESCE(MAX(rowid), 0) '\
+                                   'FROM cache').fetchone()[0]
+
+
+  def close(self):
+    self.__database.close()
+    logging.debug('CLOSE {}'.format(self.__filepath))
+
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+
+  def truncate(self, last_rowid):
+    '''Delete every value stored after the one with this rowid (e.g. an
+    earlier last_rowid).'''
+
+    database = self.__database
+    with database:
+      cursor = database.execute('DELETE FROM cache WHERE rowid > ?',
+                                (last_rowid,))
+    logging.debug('Deleted {:,} values from {}'.format(cursor.rowcount,
+                                                       self.__filepath))
+
+
+  def update(self, items):
+    database = self.__database
+    with database:
+      database.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?)',
+                           ((key, json.dumps(value, sort_keys=True)) \
+                            for key, value in items.items()))
+
+
+  @staticmethod
+  def get_legacy_filepath(filepath):
+    '''Return where older runs kept this cache as a single JSON file.'''
+
+    return os.path.splitext(filepath)[0]+'.json'
+
+
+  @staticmethod
+  def remove(filepath):
+    # Remove the write-ahead log and its index along with the database, and
+    # any JSON cache of an older run, lest it be imported into an empty one.
+    for path in (filepath, filepath+'-wal', filepath+'-shm',
+                 PersistentCache.get_legacy_filepath(filepath)):
+      if os.path.isfile(path):
+        os.remove(path)
+        logging.debug('Deleted {}'.format(path))
@@ -0,0 +1,195 @@
+'''
+A module to compute RFC 6902 patches between two versions of TUF or Mercury
+metadata, and what they cost in bandwidth.
+
+Unlike a generic JSON diff, it is specialized for the huge mappings in our
+metadata (i.e. signed.meta in snapshot metadata and signed.targets in project
+metadata), which are written with sorted keys and where nearly all values are
+shared between consecutive versions.
+'''
+
+
+# 1st-party
+import bz2
+import json
+
+
+# http://tools.ietf.org/html/rfc6901
+def _escape(key):
+  return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _join(path, key):
+  return '{}/{}'.format(path, _escape(key))
+
+
+def _split(path):
+  assert path.startswith('/')
+  return [key.replace('~1', '/').replace('~0', '~') \
+          for key in path[1:].split('/')]
+
+
+def _add(patch, path, value):
+  patch.append({'op': 'add', 'path': path, 'value': value})
+
+
+def _remove(patch, path):
+  patch.append({'op': 'remove', 'path': path})
+
+
+def _replace(patch, path, value):
+  patch.append({'op': 'replace', 'path': path, 'value': value})
+
+
+def _compare_dicts(patch, path, src, dst):
+  # Like jsonpatch, remove keys first, then add keys, and only then compare
+  # the values of the keys in both, each in the order of its dict.
+  for key in src:
+    if key not in dst:
+      _remove(patch, _join(path, key))
+
+  for key in dst:
+    if key not in src:
+      _add(patch, _join(path, key), dst[key])
+
+  for key, src_value in src.items():
+    dst_value = dst.get(key, src_value)
+    # Values are shared only between documents derived from one another
+    # (e.g. by apply_patch), never between separately decoded ones, which
+    # still compare every value: the walk is O(n), not O(changed).
+    if src_value is not dst_value and src_value != dst_value:
+      _compare_values(patch, _join(path, key), src_value, dst_value)
+
+
+def _compare_lists(patch, path, src, dst):
+  number_of_src_items, number_of_dst_items = len(src), len(dst)
+
+  for index in range(max(number_of_src_items, number_of_dst_items)):
+    if index < min(number_of_src_items, number_of_dst_items):
+      src_item, dst_item = src[index], dst[index]
+      if src_item == dst_item:
+        continue
+      elif (isinstance(src_item, dict) and isinstance(dst_item, dict)) or \
+           (isinstance(src_item, list) and isinstance(dst_item, list)):
+        _compare_values(patch, _join(path, index), src_item, dst_item)
+      else:
+        _replace(patch, _join(path, index), dst_item)
+
+    elif number_of_src_items > number_of_dst_items:
+      _remove(patch, _join(path, number_of_dst_items))
+
+    else:
+      _add(patch, _join(path, index), dst[index])
+
+
+def _compare_values(patch, path, src, dst):
+  if isinstance(src, dict) and isinstance(dst, dict):
+    _compare_dicts(patch, path, src, dst)
+  elif isinstance(src, list) and isinstance(dst, list):
+    _compare_lists(patch, path, src, dst)
+  elif src != dst:
+    _replace(patch, path, dst)
+
+
+def _copy(container):
+  if isinstance(container, dict):
+    return dict(container)
+  else:
+    assert isinstance(container, list)
+    return list(container)
+
+
+def apply_patch(document, patch):
+  '''Return a copy of this document with these RFC 6902 operations applied.
+
+  Only "add", "remove" and "replace" operations are supported, which are all
+  that make_patch emits. Values that the patch does not touch are shared with
+  the document, which is left intact.'''
+
+  document = _copy(document)
+  # int (id of every container copied from the document)
+  copies = {id(document)}
+
+  for operation in patch:
+    keys = _split(operation['path'])
+    parent = document
+
+    # Copy every container on the way, so that the document is left intact.
+    for key in keys[:-1]:
+      if isinstance(parent, list):
+        key = int(key)
+      child = parent[key]
+      if id(child) not in copies:
+        child = parent[key] = _copy(child)
+        copies.add(id(child))
+      parent = child
+
+    key, op = keys[-1], operation['op']
+
+    if isinstance(parent, list):
+      key = len(parent) if key == '-' else int(key)
+      if op == 'add':
+        parent.insert(key, operation['value'])
+      elif op == 'remove':
+        del parent[key]
+      else:
+        assert op == 'replace', op
+        parent[key] = operation['value']
+
+    else:
+      if op == 'remove':
+        del parent[key]
+      else:
+        assert op in ('add', 'replace'), op
+        parent[key] = operation['value']
+
+  return document
+
+
+def extend_patch(patch, path, src, dst):
+  '''Append to patch the RFC 6902 operations that turn the src value at this
+  JSON pointer into the dst value, exactly as make_patch would.'''
+
+  _compare_values(patch, path, src, dst)
+
+
+def get_path(*keys):
+  '''Return the JSON pointer to the value at these keys.'''
+
+  path = ''
+  for key in keys:
+    path = _join(path, key)
+  return path
+
+
+def get_patch_length(patch):
+  '''Return the cost in bytes of transferring this patch.'''
+
+  patch_str = json.dumps(patch)
+  patch_str_length = len(patch_str)
+  compressed_patch_str = bz2.compress(patch_str.encode('utf-8'))
+  compressed_patch_str_length = len(compressed_patch_str)
+
+  # If the patch is small enough, compression may increase bandwidth cost.
+  return min(patch_str_length, compressed_patch_str_length)
+
+
+def make_patch(src, dst):
+  '''Return the list of RFC 6902 operations that turns src into dst.
+
+  Operations come in the same order as those of jsonpatch.make_patch, because
+  the order changes how well patches compress, and thus their lengths. Unlike
+  jsonpatch.make_patch, though, it never emits "move" or "copy" operations,
+  which we do not know how to charge: a removed value that equals an added one
+  is a "remove" and an "add" instead of a "move". Lists are compared index by
+  index, so inserting into a list replaces every item after it instead of
+  adding just one: e.g. [1, 2, 3] to [0, 1, 2, 3] takes four operations
+  instead of one. Patch lengths therefore differ from those measured with
+  jsonpatch in these cases.'''
+
+  assert isinstance(src, dict)
+  assert isinstance(dst, dict)
+
+  patch = []
+  _compare_dicts(patch, '', src, dst)
+  return patch
@@ -0,0 +1,35 @@
+'''
+A module of what readers and writers of metadata must agree on: the keys of
+the caches of patch lengths and dirty projects, and the identifiers of project
+metadata in snapshot metadata.
+'''
+
+
+def get_dirty_projects(meta):
+  '''Return the identifier of every project in these entries of signed.meta,
+  just like readers find them in the patch between two snapshot metadata.'''
+
+  return {project_metadata_relpath:
+            get_project_metadata_identifier(project_metadata_identifier) \
+          for project_metadata_relpath, project_metadata_identifier \
+          in meta.items()}
+
+
+def get_patch_key(prev_metadata_relpath, curr_metadata_relpath):
+  '''Return the key of the patch from the previous metadata (or None, for
+  nothing) to the current metadata in the caches.'''
+
+  return '{}:{}'.format(prev_metadata_relpath, curr_metadata_relpath)
+
+
+def get_project_metadata_identifier(project_metadata_identifier):
+  '''Return the identifier of project metadata in this entry of signed.meta.'''
+
+  # NOTE: Kludge to accommodate mercury-hash, which has both hashes and
+  # version numbers.
+  if isinstance(project_metadata_identifier, dict):
+    return project_metadata_identifier['hashes']['sha256']
+  else:
+    assert isinstance(project_metadata_identifier, int) or \
+           isinstance(project_metadata_identifier, str)
+    return project_metadata_identifier
@@ -1,37 +1,62 @@
 
 
 # 1st-party
-import bz2
 import collections
 import csv
-import glob
 import json
 import logging
 import math
+import multiprocessing
 import os
 import re
+import zlib
 
 
 # 2nd-party
+from metadatacache import LRUCache, PersistentCache
+import metadatadiff
+import metadatakeys
 from nouns import FREQUENCY_OF_PROJECT_CREATION_OR_UPDATE, \
-                  LOG_FORMAT, REQUESTS_FILENAME, TIME_LIMIT_IN_SECONDS
+                  LOG_FORMAT, METADATA_CACHE_SIZE_IN_BYTES, NUMBER_OF_SHARDS, \
+                  PACKFILE_FILENAME, REQUESTS_FILENAME, \
+                  RESULTS_INTERVAL_IN_SECONDS, SNAPSHOT_INDEX_FILENAME, \
+                  TIME_LIMIT_IN_SECONDS
+from packfile import PackfileReader
 from projects import Projects
+import snapshotdelta
+import snapshotindex
+from snapshotindex import SnapshotIndex
 
 
-# 3rd-party
-import jsonpatch
-
-
-# If you want to *cache* ALL snapshot metadata in RAM,
-# then set this flag to True.
-# Otherwise, we will load every snapshot metadata file from disk,
-# and leave the caching to the OS.
+# If you want to *cache* ALL snapshot metadata in RAM up front, as much as the
+# metadata cache can hold, then set this flag to True.
+# Otherwise, we will load every snapshot metadata file from disk on demand,
+# and leave the caching of evicted files to the OS.
 CACHE_SNAPSHOT = False
 NUMBER_OF_SECONDS_IN_A_DAY = 24*60*60
 SNAPSHOTS_ARE_EXHAUSTED = False
 # The experiment is valid since only the following Unix timestamp.
 SINCE_TIMESTAMP = 1395360000
 
+# The running totals of package costs right before the first request that
+# entered an interval, and the cost of that request itself.
+IntervalCost = collections.namedtuple('IntervalCost',
+                                      ['interval_number', 'line_number',
+                                       'elapsed_time', 'new_package_cost',
+                                       'return_package_cost', 'package_cost',
+                                       'is_new'])
+
+
+# Caches shared between classes of readers that are set up at the same time.
+# str (metadata directory): dict (metadata relpath: metadata)
+_METADATA_CACHES = {}
+# str (metadata directory): PackfileReader
+_PACKFILES = {}
+# str (cache filepath): PersistentCache
+_PERSISTENT_CACHES = {}
+# str (metadata directory): SnapshotIndex
+_SNAPSHOT_INDEXES = {}
+
 
 class MetadataReader:
 
@@ -74,20 +99,22 @@ class MetadataReader:
     self._prev_snapshot_metadata_relpath = curr_snapshot_metadata_relpath
 
     package_cost.snapshot_metadata_length = snapshot_metadata_length
-    snapshot_metadata = self._read_snapshot(curr_snapshot_metadata_relpath)
 
     project_name = Projects.get_project_name_from_package(url)
     project_metadata_relpath = 'packages/{}.json'.format(project_name)
+    project_metadata_identifier = \
+          self._get_project_metadata_identifier_at(
+                                                curr_snapshot_metadata_relpath,
+                                                project_metadata_relpath)
 
     # Does the project of the desired package exist in this snapshot?
-    if project_metadata_relpath in snapshot_metadata:
+    if project_metadata_identifier is not None:
       # What are the previous and current versions of this project?
       prev_project_metadata_relpath = \
               self._get_prev_project_metadata_relpath(project_metadata_relpath,
                                                       project_name)
       project_metadata_identifier = \
-               self._get_project_metadata_identifier(snapshot_metadata[\
-                                                      project_metadata_relpath])
+        self._get_project_metadata_identifier(project_metadata_identifier)
       curr_project_metadata_relpath = 'packages/{}.{}.json'\
                                       .format(project_name,
                                               project_metadata_identifier)
@@ -165,17 +192,47 @@ class MetadataReader:
     raise NotImplementedError()
 
 
-  # NOTE: Kludge to accommodate mercury-hash, which has both hashes and
-  # version numbers.
   @classmethod
   def _get_project_metadata_identifier(cls, project_metadata_identifier):
     if isinstance(project_metadata_identifier, dict):
       logging.debug('mercury-hash')
-      return project_metadata_identifier['hashes']['sha256']
+    return metadatakeys.get_project_metadata_identifier(
+                                                  project_metadata_identifier)
+
+
+  # What was the identifier of this project in this snapshot metadata, if the
+  # project existed there at all?
+  @classmethod
+  def _get_project_metadata_identifier_at(cls, snapshot_metadata_relpath,
+                                          project_metadata_relpath):
+    # Look up the timeline of the project instead of the snapshot metadata.
+    if cls.__is_indexed(snapshot_metadata_relpath):
+      timestamp = snapshotindex.get_timestamp(snapshot_metadata_relpath)
+      return cls.__SNAPSHOT_INDEX.get_identifier_at(project_metadata_relpath,
+                                                    timestamp)
     else:
-      assert isinstance(project_metadata_identifier, int) or \
-             isinstance(project_metadata_identifier, str)
-      return project_metadata_identifier
+      snapshot_metadata = cls._read_snapshot(snapshot_metadata_relpath)
+      return snapshot_metadata.get(project_metadata_relpath)
+
+
+  # What was the project metadata relpath of this project in this snapshot
+  # metadata, if the project existed there at all?
+  @classmethod
+  def _get_project_metadata_relpath_at(cls, snapshot_metadata_relpath,
+                                       project_metadata_relpath, project_name):
+    project_metadata_identifier = \
+          cls._get_project_metadata_identifier_at(snapshot_metadata_relpath,
+                                                  project_metadata_relpath)
+
+    # NOTE: This computation would be stupid for Mercury, because it would
+    # just be packages/project.1.json anyway, except for one thing: the
+    # project itself could be missing in the previous snapshot.
+    if project_metadata_identifier is not None:
+      return 'packages/{}.{}.json'.format(project_name,
+                                          project_metadata_identifier)
+    # Project did not exist in previous snapshot!
+    else:
+      return None
 
 
   # Load from cache the dirty projects present in snapshot diff.
@@ -186,13 +243,36 @@ class MetadataReader:
   def _read_metadata(cls, metadata_relpath):
     metadata = cls._METADATA_CACHE.get(metadata_relpath)
 
-    if not metadata:
-      with open(cls.__get_metadata_abspath(metadata_relpath)) as metadata_file:
-        metadata = json.load(metadata_file)
-        cls._METADATA_CACHE[metadata_relpath] = metadata
+    # Read metadata only on demand, and only until it is evicted again.
+    if metadata is None:
+      # Walk back along the deltas to the nearest snapshot metadata that is
+      # either cached or stored in full, without recursing, ...
+      deltas = []
+      while metadata is None and \
+            metadata_relpath in cls.__SNAPSHOT_DELTA_RELPATHS:
+        delta_relpath = cls.__SNAPSHOT_DELTA_RELPATHS[metadata_relpath]
+        delta = json.loads(cls.__read_metadata_str(delta_relpath))
+        deltas.append((metadata_relpath, delta))
+        metadata_relpath = delta['base']
+        metadata = cls._METADATA_CACHE.get(metadata_relpath)
+
+      if metadata is None:
+        metadata_str = cls.__read_metadata_str(metadata_relpath)
+        metadata = json.loads(metadata_str)
+        weight = len(metadata_str)
+        cls._METADATA_CACHE.put(metadata_relpath, metadata, weight)
+      else:
+        weight = cls._METADATA_CACHE.get_weight(metadata_relpath)
+
+      # ... and then rebuild every snapshot metadata on the way forward.
+      # NOTE: It is about as large as its base.
+      for metadata_relpath, delta in reversed(deltas):
+        metadata = snapshotdelta.rebuild(delta, metadata)
+        cls._METADATA_CACHE.put(metadata_relpath, metadata, weight)
 
     return metadata
 
+
   @classmethod
   def _read_project(cls, project_metadata_relpath):
     return cls._read_metadata(project_metadata_relpath)['signed']['targets']
@@ -200,7 +280,11 @@ class MetadataReader:
 
   @classmethod
   def _read_snapshot(cls, snapshot_metadata_relpath):
-    return cls._read_metadata(snapshot_metadata_relpath)['signed']['meta']
+    # Look up projects in the index instead of parsing the snapshot metadata.
+    if cls.__is_indexed(snapshot_metadata_relpath):
+      return cls.__SNAPSHOT_INDEX.get_meta(snapshot_metadata_relpath)
+    else:
+      return cls._read_metadata(snapshot_metadata_relpath)['signed']['meta']
 
 
   # Clear cache of dirty projects present in snapshot diff.
@@ -276,12 +360,17 @@ class MetadataReader:
 
 
   @classmethod
-  def __get_metadata_relpath(cls, metadata_abspath):
-    return metadata_abspath[len(cls.__METADATA_DIRECTORY):]
+  def __read_metadata_str(cls, metadata_relpath):
+    if cls.__PACKFILE is not None:
+      return cls.__PACKFILE[metadata_relpath].decode('utf-8')
+    else:
+      with open(cls.__get_metadata_abspath(metadata_relpath)) as metadata_file:
+        return metadata_file.read()
 
 
   def __get_patch_length(self, prev_metadata_relpath, curr_metadata_relpath):
-    key = '{}:{}'.format(prev_metadata_relpath, curr_metadata_relpath)
+    key = metadatakeys.get_patch_key(prev_metadata_relpath,
+                                     curr_metadata_relpath)
 
     # If we have already cached the difference, use that.
     if key in self.__METADATA_PATCH_LENGTH_CACHE:
@@ -290,51 +379,74 @@ class MetadataReader:
 
     # Otherwise, compute the difference.
     else:
-      # Either get the previous file, if any, or start from scratch.
-      if prev_metadata_relpath:
-        prev = self._read_metadata(prev_metadata_relpath)
-      else:
-        prev = {}
-
-      curr = self._read_metadata(curr_metadata_relpath)
-      patch = jsonpatch.make_patch(prev, curr)
+      patch = self.__make_patch(prev_metadata_relpath, curr_metadata_relpath)
       self._store_dirty_projects(curr_metadata_relpath, key, patch)
 
-      patch_str = str(patch)
-      patch_str_length = len(patch_str)
-      compressed_patch_str = bz2.compress(patch_str.encode('utf-8'))
-      compressed_patch_str_length = len(compressed_patch_str)
-
-      # If the patch is small enough, compression may increase bandwidth cost.
-      cost = min(patch_str_length, compressed_patch_str_length)
+      cost = metadatadiff.get_patch_length(patch)
       self.__METADATA_PATCH_LENGTH_CACHE[key] = cost
 
     return cost
 
 
   @classmethod
-  def __setup_project_metadata(cls):
-    project_metadata_abspaths = \
-              sorted(glob.glob(cls.__get_metadata_abspath('packages/*.json')))
+  def __is_indexed(cls, metadata_relpath):
+    return cls.__SNAPSHOT_INDEX is not None and \
+           metadata_relpath in cls.__SNAPSHOT_INDEX
+
+
+  @classmethod
+  def __make_patch(cls, prev_metadata_relpath, curr_metadata_relpath):
+    # Compare indexed snapshot metadata without reading it.
+    if cls.__is_indexed(curr_metadata_relpath) and \
+       (not prev_metadata_relpath or cls.__is_indexed(prev_metadata_relpath)):
+      return cls.__SNAPSHOT_INDEX.make_patch(prev_metadata_relpath or None,
+                                             curr_metadata_relpath)
+
+    # Either get the previous file, if any, or start from scratch.
+    if prev_metadata_relpath:
+      prev = cls._read_metadata(prev_metadata_relpath)
+    else:
+      prev = {}
+
+    curr = cls._read_metadata(curr_metadata_relpath)
+    return metadatadiff.make_patch(prev, curr)
+
+
+  @classmethod
+  def __setup_cache(cls, cache_filepath):
+    # Share the same cache between classes of readers that use the same file.
+    cache = _PERSISTENT_CACHES.get(cache_filepath)
+    if cache is not None:
+      return cache
+
+    cache = PersistentCache(cache_filepath)
+    _PERSISTENT_CACHES[cache_filepath] = cache
+
+    # Import the JSON cache left behind by an older run, if any, so that we do
+    # not have to recompute its entries.
+    legacy_cache_filepath = PersistentCache.get_legacy_filepath(cache_filepath)
+    if len(cache) == 0 and os.path.isfile(legacy_cache_filepath):
+      with open(legacy_cache_filepath) as legacy_cache_file:
+        logging.debug('READ {}'.format(legacy_cache_filepath))
+        cache.update(json.load(legacy_cache_file))
 
-    for project_metadata_abspath in project_metadata_abspaths:
-      with open(project_metadata_abspath) as project_metadata_file:
-        project_metadata = json.load(project_metadata_file)
-        project_metadata_relpath = \
-                        cls.__get_metadata_relpath(project_metadata_abspath)
-        assert project_metadata_relpath not in cls._METADATA_CACHE
-        cls._METADATA_CACHE[project_metadata_relpath] = project_metadata
+    return cache
 
 
   @classmethod
   def __setup_snapshot_metadata(cls):
     prev_timestamp = 0
-    snapshot_metadata_abspaths = \
-              sorted(glob.glob(cls.__get_metadata_abspath('snapshot.*.json')))
 
-    for snapshot_metadata_abspath in snapshot_metadata_abspaths:
-      snapshot_metadata_relpath = \
-                        cls.__get_metadata_relpath(snapshot_metadata_abspath)
+    # str (snapshot metadata relpath): str (delta relpath)
+    cls.__SNAPSHOT_DELTA_RELPATHS = {}
+
+    for snapshot_metadata_relpath, stored_metadata_relpath in \
+        snapshotindex.get_stored_snapshot_metadata_relpaths(
+                                  cls.__METADATA_DIRECTORY, cls.__PACKFILE):
+      if stored_metadata_relpath != snapshot_metadata_relpath:
+        cls.__SNAPSHOT_DELTA_RELPATHS[snapshot_metadata_relpath] = \
+                                                        stored_metadata_relpath
+
       curr_timestamp = int(re.match('snapshot.(\d+).json',
                                     snapshot_metadata_relpath).group(1))
       assert prev_timestamp < curr_timestamp
@@ -346,16 +458,21 @@ class MetadataReader:
         cls.__SNAPSHOT_TIMESTAMPS.append(curr_timestamp)
         prev_timestamp = curr_timestamp
 
-        # TODO: Cache only snapshot metadata that will be actually be used.
+        # NOTE: Only as much snapshot metadata as fits into the metadata
+        # cache stays there.
         if CACHE_SNAPSHOT:
-          with open(snapshot_metadata_abspath) as snapshot_metadata_file:
-            snapshot_metadata = json.load(snapshot_metadata_file)
-            assert snapshot_metadata_relpath not in cls._METADATA_CACHE
-            cls._METADATA_CACHE[snapshot_metadata_relpath] = snapshot_metadata
+          cls._read_snapshot(snapshot_metadata_relpath)
 
         logging.info(snapshot_metadata_relpath)
 
 
+  @classmethod
+  def __unpin_snapshot_metadata(cls):
+    if cls.__PINNED_SNAPSHOT_METADATA_RELPATH is not None:
+      cls._METADATA_CACHE.unpin(cls.__PINNED_SNAPSHOT_METADATA_RELPATH)
+      cls.__PINNED_SNAPSHOT_METADATA_RELPATH = None
+
+
   # For new users.
   def new_charge(self, curr_snapshot_timestamp, url):
     raise NotImplementedError()
@@ -405,7 +522,20 @@ class MetadataReader:
 
   @classmethod
   def get_current_and_next_snapshot_timestamps(cls):
-    return next(cls.__CURRENT_AND_NEXT_SNAPSHOT_TIMESTAMPS_GENERATOR)
+    curr_timestamp, next_timestamp = \
+                      next(cls.__CURRENT_AND_NEXT_SNAPSHOT_TIMESTAMPS_GENERATOR)
+
+    # Pin the current snapshot metadata, which every user is about to compare
+    # against, but only until the current snapshot moves past it, so that the
+    # previous snapshot metadata of users is evicted like any other metadata.
+    curr_snapshot_metadata_relpath = 'snapshot.{}.json'.format(curr_timestamp)
+    if curr_snapshot_metadata_relpath != \
+       cls.__PINNED_SNAPSHOT_METADATA_RELPATH:
+      cls._METADATA_CACHE.pin(curr_snapshot_metadata_relpath)
+      cls.__unpin_snapshot_metadata()
+      cls.__PINNED_SNAPSHOT_METADATA_RELPATH = curr_snapshot_metadata_relpath
+
+    return curr_timestamp, next_timestamp
 
 
   @classmethod
@@ -416,31 +546,47 @@ class MetadataReader:
     cls.__METADATA_DIRECTORY = metadata_directory
 
     # str (metadata relpath): dict (metadata)
-    cls._METADATA_CACHE = {}
+    # NOTE: Classes of readers that read the same metadata directory share the
+    # same metadata, so that it is read into memory only once.
+    if metadata_directory not in _METADATA_CACHES:
+      _METADATA_CACHES[metadata_directory] = \
+                                    LRUCache(METADATA_CACHE_SIZE_IN_BYTES)
+    cls._METADATA_CACHE = _METADATA_CACHES[metadata_directory]
+    # str (the current snapshot metadata relpath), or None
+    cls.__PINNED_SNAPSHOT_METADATA_RELPATH = None
+
+    # PackfileReader, if the metadata has been packed, or None.
+    packfile_filepath = os.path.join(metadata_directory, PACKFILE_FILENAME)
+    if metadata_directory not in _PACKFILES and \
+       os.path.isfile(packfile_filepath):
+      logging.info('Use {}'.format(packfile_filepath))
+      _PACKFILES[metadata_directory] = PackfileReader(packfile_filepath)
+    cls.__PACKFILE = _PACKFILES.get(metadata_directory)
+
+    # SnapshotIndex, if the snapshot metadata has been indexed since it last
+    # changed, or None.
+    snapshot_index_filepath = os.path.join(metadata_directory,
+                                           SNAPSHOT_INDEX_FILENAME)
+    if metadata_directory not in _SNAPSHOT_INDEXES and \
+       os.path.isfile(snapshot_index_filepath):
+      snapshot_index = SnapshotIndex(snapshot_index_filepath)
+
+      if snapshot_index.get_fingerprint() == \
+         snapshotindex.get_fingerprint(metadata_directory, cls.__PACKFILE):
+        logging.info('Use {}'.format(snapshot_index_filepath))
+        _SNAPSHOT_INDEXES[metadata_directory] = snapshot_index
+      else:
+        logging.warning('Ignore stale {}'.format(snapshot_index_filepath))
+        snapshot_index.close()
+    cls.__SNAPSHOT_INDEX = _SNAPSHOT_INDEXES.get(metadata_directory)
 
     # str (prev + curr metadata relpath): int (file length > -1)
-    if os.path.isfile(metadata_patch_length_cache_filepath):
-      with open(metadata_patch_length_cache_filepath) as \
-                                              metadata_patch_length_cache_file:
-        logging.debug('READ {}'.format(metadata_patch_length_cache_filepath))
-        cls.__METADATA_PATCH_LENGTH_CACHE = \
-                                    json.load(metadata_patch_length_cache_file)
-    else:
-      logging.debug('NO {}'.format(metadata_patch_length_cache_filepath))
-      cls.__METADATA_PATCH_LENGTH_CACHE = {}
+    cls.__METADATA_PATCH_LENGTH_CACHE = \
+                      cls.__setup_cache(metadata_patch_length_cache_filepath)
 
     # str (prev + curr metadata relpath): str/int (project_metadata_identifier)
-    if os.path.isfile(dirty_projects_cache_filepath):
-      with open(dirty_projects_cache_filepath) as dirty_projects_cache_file:
-        logging.debug('READ {}'.format(dirty_projects_cache_filepath))
-        cls._DIRTY_PROJECTS_CACHE = json.load(dirty_projects_cache_file)
-    else:
-      logging.debug('NO {}'.format(dirty_projects_cache_filepath))
-      cls._DIRTY_PROJECTS_CACHE = {}
-
-    logging.info('Setup project metadata...')
-    cls.__setup_project_metadata()
-    logging.info('...done.')
+    cls._DIRTY_PROJECTS_CACHE = \
+                      cls.__setup_cache(dirty_projects_cache_filepath)
 
     # str (metadata relpath): dict (snapshot metadata)
     logging.info('Setup snapshot metadata...')
@@ -455,19 +601,23 @@ class MetadataReader:
   @classmethod
   def teardown(cls, metadata_patch_length_cache_filepath,
                dirty_projects_cache_filepath):
-    if not os.path.isfile(metadata_patch_length_cache_filepath):
-      with open(metadata_patch_length_cache_filepath, 'w') as \
-                                              metadata_patch_length_cache_file:
-        json.dump(cls.__METADATA_PATCH_LENGTH_CACHE,
-                  metadata_patch_length_cache_file, indent=1, sort_keys=True)
-      logging.debug('WROTE {}'.format(metadata_patch_length_cache_filepath))
-
-    if not os.path.isfile(dirty_projects_cache_filepath):
-      with open(dirty_projects_cache_filepath, 'w') as \
-                                                      dirty_projects_cache_file:
-        json.dump(cls._DIRTY_PROJECTS_CACHE, dirty_projects_cache_file,
-                  indent=1, sort_keys=True)
-      logging.debug('WROTE {}'.format(dirty_projects_cache_filepath))
+    # NOTE: Every entry was already committed to disk as soon as it was
+    # computed, so there is nothing left to write.
+    for cache_filepath in (metadata_patch_length_cache_filepath,
+                           dirty_projects_cache_filepath):
+      # Another class of readers may have already closed a shared cache.
+      cache = _PERSISTENT_CACHES.pop(cache_filepath, None)
+      if cache is not None:
+        cache.close()
+
+    cls.__unpin_snapshot_metadata()
+    _METADATA_CACHES.pop(cls.__METADATA_DIRECTORY, None)
+    packfile = _PACKFILES.pop(cls.__METADATA_DIRECTORY, None)
+    if packfile is not None:
+      packfile.close()
+    snapshot_index = _SNAPSHOT_INDEXES.pop(cls.__METADATA_DIRECTORY, None)
+    if snapshot_index is not None:
+      snapshot_index.close()
 
 
 class PackageCost:
@@ -569,34 +719,268 @@ class PackageCostEncoder(json.JSONEncoder):
       return json.JSONEncoder.default(self, obj)
 
 
+class PackageCostWriter:
+
+
+  '''
+  Append the running totals of package costs to a JSON Lines log once per
+  interval, instead of rewriting every result so far at every interval.
+
+  When closed, summarize the log into the day-keyed JSON output that we plot.
+  '''
+
+
+  def __init__(self, output_filename, interval=RESULTS_INTERVAL_IN_SECONDS):
+    assert output_filename.endswith('.json')
+    assert interval > 0
+    assert NUMBER_OF_SECONDS_IN_A_DAY % interval == 0
+
+    self.__output_filename = output_filename
+    self.__log_filename = output_filename+'l'
+    self.__interval = interval
+
+    for filename in (self.__output_filename, self.__log_filename):
+      if os.path.exists(filename):
+        os.remove(filename)
+        logging.debug('Deleted {}'.format(filename))
+
+    self.__log_file = open(self.__log_filename, 'wt')
+
+
+  def __summarize(self):
+    # str (day number): {'elapsed_time': int, 'new': dict, 'return': dict}
+    daily_costs = {}
+    prev_day_number = 0
+    day_number = 0
+    interval_costs = None
+
+    with open(self.__log_filename, 'rt') as log_file:
+      for line in log_file:
+        interval_costs = json.loads(line)
+        day_number = (interval_costs['interval']*self.__interval) // \
+                     NUMBER_OF_SECONDS_IN_A_DAY
+
+        # Keep only the first interval of every day...
+        if day_number > prev_day_number:
+          daily_costs[day_number] = interval_costs
+          prev_day_number = day_number
+
+    # ...except for the last day, which keeps the final totals.
+    if interval_costs:
+      daily_costs[day_number] = interval_costs
+
+    # Oh, you want to know why we're explicitly converting an int to a str?
+    # Because Python 3 gets confused about sorting str and int keys.
+    # https://bugs.python.org/issue25457
+    return {
+      str(day_number): {
+        'elapsed_time': interval_costs['elapsed_time'],
+        'new': interval_costs['new'],
+        'return': interval_costs['return']
+      } for day_number, interval_costs in daily_costs.items()
+    }
+
+
+  def close(self):
+    self.__log_file.close()
+
+    with open(self.__output_filename, 'w') as output_file:
+      json.dump(self.__summarize(), output_file, indent=1, sort_keys=True)
+    logging.debug('WROTE {}'.format(self.__output_filename))
+
+
+  @property
+  def interval(self):
+    return self.__interval
+
+
+  def write(self, new_package_cost, return_package_cost, interval_number,
+            elapsed_time):
+    interval_costs = {
+      'elapsed_time': elapsed_time,
+      'interval': interval_number,
+      'new': PackageCostEncoder.encode_package_cost(new_package_cost),
+      'return': PackageCostEncoder.encode_package_cost(return_package_cost)
+    }
+    self.__log_file.write(json.dumps(interval_costs, sort_keys=True)+'\n')
+    self.__log_file.flush()
+
+
+class Replay:
+
+
+  '''
+  Replay package requests against one class of metadata readers, and keep the
+  running totals of package costs for new and returning users.
+
+  Replays of disjoint sets of users can be merged with _merge_intervals.
+  '''
+
+
+  def __init__(self, metadata_reader_class, interval, package_cost_writer=None):
+    self.__metadata_reader_class = metadata_reader_class
+    self.__interval = interval
+    # Write intervals as soon as we see them, if we are replaying all users.
+    self.__package_cost_writer = package_cost_writer
+
+    # str (user-agent@ip-address): MetadataReader (user)
+    self.__metadata_readers = {}
+    # The total metadata+package costs for new users.
+    self.new_package_cost = PackageCost()
+    # The total metadata+package costs for returning users.
+    self.return_package_cost = PackageCost()
+
+    self.missed_requests, self.total_requests = 0, 0
+    self.missed_packages = set()
+    self.prev_user_timestamp = 0
+    self.curr_interval_number = 0
+    self.__prev_interval_number = 0
+    # [IntervalCost]
+    self.intervals = []
+
+    self.__curr_snapshot_timestamp, self.__next_snapshot_timestamp = \
+              metadata_reader_class.get_current_and_next_snapshot_timestamps()
+
+
+  # NOTE: Do not pickle users, which are useless outside of this replay.
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_Replay__metadata_readers'] = {}
+    state['_Replay__package_cost_writer'] = None
+    return state
+
+
+  def advance(self, curr_user_timestamp):
+    # We must be going forward, or staying where we are, in time.
+    assert self.prev_user_timestamp <= curr_user_timestamp
+    self.prev_user_timestamp = curr_user_timestamp
+    # Set the current snapshot timestamp to the next one if the next
+    # snapshot timestamp is already strictly older than the user timestamp.
+    if curr_user_timestamp > self.__next_snapshot_timestamp:
+      logging.debug('advance snapshot: {} > {}'\
+                    .format(curr_user_timestamp,
+                            self.__next_snapshot_timestamp))
+      self.__curr_snapshot_timestamp, self.__next_snapshot_timestamp = \
+        self.__metadata_reader_class.get_current_and_next_snapshot_timestamps()
+
+
+  def charge(self, line_number, curr_user_timestamp, ip_address, url):
+    new_package_cost = self.new_package_cost+PackageCost()
+    return_package_cost = self.return_package_cost+PackageCost()
+
+    try:
+      logging.debug('USER {}'.format(ip_address))
+      if ip_address in self.__metadata_readers:
+        metadata_reader = self.__metadata_readers[ip_address]
+        package_cost = \
+            metadata_reader.return_charge(self.__curr_snapshot_timestamp, url)
+        self.return_package_cost += package_cost
+        is_new = False
+      else:
+        metadata_reader = self.__metadata_reader_class(ip_address)
+        self.__metadata_readers[ip_address] = metadata_reader
+        package_cost = \
+               metadata_reader.new_charge(self.__curr_snapshot_timestamp, url)
+        self.new_package_cost += package_cost
+        is_new = True
+
+    # FIXME: But should we count the metadata cost anyway?
+    except (UnknownPackage, UnknownProject):
+      self.missed_packages.add(url)
+      self.missed_requests += 1
+    else:
+      self.curr_interval_number = (curr_user_timestamp-SINCE_TIMESTAMP) // \
+                                  self.__interval
+      logging.debug('Interval {}: {}'.format(self.curr_interval_number,
+                                             self.new_package_cost+\
+                                             self.return_package_cost))
+      if self.curr_interval_number > self.__prev_interval_number:
+        elapsed_time = self.prev_user_timestamp - SINCE_TIMESTAMP
+        # Remember the costs right before this request, so that we can merge
+        # this interval with those of other users.
+        self.intervals.append(IntervalCost(self.curr_interval_number,
+                                           line_number, elapsed_time,
+                                           new_package_cost,
+                                           return_package_cost, package_cost,
+                                           is_new))
+        if self.__package_cost_writer:
+          self.__package_cost_writer.write(self.new_package_cost,
+                                           self.return_package_cost,
+                                           self.curr_interval_number,
+                                           elapsed_time)
+        self.__prev_interval_number = self.curr_interval_number
+
+    finally:
+      self.total_requests += 1
+      assert self.missed_requests <= self.total_requests
+      logging.info('Total requests: {:,}'.format(self.total_requests))
+      logging.info('')
+
+
 class UnknownPackage(Exception): pass
 class UnknownProject(Exception): pass
 
 
-def count(metadata_reader_class, output_filename):
-  # str (user-agent@ip-address): MetadataReader (user)
-  metadata_readers = {}
-  # The total metadata+package costs for new users.
-  new_package_cost = PackageCost()
-  # The total metadata+package costs for returning users.
-  return_package_cost = PackageCost()
+def _get_shard_number(ip_address, number_of_shards):
+  # NOTE: Unlike hash(), CRC-32 is the same in every process.
+  return zlib.crc32(ip_address.encode('utf-8')) % number_of_shards
 
-  missed_requests, total_requests = 0, 0
-  missed_packages = set()
-  prev_user_timestamp = 0
-  prev_day_number = 0
 
-  curr_snapshot_timestamp, next_snapshot_timestamp = \
-              metadata_reader_class.get_current_and_next_snapshot_timestamps()
+def _merge_intervals(replays):
+  '''Merge the intervals of replays of disjoint users into the intervals that
+  a single replay of all users would have seen.'''
+
+  interval_numbers = sorted({interval_cost.interval_number \
+                             for replay in replays \
+                             for interval_cost in replay.intervals})
+  # The next interval of every replay that we have yet to merge.
+  next_indices = [0]*len(replays)
+
+  for interval_number in interval_numbers:
+    new_package_cost, return_package_cost = PackageCost(), PackageCost()
+    first_interval_cost = None
+
+    for i, replay in enumerate(replays):
+      while next_indices[i] < len(replay.intervals) and \
+            replay.intervals[next_indices[i]].interval_number < interval_number:
+        next_indices[i] += 1
+
+      # A replay that has no more intervals has not charged anything since
+      # its last one.
+      if next_indices[i] == len(replay.intervals):
+        new_package_cost += replay.new_package_cost
+        return_package_cost += replay.return_package_cost
+
+      # Otherwise, it has not charged anything since its last interval before
+      # this one, either.
+      else:
+        interval_cost = replay.intervals[next_indices[i]]
+        new_package_cost += interval_cost.new_package_cost
+        return_package_cost += interval_cost.return_package_cost
+
+        # The first request to enter this interval among all users is the one
+        # that a single replay would have seen.
+        if interval_cost.interval_number == interval_number and \
+           (not first_interval_cost or \
+            interval_cost.line_number < first_interval_cost.line_number):
+          first_interval_cost = interval_cost
+
+    assert first_interval_cost
+    if first_interval_cost.is_new:
+      new_package_cost += first_interval_cost.package_cost
+    else:
+      return_package_cost += first_interval_cost.package_cost
 
-  if os.path.exists(output_filename):
-    os.remove(output_filename)
-    logging.debug('Deleted {}'.format(output_filename))
+    yield new_package_cost, return_package_cost, interval_number, \
+          first_interval_cost.elapsed_time
 
+
+def _read_requests():
   with open(REQUESTS_FILENAME, 'rt') as requests_file:
     requests_file = csv.reader(requests_file)
 
-    for curr_user_timestamp, ip_address, url, user_agent in requests_file:
+    for line_number, (curr_user_timestamp, ip_address, url, user_agent) in \
+                                                      enumerate(requests_file):
       curr_user_timestamp = int(curr_user_timestamp)
 
       # If we are out of time or new snapshots, then let's stop.
@@ -605,100 +989,141 @@ def count(metadata_reader_class, output_filename):
                                                TIME_LIMIT_IN_SECONDS
       if time_limit_is_up or SNAPSHOTS_ARE_EXHAUSTED: break
 
-      # We must be going forward, or staying where we are, in time.
-      assert prev_user_timestamp <= curr_user_timestamp
-      prev_user_timestamp = curr_user_timestamp
-      # Set the current snapshot timestamp to the next one if the next
-      # snapshot timestamp is already strictly older than the user timestamp.
-      if curr_user_timestamp > next_snapshot_timestamp:
-        logging.debug('advance snapshot: {} > {}'\
-                      .format(curr_user_timestamp, next_snapshot_timestamp))
-        curr_snapshot_timestamp, next_snapshot_timestamp = \
-            metadata_reader_class.get_current_and_next_snapshot_timestamps()
-
-      try:
-        logging.debug('USER {}'.format(ip_address))
-        if ip_address in metadata_readers:
-          metadata_reader = metadata_readers[ip_address]
-          return_package_cost += \
-                    metadata_reader.return_charge(curr_snapshot_timestamp, url)
-        else:
-          metadata_reader = metadata_reader_class(ip_address)
-          metadata_readers[ip_address] = metadata_reader
-          new_package_cost += \
-                      metadata_reader.new_charge(curr_snapshot_timestamp, url)
-
-      # FIXME: But should we count the metadata cost anyway?
-      except (UnknownPackage, UnknownProject):
-        missed_packages.add(url)
-        missed_requests += 1
-      else:
-        curr_day_number = (curr_user_timestamp-SINCE_TIMESTAMP) // \
-                           NUMBER_OF_SECONDS_IN_A_DAY
-        logging.debug('Day {}: {}'.format(curr_day_number,
-                                          new_package_cost+\
-                                          return_package_cost))
-        if curr_day_number > prev_day_number:
-          elapsed_time = prev_user_timestamp - SINCE_TIMESTAMP
-          write(new_package_cost, return_package_cost, curr_day_number,
-                elapsed_time, output_filename)
-          prev_day_number = curr_day_number
-
-      finally:
-        total_requests += 1
-        assert missed_requests <= total_requests
-        logging.info('Total requests: {:,}'.format(total_requests))
-        logging.info('')
+      yield line_number, curr_user_timestamp, ip_address, url
+
+
+def _replay(metadata_reader_classes, interval, package_cost_writers=None,
+            shard_number=0, number_of_shards=1):
+  package_cost_writers = package_cost_writers or \
+                         [None]*len(metadata_reader_classes)
+  replays = [Replay(metadata_reader_class, interval, package_cost_writer) \
+             for metadata_reader_class, package_cost_writer in \
+             zip(metadata_reader_classes, package_cost_writers)]
+
+  # Parse every request only once for all replays.
+  for line_number, curr_user_timestamp, ip_address, url in _read_requests():
+    in_shard = number_of_shards == 1 or \
+               _get_shard_number(ip_address, number_of_shards) == shard_number
+
+    for replay in replays:
+      # Every shard must see every request in order to advance through the
+      # same snapshots at the same time...
+      replay.advance(curr_user_timestamp)
+
+      # ...but it charges only the requests of its own users.
+      if in_shard:
+        replay.charge(line_number, curr_user_timestamp, ip_address, url)
+
+  return replays
+
+
+def _summarize(replays, package_cost_writer):
+  new_package_cost, return_package_cost = PackageCost(), PackageCost()
+  missed_requests, total_requests = 0, 0
+  missed_packages = set()
+
+  for replay in replays:
+    new_package_cost += replay.new_package_cost
+    return_package_cost += replay.return_package_cost
+    missed_requests += replay.missed_requests
+    total_requests += replay.total_requests
+    missed_packages |= replay.missed_packages
+
+  curr_interval_number = max(replay.curr_interval_number for replay in replays)
+  prev_user_timestamp = max(replay.prev_user_timestamp for replay in replays)
 
   missed_percentage = (missed_requests/total_requests)*100
   logging.info('{}% missed requests'.format(missed_percentage))
   logging.info('Missed these packages: {}'.format(sorted(missed_packages)))
 
-  logging.info('Day {}'.format(curr_day_number))
+  logging.info('Interval {}'.format(curr_interval_number))
   logging.info('New: {}'.format(new_package_cost))
   logging.info('Return: {}'.format(return_package_cost))
   logging.info('Total: {}'.format(new_package_cost+return_package_cost))
   elapsed_time = prev_user_timestamp - SINCE_TIMESTAMP
-  write(new_package_cost, return_package_cost, curr_day_number, elapsed_time,
-        output_filename)
+  package_cost_writer.write(new_package_cost, return_package_cost,
+                            curr_interval_number, elapsed_time)
+  package_cost_writer.close()
+
+
+def count(metadata_reader_class, output_filename,
+          number_of_shards=NUMBER_OF_SHARDS):
+  count_all((metadata_reader_class,), (output_filename,), number_of_shards)
+
+
+# Replay the same requests against every class of metadata readers at once.
+def count_all(metadata_reader_classes, output_filenames,
+              number_of_shards=NUMBER_OF_SHARDS):
+  assert len(metadata_reader_classes) == len(output_filenames)
+  assert number_of_shards > 0
+  package_cost_writers = [PackageCostWriter(output_filename) \
+                          for output_filename in output_filenames]
+  interval = package_cost_writers[0].interval
+
+  # Replay all users in this process, and write their costs as we go.
+  if number_of_shards == 1:
+    # [[Replay] (one per class)] (one per shard)
+    shard_replays = [_replay(metadata_reader_classes, interval,
+                             package_cost_writers)]
+
+  # Otherwise, replay every shard of users in its own process. Users share
+  # nothing but class-level caches, which every process inherits on fork.
+  else:
+    logging.info('Replaying {} shards...'.format(number_of_shards))
+    with multiprocessing.get_context('fork').Pool(number_of_shards) as pool:
+      shard_numbers = range(number_of_shards)
+      shard_replays = pool.starmap(_replay,
+                                   ((metadata_reader_classes, interval, None,
+                                     shard_number, number_of_shards) \
+                                    for shard_number in shard_numbers))
+    logging.info('...done.')
+
+    for i, package_cost_writer in enumerate(package_cost_writers):
+      replays = [replays[i] for replays in shard_replays]
+      for interval_costs in _merge_intervals(replays):
+        package_cost_writer.write(*interval_costs)
+
+  for i, package_cost_writer in enumerate(package_cost_writers):
+    # NOTE: Several scripts give their classes the same name, but not the
+    # same module.
+    metadata_reader_class = metadata_reader_classes[i]
+    logging.info('{}.{}'.format(metadata_reader_class.__module__,
+                                metadata_reader_class.__qualname__))
+    _summarize([replays[i] for replays in shard_replays], package_cost_writer)
 
 
 def read(log_filename, MetadataReaderClass, metadata_directory,
          metadata_patch_length_cache_filepath, dirty_projects_cache_filepath,
          output_filename):
+  read_all(log_filename, ((MetadataReaderClass, metadata_directory,
+                           metadata_patch_length_cache_filepath,
+                           dirty_projects_cache_filepath, output_filename),))
+
+
+# Every scheme is a tuple of: MetadataReaderClass, metadata_directory,
+# metadata_patch_length_cache_filepath, dirty_projects_cache_filepath, and
+# output_filename.
+def read_all(log_filename, schemes):
   logging.basicConfig(filename=log_filename, level=logging.DEBUG, filemode='w',
                       format=LOG_FORMAT)
 
   try:
-    MetadataReaderClass.setup(metadata_directory,
-                              metadata_patch_length_cache_filepath,
-                              dirty_projects_cache_filepath)
-    count(MetadataReaderClass, output_filename)
-    MetadataReaderClass.teardown(metadata_patch_length_cache_filepath,
-                                 dirty_projects_cache_filepath)
+    for MetadataReaderClass, metadata_directory, \
+        metadata_patch_length_cache_filepath, dirty_projects_cache_filepath, \
+        output_filename in schemes:
+      MetadataReaderClass.setup(metadata_directory,
+                                metadata_patch_length_cache_filepath,
+                                dirty_projects_cache_filepath)
+
+    count_all([scheme[0] for scheme in schemes],
+              [scheme[-1] for scheme in schemes])
+
+    for MetadataReaderClass, metadata_directory, \
+        metadata_patch_length_cache_filepath, dirty_projects_cache_filepath, \
+        output_filename in schemes:
+      MetadataReaderClass.teardown(metadata_patch_length_cache_filepath,
+                                   dirty_projects_cache_filepath)
 
   except:
     logging.exception('MEOW!')
     raise
-
-
-def write(new_package_cost, return_package_cost, day_number, elapsed_time,
-          output_filename):
-  if os.path.exists(output_filename):
-    with open(output_filename, 'r') as output_file:
-      daily_costs = json.load(output_file)
-  else:
-    daily_costs = {}
-
-  # Oh, you want to know why we're explicitly converting an int to a str?
-  # Because Python 3 gets confused about sorting str and int keys.
-  # https://bugs.python.org/issue25457
-  day_number_str = str(day_number)
-  daily_costs[day_number_str] = {
-    'elapsed_time': elapsed_time,
-    'new': PackageCostEncoder.encode_package_cost(new_package_cost),
-    'return': PackageCostEncoder.encode_package_cost(return_package_cost)
-  }
-
-  with open(output_filename, 'w') as output_file:
-    json.dump(daily_costs, output_file, indent=1, sort_keys=True)
@@ -6,18 +6,118 @@ write, for example, TUF or Mercury metadata.
 
 # 1st-party
 import binascii
+import bisect
+import collections
+import concurrent.futures
 import datetime
 import errno
+import glob
 import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import pickle
 import shutil
+import threading
+import weakref
 
 
 # 2nd-party
+import canonicaljson
 from changelog import ChangeLogReader, unix_timestamp
-from nouns import LOG_FORMAT
+from metadatacache import PersistentCache
+import metadatadiff
+import metadatakeys
+from nouns import CHECKPOINT_DIRECTORY_NAME, CHECKPOINT_INTERVAL_IN_SECONDS, \
+                  COMPACT_METADATA, JOURNAL_FILENAME, LOG_FORMAT, \
+                  MAX_DIRTY_PROJECTS_PER_RELEASE, \
+                  MAX_RELEASE_STALENESS_IN_SECONDS, \
+                  MIN_DIRTY_PROJECTS_TO_PARALLELIZE, \
+                  NUMBER_OF_CHECKPOINTS_TO_KEEP, NUMBER_OF_WRITER_THREADS, \
+                  PACK_METADATA, PACKFILE_FILENAME, \
+                  PRECOMPUTE_METADATA_CACHES, RELEASE_INTERVAL_IN_SECONDS, \
+                  REVERSED_PROJECTS_FILEPATH, SNAPSHOT_INDEX_FILENAME, \
+                  SNAPSHOT_KEYFRAME_INTERVAL
+from packfile import PackfileWriter
+import snapshotdelta
+
+
+# The writer that forked workers make project metadata with.
+_FORKED_METADATA_WRITER = None
+# {MetadataWriter} (whose threads must be joined before forking)
+_OPEN_METADATA_WRITERS = weakref.WeakSet()
+# The pool of processes that measure patches for every writer that fills the
+# caches, and the number of those writers that are open.
+_PATCH_POOL = None
+_NUMBER_OF_PATCH_POOL_USERS = 0
+# Tells write() to resume from the latest checkpoint, if there is one.
+LATEST_CHECKPOINT = 'latest'
+
+
+class ReleasePolicy:
+
+
+  '''
+  When writers release the changes buffered in their repository: at the end
+  of every fixed window of interval seconds, once the oldest buffered change is
+  max_staleness seconds old, or once max_dirty_projects projects are dirty,
+  whichever comes first. Without any of them, every timestamp is released.
+
+  A release at a timestamp has every change up to and including it.
+  '''
+
+
+  def __init__(self, interval=RELEASE_INTERVAL_IN_SECONDS,
+               max_staleness=MAX_RELEASE_STALENESS_IN_SECONDS,
+               max_dirty_projects=MAX_DIRTY_PROJECTS_PER_RELEASE):
+    assert interval is None or interval > 0
+    assert max_staleness is None or max_staleness >= 0
+    assert max_dirty_projects is None or max_dirty_projects > 0
+
+    self.interval = interval
+    self.max_staleness = max_staleness
+    self.max_dirty_projects = max_dirty_projects
+
+
+  def __repr__(self):
+    return 'ReleasePolicy(interval={}, max_staleness={}, '\
+           'max_dirty_projects={})'.format(self.interval, self.max_staleness,
+                                           self.max_dirty_projects)
+
+
+  def get_deadline(self, first_change_timestamp):
+    '''Return the timestamp by which changes buffered since this timestamp
+    must be released, or None if only the number of dirty projects bounds
+    it.'''
+
+    deadlines = []
+
+    if self.interval is not None:
+      # The last second of the window of this timestamp.
+      deadlines.append((first_change_timestamp//self.interval+1)*\
+                       self.interval-1)
+
+    if self.max_staleness is not None:
+      deadlines.append(first_change_timestamp+self.max_staleness)
+
+    if len(deadlines) > 0:
+      return min(deadlines)
+    elif self.max_dirty_projects is None:
+      return first_change_timestamp
+    else:
+      return None
+
+
+  def is_full(self, repository):
+    '''Return whether this repository has too many dirty projects to buffer
+    any more changes.'''
+
+    if self.max_dirty_projects is None:
+      return False
+    else:
+      return repository.projects.number_of_dirty_projects >= \
+             self.max_dirty_projects
 
 
 class MetadataWriter:
@@ -25,10 +125,35 @@ class MetadataWriter:
 
   '''
   A base class for writing metadata.
+
+  If given the filepaths of the caches of patch lengths and dirty projects,
+  it also fills them, as it flushes metadata, with the same entries that
+  readers would otherwise compute themselves.
+
+  If given the filepath of a packfile, it appends every version of metadata
+  to the packfile instead of writing it to its own file. Otherwise, it notes
+  every file in a journal before writing it, so that a writer resumed from a
+  checkpoint knows which files to delete.
+
+  Given writer threads, it writes the metadata of a release to disk in those
+  threads, while it makes the next release. Snapshot metadata is written only
+  after all of the project metadata it lists, and only after the previous
+  snapshot metadata.
   '''
 
 
-  def __init__(self, repository, metadata_directory, delete=True):
+  # Maximum number of patches waiting to be measured by workers, per worker.
+  MAX_PENDING_PATCHES_PER_WORKER = 16
+  # Maximum number of files waiting to be written by threads, per thread.
+  MAX_PENDING_WRITES_PER_THREAD = 64
+  # Stands in for signed.meta while the rest of snapshot metadata is encoded.
+  SNAPSHOT_META_PLACEHOLDER = '<signed.meta>'
+
+
+  def __init__(self, repository, metadata_directory, delete=True,
+               metadata_patch_length_cache_filepath=None,
+               dirty_projects_cache_filepath=None, packfile_filepath=None,
+               number_of_writer_threads=NUMBER_OF_WRITER_THREADS):
     logging.debug('Init...')
 
     self.repository = repository
@@ -41,11 +166,417 @@ class MetadataWriter:
     self.mkdir(metadata_directory)
     self.metadata_directory = metadata_directory
 
+    # Whatever the writer opens from these is never pickled, but opened again
+    # when the writer is unpickled.
+    self.__packfile_filepath = packfile_filepath
+    self.__number_of_writer_threads = number_of_writer_threads
+    self.__metadata_patch_length_cache_filepath = \
+                                          metadata_patch_length_cache_filepath
+    self.__dirty_projects_cache_filepath = dirty_projects_cache_filepath
+    self.__open()
+    # How far the packfile or journal, and the last rowids of the caches of
+    # patch lengths and dirty projects, went when this writer was
+    # checkpointed, if it was unpickled from a checkpoint and not rewound yet.
+    self.__journal_offset = None
+    self.__cache_rowids = None
+
     self.reset_metadata()
 
+    if self.__metadata_patch_length_cache is not None:
+      # The last flushed project metadata, which the next one is compared
+      # against.
+      # str (project name): (str (project metadata relpath), bytes (JSON))
+      self.__flushed_project_metadata = {}
+      # The initial snapshot metadata, which every user starts with, and which
+      # every later one is compared against.
+      # (str (snapshot metadata relpath), dict (snapshot metadata))
+      self.__initial_snapshot_metadata = (None, None)
+      # {str (project metadata relpath)} (entries of signed.meta that differ
+      # from those of the initial snapshot metadata)
+      self.__snapshot_meta_changed_since_initial = set()
+
     logging.debug('...done.')
 
 
+  # Open the packfile, threads, caches and processes of this writer.
+  def __open(self):
+    # PackfileWriter, or None to write every version of metadata to its own
+    # file, which is noted in the journal instead.
+    if self.__packfile_filepath:
+      self.__packfile = PackfileWriter(self.__packfile_filepath)
+      self.__journal_file = None
+    else:
+      self.__packfile = None
+      self.__journal_file = open(os.path.join(self.metadata_directory,
+                                              JOURNAL_FILENAME), 'ab')
+    # Keeps the relpaths noted by threads from interleaving.
+    self.__journal_lock = threading.Lock()
+
+    # [Future] (the writes of the release in progress)
+    self.__pending_writes = []
+    self.__start_writer_threads()
+    _OPEN_METADATA_WRITERS.add(self)
+
+    # str (prev + curr metadata relpath): int (file length > -1)
+    self.__metadata_patch_length_cache = None
+    # str (prev + curr metadata relpath):
+    #   {str (project metadata relpath): str/int (project metadata identifier)}
+    self.__dirty_projects_cache = None
+    self.__pool = None
+    self.__max_pending_patches = 0
+    # [AsyncResult] (in order of submission)
+    self.__pending_patches = collections.deque()
+
+    if self.__metadata_patch_length_cache_filepath and \
+       self.__dirty_projects_cache_filepath:
+      self.__metadata_patch_length_cache = \
+                    PersistentCache(self.__metadata_patch_length_cache_filepath)
+      self.__dirty_projects_cache = \
+                          PersistentCache(self.__dirty_projects_cache_filepath)
+
+      # Measure patches in other processes, so as not to slow down writing.
+      # NOTE: Every writer shares the same workers.
+      self.__pool = _open_patch_pool()
+      number_of_workers = os.cpu_count() or 1
+      self.__max_pending_patches = \
+                      self.MAX_PENDING_PATCHES_PER_WORKER*number_of_workers
+
+
+  # Store the lengths of the patches that workers have measured. Wait only for
+  # the oldest patches, and only until there are not too many pending.
+  def __drain_patches(self, max_pending_patches=0):
+    patch_lengths = {}
+
+    while self.__pending_patches and \
+          (self.__pending_patches[0].ready() or \
+           len(self.__pending_patches) > max_pending_patches):
+      key, patch_length = self.__pending_patches.popleft().get()
+      patch_lengths[key] = patch_length
+
+    if patch_lengths:
+      self.__metadata_patch_length_cache.update(patch_lengths)
+
+
+  # Measure patches from both nothing and the previous metadata to the current
+  # metadata, just as readers would key them.
+  def __make_patches(self, prev_metadata_relpath, prev_metadata_json,
+                     curr_metadata_relpath, curr_metadata_json):
+    prev_metadata = [(None, None)]
+    if prev_metadata_relpath and prev_metadata_relpath != curr_metadata_relpath:
+      prev_metadata.append((prev_metadata_relpath, prev_metadata_json))
+
+    for metadata_relpath, metadata_json in prev_metadata:
+      key = metadatakeys.get_patch_key(metadata_relpath,
+                                       curr_metadata_relpath)
+
+      if key not in self.__metadata_patch_length_cache:
+        self.__pending_patches.append(
+                      self.__pool.apply_async(_get_patch_length,
+                                              (key, metadata_json,
+                                               curr_metadata_json)))
+
+    self.__drain_patches(self.__max_pending_patches)
+
+
+  # Record the patches from the last flushed project metadata, and from the
+  # initial snapshot metadata, along with the projects that are dirty since
+  # the initial snapshot metadata. These are the pairs of snapshot metadata
+  # that readers ask for, because every user starts with the initial one.
+  # NOTE: Readers still compute any other pair themselves (e.g. from the
+  # snapshot metadata that a returning user saw last).
+  def __record_patches(self, timestamp):
+    for project_name in self.repository.projects.dirty:
+      curr_metadata_relpath = 'packages/{}.{}.json'\
+                      .format(project_name,
+                              self.project_metadata_identifier(project_name))
+      curr_metadata_json = self.project_developer_metadata_json[project_name]
+      prev_metadata_relpath, prev_metadata_json = \
+              self.__flushed_project_metadata.get(project_name, (None, None))
+      self.__make_patches(prev_metadata_relpath, prev_metadata_json,
+                          curr_metadata_relpath, curr_metadata_json)
+      self.__flushed_project_metadata[project_name] = (curr_metadata_relpath,
+                                                       curr_metadata_json)
+
+    curr_metadata_relpath = 'snapshot.{}.json'.format(timestamp)
+    curr_metadata = self.snapshot_administrator_metadata
+    prev_metadata_relpath, prev_metadata = self.__initial_snapshot_metadata
+
+    if prev_metadata_relpath is None:
+      # Keep signed.meta as it is now, because it is updated in place.
+      self.__initial_snapshot_metadata = \
+              (curr_metadata_relpath,
+               dict(curr_metadata, signed=dict(curr_metadata['signed'],
+                                               meta=dict(self.snapshot_meta))))
+      return
+
+    prev_meta = prev_metadata['signed']['meta']
+    changed_relpaths = self.__snapshot_meta_changed_since_initial
+    for project_metadata_relpath in self.snapshot_meta_removals:
+      if project_metadata_relpath in prev_meta:
+        changed_relpaths.add(project_metadata_relpath)
+      else:
+        changed_relpaths.discard(project_metadata_relpath)
+    for project_metadata_relpath, entry in self.snapshot_meta_changes.items():
+      if prev_meta.get(project_metadata_relpath) == entry:
+        changed_relpaths.discard(project_metadata_relpath)
+      else:
+        changed_relpaths.add(project_metadata_relpath)
+
+    # Compare only the entries of signed.meta that differ, because the others
+    # would not add to the patch anyway.
+    prev_changed_meta, curr_changed_meta = {}, {}
+    for project_metadata_relpath in sorted(changed_relpaths):
+      if project_metadata_relpath in prev_meta:
+        prev_changed_meta[project_metadata_relpath] = \
+                                            prev_meta[project_metadata_relpath]
+      if project_metadata_relpath in self.snapshot_meta:
+        curr_changed_meta[project_metadata_relpath] = \
+                                    self.snapshot_meta[project_metadata_relpath]
+
+    key = metadatakeys.get_patch_key(prev_metadata_relpath,
+                                     curr_metadata_relpath)
+    if key not in self.__metadata_patch_length_cache:
+      prev_metadata = dict(prev_metadata,
+                           signed=dict(prev_metadata['signed'],
+                                       meta=prev_changed_meta))
+      curr_metadata = dict(curr_metadata,
+                           signed=dict(curr_metadata['signed'],
+                                       meta=curr_changed_meta))
+      self.__pending_patches.append(
+                      self.__pool.apply_async(_measure_patch,
+                                              (key, prev_metadata,
+                                               curr_metadata)))
+      self.__drain_patches(self.__max_pending_patches)
+
+    # Only the projects that were added or changed since the initial snapshot
+    # metadata are dirty.
+    self.__dirty_projects_cache[key] = \
+                              metadatakeys.get_dirty_projects(curr_changed_meta)
+
+
+  # Split projects into slices, and make their metadata in forked workers,
+  # which inherit this writer and its repository. Return the results in the
+  # same order as the projects.
+  def __make_project_developer_metadata_in_parallel(self, project_names,
+                                                    timestamp):
+    global _FORKED_METADATA_WRITER
+
+    number_of_workers = os.cpu_count() or 1
+    # Give every worker a few slices, in case some are slower than others.
+    slice_size = -(-len(project_names)//(4*number_of_workers))
+    project_names_slices = [project_names[i:i+slice_size] \
+                            for i in range(0, len(project_names), slice_size)]
+    logging.info('Making metadata for {:,} projects in {} workers...'\
+                 .format(len(project_names), number_of_workers))
+
+    # NOTE: Join the threads of every open writer (e.g. still writing the
+    # previous release) first, lest forked workers inherit locks that those
+    # threads held at the time, and then deadlock on them.
+    metadata_writers = list(_OPEN_METADATA_WRITERS)
+    for metadata_writer in metadata_writers:
+      metadata_writer.__stop_writer_threads()
+
+    project_developer_metadata = []
+    _FORKED_METADATA_WRITER = self
+    try:
+      with multiprocessing.get_context('fork').Pool(number_of_workers) as pool:
+        for project_developer_metadata_slice in \
+            pool.imap(_make_project_developer_metadata_slice,
+                      ((project_names_slice, timestamp) \
+                       for project_names_slice in project_names_slices)):
+          project_developer_metadata.extend(project_developer_metadata_slice)
+    finally:
+      _FORKED_METADATA_WRITER = None
+      for metadata_writer in metadata_writers:
+        metadata_writer.__start_writer_threads()
+
+    return project_developer_metadata
+
+
+  # Return how far the packfile, or else the journal, goes: everything past
+  # this offset was written later.
+  def __get_journal_offset(self):
+    if self.__packfile is not None:
+      return self.__packfile.end_offset
+    else:
+      with self.__journal_lock:
+        self.__journal_file.flush()
+        return self.__journal_file.tell()
+
+
+  # Note this relpath in the journal before its file is written. The journal
+  # is flushed right away, lest the file outlive its note in a crash.
+  def __note_in_journal(self, metadata_relpath):
+    with self.__journal_lock:
+      self.__journal_file.write(metadata_relpath.encode('utf-8')+b'\n')
+      self.__journal_file.flush()
+
+
+  # Call this function to write metadata, either on a writer thread, or right
+  # away if there are none.
+  def __submit_write(self, function, *args):
+    if self.__executor is None:
+      function(*args)
+
+    else:
+      self.__write_slots.acquire()
+      try:
+        future = self.__executor.submit(function, *args)
+      except:
+        self.__write_slots.release()
+        raise
+      future.add_done_callback(lambda future: self.__write_slots.release())
+      self.__pending_writes.append(future)
+
+
+  # Wait until the release in progress is written, and raise any error that
+  # a writer thread ran into.
+  def __wait_for_writes(self):
+    pending_writes, self.__pending_writes = self.__pending_writes, []
+    for future in pending_writes:
+      future.result()
+
+
+  # Start the threads that write metadata, if there are any.
+  def __start_writer_threads(self):
+    # ThreadPoolExecutor, or None to write metadata on this thread.
+    if self.__number_of_writer_threads > 0:
+      self.__executor = \
+        concurrent.futures.ThreadPoolExecutor(self.__number_of_writer_threads)
+      # Blocks new writes while too many are waiting for a thread.
+      self.__write_slots = \
+        threading.BoundedSemaphore(self.MAX_PENDING_WRITES_PER_THREAD*\
+                                   self.__number_of_writer_threads)
+    else:
+      self.__executor = None
+      self.__write_slots = None
+
+
+  # Wait until the release in progress is written, and then join the threads
+  # that wrote it, if there are any.
+  def __stop_writer_threads(self):
+    self.__wait_for_writes()
+
+    if self.__executor is not None:
+      self.__executor.shutdown()
+      self.__executor = None
+      self.__write_slots = None
+
+
+  # Publish snapshot metadata only after all of the project metadata it lists.
+  def __write_snapshot_metadata(self, project_writes, filename, timestamp,
+                                snapshot_metadata_json):
+    for future in project_writes:
+      future.result()
+
+    # NOTE: We identify every snapshot metadata file with the "current"
+    # timestamp, and not the version number of the snapshot metadata file.
+    self.write_json_to_disk(filename, timestamp, snapshot_metadata_json)
+
+    # Lose at most the release in progress, if the writer crashes.
+    if self.__packfile is not None:
+      self.__packfile.flush()
+
+
+  # Return the filename and JSON to store the snapshot metadata of this
+  # release with: either in full, as a keyframe, or as a delta from the
+  # previous snapshot metadata.
+  def __get_stored_snapshot_metadata(self, timestamp):
+    # Everything but signed.meta, whose changes are already known.
+    signed = {key: value for key, value \
+              in self.snapshot_administrator_metadata['signed'].items() \
+              if key != 'meta'}
+    rest = dict(self.snapshot_administrator_metadata, signed=signed)
+
+    prev_snapshot_metadata = self.__prev_snapshot_metadata
+    self.__prev_snapshot_metadata = ('snapshot.{}.json'.format(timestamp),
+                                     rest)
+
+    if SNAPSHOT_KEYFRAME_INTERVAL is None or prev_snapshot_metadata is None \
+       or self.__number_of_snapshot_deltas+1 >= SNAPSHOT_KEYFRAME_INTERVAL:
+      self.__number_of_snapshot_deltas = 0
+      return 'snapshot.json', self.snapshot_administrator_metadata_json
+
+    else:
+      self.__number_of_snapshot_deltas += 1
+      prev_snapshot_metadata_relpath, prev_rest = prev_snapshot_metadata
+
+      patch = []
+      for project_metadata_relpath in self.snapshot_meta_removals:
+        patch.append({'op': 'remove',
+                      'path': metadatadiff.get_path('signed', 'meta',
+                                                    project_metadata_relpath)})
+      # NOTE: Adding an entry that already exists replaces it.
+      for project_metadata_relpath, entry in \
+          self.snapshot_meta_changes.items():
+        patch.append({'op': 'add',
+                      'path': metadatadiff.get_path('signed', 'meta',
+                                                    project_metadata_relpath),
+                      'value': entry})
+      metadatadiff.extend_patch(patch, '', prev_rest, rest)
+
+      delta = snapshotdelta.make_delta(prev_snapshot_metadata_relpath, patch)
+      return 'snapshot-delta.json', self.jsonify(delta)
+
+
+  # Forget the Fragment of every target of this project, except those that
+  # are kept (e.g. because the project still has those targets).
+  def __discard_target_fragments(self, project_name, kept_keys=()):
+    for key in self.__project_target_fragment_keys.pop(project_name, ()):
+      if key not in kept_keys:
+        self.__target_fragments.discard(key)
+
+
+  # Return the Fragment of every target of this project, and forget those of
+  # the targets that it no longer has (e.g. removed or uploaded again), lest
+  # they pile up.
+  def __get_target_fragments(self, project_name, targets):
+    # The same target may be uploaded again with different contents, so the
+    # key includes its hash and length as well.
+    keys = {target_relpath: (target_relpath, target['hashes']['sha256'],
+                             target['length']) \
+            for target_relpath, target in targets.items()}
+
+    kept_keys = set(keys.values())
+    self.__discard_target_fragments(project_name, kept_keys)
+    self.__project_target_fragment_keys[project_name] = kept_keys
+
+    return {target_relpath: self.__target_fragments.get(keys[target_relpath],
+                                                        target) \
+            for target_relpath, target in targets.items()}
+
+
+  # NOTE: This must encode signed.meta exactly like jsonify would. Compact
+  # JSON simply separates the sorted entries of signed.meta with a comma.
+  # Otherwise, jsonify indents every entry by three spaces, and separates them
+  # with a comma, a space and a newline.
+  def __jsonify_snapshot_meta(self):
+    entries_json = (self.__snapshot_meta_json[project_metadata_relpath] \
+                    for project_metadata_relpath \
+                    in self.__snapshot_meta_relpaths)
+
+    if len(self.__snapshot_meta_relpaths) == 0:
+      return self.jsonify({})
+    elif COMPACT_METADATA:
+      return b'{' + b','.join(entries_json) + b'}'
+    else:
+      return b'{\n' + b', \n'.join(entries_json) + b'\n  }'
+
+
+  def __jsonify_snapshot_meta_entry(self, project_metadata_relpath):
+    # Encode the entry as the only one in signed.meta, and strip the braces.
+    entry_json = self.jsonify({project_metadata_relpath:
+                               self.snapshot_meta[project_metadata_relpath]})
+
+    if COMPACT_METADATA:
+      assert entry_json.startswith(b'{') and entry_json.endswith(b'}')
+      return entry_json[1:-1]
+    else:
+      # Indent it two more levels.
+      assert entry_json.startswith(b'{\n') and entry_json.endswith(b'\n}')
+      return b'  ' + entry_json[2:-2].replace(b'\n', b'\n  ')
+
+
   # Expires this many days from this UTC timestamp.
   # Use the Javascript ISO 8601 format.
   def __make_expiration_timestamp(self, timestamp, days):
@@ -58,15 +589,56 @@ class MetadataWriter:
   # and version number.
   # EITHER the filenames, timestamp, OR the version number MUST change in order
   # for the entire signature to change.
+  # NOTE: The filenames must already be sorted.
   def __make_pseudo_signature(self, filenames, timestamp, version):
-    change = '{}{}{}'.format(''.join(sorted(filenames)), timestamp, version)
+    change = '{}{}{}'.format(''.join(filenames), timestamp, version)
     # Concatenate two 64-byte hashes to get one 128-byte "signature".
     first_half = self.get_sha256(change.encode('utf-8'))
     second_half = self.get_sha256(first_half.encode('utf-8'))
     return first_half+second_half
 
 
-  def flush_metadata(self, timestamp):
+  # NOTE: Only a flushed writer may be pickled (e.g. into a checkpoint), and
+  # without what it opened, which is opened again when it is unpickled. It is
+  # pickled along with how far its packfile or journal, and its caches, went,
+  # so that whatever was written after it can be told apart.
+  def __getstate__(self):
+    assert len(self.__pending_writes) == 0
+    assert len(self.__pending_patches) == 0
+
+    state = self.__dict__.copy()
+    state['_MetadataWriter__journal_offset'] = self.__get_journal_offset()
+    if self.__metadata_patch_length_cache is not None:
+      state['_MetadataWriter__cache_rowids'] = \
+                              (self.__metadata_patch_length_cache.last_rowid,
+                               self.__dirty_projects_cache.last_rowid)
+    for name in ('__packfile', '__journal_file', '__journal_lock',
+                 '__executor', '__write_slots', '__pending_writes',
+                 '__metadata_patch_length_cache', '__dirty_projects_cache',
+                 '__pool', '__max_pending_patches', '__pending_patches'):
+      del state['_MetadataWriter'+name]
+    return state
+
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.__open()
+
+
+  def flush(self):
+    '''Wait until all metadata released so far is on disk, and in the caches
+    of patch lengths and dirty projects.'''
+
+    self.__wait_for_writes()
+
+    if self.__metadata_patch_length_cache is not None:
+      self.__drain_patches()
+
+    if self.__packfile is not None:
+      self.__packfile.flush()
+
+
+  def flush_metadata(self, timestamp, unmark=True):
     assert timestamp > 0
 
     # projects subordinates
@@ -78,7 +650,14 @@ class MetadataWriter:
     #            self.projects_subordinates_metadata_json[projects_subordinate]
     #  self.write_json_to_disk(filename, metadata_version, metadata_json)
 
-    if len(self.repository.projects.dirty) > 0:
+    # This is the barrier between releases: the previous release must be
+    # written before this one is.
+    self.__wait_for_writes()
+
+    if self.repository.projects.number_of_dirty_projects > 0:
+      if self.__metadata_patch_length_cache is not None:
+        self.__record_patches(timestamp)
+
       # Write only dirty projects (i.e. with dirty metadata).
       for project_name in self.repository.projects.dirty:
         filename = 'packages/{}.json'.format(project_name)
@@ -87,8 +666,10 @@ class MetadataWriter:
         # django.json.
         metadata_identifier = self.project_metadata_identifier(project_name)
         metadata_json = self.project_developer_metadata_json[project_name]
-        self.write_json_to_disk(filename, metadata_identifier, metadata_json)
-        self.repository.projects.unmark_project_as_dirty(project_name)
+        self.__submit_write(self.write_json_to_disk, filename,
+                            metadata_identifier, metadata_json)
+        if unmark:
+          self.repository.projects.unmark_project_as_dirty(project_name)
 
       # projects administrator
       #self.write_json_to_disk('packages.json',
@@ -96,16 +677,37 @@ class MetadataWriter:
       #                        self.projects_administrator_metadata_json)
 
       # snapshot administrator
-      # NOTE: We identify every snapshot metadata file with the "current"
-      # timestamp, and not the version number of the snapshot metadata file.
-      self.write_json_to_disk('snapshot.json',
-                              timestamp,
-                              self.snapshot_administrator_metadata_json)
+      filename, snapshot_metadata_json = \
+                              self.__get_stored_snapshot_metadata(timestamp)
+      self.__submit_write(self.__write_snapshot_metadata,
+                          list(self.__pending_writes), filename, timestamp,
+                          snapshot_metadata_json)
 
     else:
       logging.debug('No dirty metadata to flush to disk.')
 
 
+  def close(self):
+    logging.info('Waiting for {:,} writes and {:,} patches...'\
+                 .format(len(self.__pending_writes),
+                         len(self.__pending_patches)))
+    self.flush()
+    logging.info('...done.')
+
+    self.__stop_writer_threads()
+    _OPEN_METADATA_WRITERS.discard(self)
+
+    if self.__metadata_patch_length_cache is not None:
+      _close_patch_pool()
+      self.__metadata_patch_length_cache.close()
+      self.__dirty_projects_cache.close()
+
+    if self.__packfile is not None:
+      self.__packfile.close()
+    else:
+      self.__journal_file.close()
+
+
   @classmethod
   def get_random_keyid(cls):
     return cls.get_random_hexstring(64)
@@ -139,38 +741,67 @@ class MetadataWriter:
     }
 
 
-  def jsonify(self, metadata, debug=True):
+  @staticmethod
+  def jsonify(metadata, debug=not COMPACT_METADATA):
     # the root json data type
     assert isinstance(metadata, dict)
 
     if debug:
-      indent = 1
-      separators = (', ', ': ')
-      sort_keys = True
+      return json.dumps(metadata, indent=1, separators=(', ', ': '),
+                        sort_keys=True).encode('utf-8')
     else:
-      indent = None
-      separators = (',', ':')
-      sort_keys = False
-
-    return json.dumps(metadata, indent=indent, separators=separators,
-                      sort_keys=sort_keys).encode('utf-8')
+      # NOTE: Only compact JSON may contain Fragments of JSON.
+      return canonicaljson.encode(metadata)
 
 
   def make_project_developer_metadata(self, timestamp):
     # Update only dirty projects (i.e. with dirty metadata).
-    for project_name in self.repository.projects.dirty:
+    project_names = self.repository.projects.dirty
+
+    # e.g. The initial release, where every project is dirty.
+    if MIN_DIRTY_PROJECTS_TO_PARALLELIZE is not None and \
+       len(project_names) >= MIN_DIRTY_PROJECTS_TO_PARALLELIZE:
+      project_developer_metadata = \
+        self.__make_project_developer_metadata_in_parallel(project_names,
+                                                           timestamp)
+    else:
+      project_developer_metadata = \
+        self.make_project_developer_metadata_slice(project_names, timestamp)
+
+    for project_name, metadata, metadata_json, metadata_sha256 \
+        in project_developer_metadata:
+      self.project_developer_metadata[project_name] = metadata
+      self.project_developer_metadata_json[project_name] = metadata_json
+      # Hash the new metadata only once, and reuse it until it is remade.
+      self.project_developer_metadata_sha256[project_name] = metadata_sha256
+
+
+  def make_project_developer_metadata_slice(self, project_names, timestamp):
+    '''Return the metadata of these projects, its JSON, and the SHA-256 of its
+    JSON, without keeping any of it.'''
+
+    project_developer_metadata = []
+
+    for project_name in project_names:
       keyids = self.repository.projects.get_keyids_for_project(project_name)
       targets = \
         self.repository.projects.get_targets_metadata_for_project(project_name)
       version = self.repository.projects.get_project_version(project_name)
 
-      self.project_developer_metadata[project_name] = \
-                                self.make_targets_metadata(keyids=keyids,
-                                                           targets=targets,
-                                                           timestamp=timestamp,
-                                                           version=version)
-      self.project_developer_metadata_json[project_name] = \
-                    self.jsonify(self.project_developer_metadata[project_name])
+      if COMPACT_METADATA:
+        # Encode every target only once, and reuse its JSON in every version
+        # of project metadata.
+        targets = self.__get_target_fragments(project_name, targets)
+
+      metadata = self.make_targets_metadata(keyids=keyids, targets=targets,
+                                            timestamp=timestamp,
+                                            version=version)
+      metadata_json = self.jsonify(metadata)
+      project_developer_metadata.append((project_name, metadata,
+                                         metadata_json,
+                                         self.get_sha256(metadata_json)))
+
+    return project_developer_metadata
 
 
   def make_projects_administrator_metadata(self):
@@ -231,13 +862,20 @@ class MetadataWriter:
         self.jsonify(self.projects_subordinates_metadata[projects_subordinate])
 
 
-  def make_release_metadata(self, keyids=(), meta={}, timestamp=0, version=0):
+  # NOTE: Pass the sorted relpaths of meta, if known, so that we need not sort
+  # them all over again on every release.
+  def make_release_metadata(self, keyids=(), meta={}, timestamp=0, version=0,
+                            meta_relpaths=None):
+    if meta_relpaths is None:
+      meta_relpaths = sorted(meta)
+    sig = self.__make_pseudo_signature(meta_relpaths, timestamp, version)
+
     return {
       'signatures': [
         {
           'keyid': keyid,
           'method': 'ed25519',
-          'sig': self.__make_pseudo_signature(meta, timestamp, version)
+          'sig': sig
         } for keyid in keyids
       ],
       'signed': {
@@ -250,8 +888,37 @@ class MetadataWriter:
     }
 
 
-  def make_snapshot_administrator_metadata(self, timestamp):
-    raise NotImplementedError()
+  def make_snapshot_administrator_metadata(self, timestamp, unmark=True):
+    if self.repository.projects.number_of_dirty_projects > 0:
+      self.update_snapshot_meta(unmark=unmark)
+
+      # Commit the snapshot metadata to memory.
+      keyids = self.repository.snapshot_administrator_keyids
+      version = self.repository.snapshot_administrator_version
+      meta_relpaths = self.__snapshot_meta_relpaths
+      self.snapshot_administrator_metadata = \
+            self.make_release_metadata(keyids=keyids, meta=self.snapshot_meta,
+                                       timestamp=timestamp, version=version,
+                                       meta_relpaths=meta_relpaths)
+
+      # Encode everything but signed.meta, and then splice in the entries of
+      # signed.meta, which were encoded only when they last changed.
+      signed = dict(self.snapshot_administrator_metadata['signed'],
+                    meta=self.SNAPSHOT_META_PLACEHOLDER)
+      snapshot_administrator_metadata_json = \
+            self.jsonify(dict(self.snapshot_administrator_metadata,
+                              signed=signed))
+      placeholder_json = json.dumps(self.SNAPSHOT_META_PLACEHOLDER)\
+                         .encode('utf-8')
+      assert snapshot_administrator_metadata_json.count(placeholder_json) == 1
+      snapshot_meta_json = self.__jsonify_snapshot_meta()
+      self.snapshot_administrator_metadata_json = \
+            snapshot_administrator_metadata_json.replace(placeholder_json,
+                                                         snapshot_meta_json)
+
+    else:
+      logging.debug('No new snapshot metadata, '\
+                    'because no new package metadata.')
 
 
   def make_targets_metadata(self, keyid_to_keyval={}, keyids=(),
@@ -262,7 +929,8 @@ class MetadataWriter:
         {
           'keyid': keyid,
           'method': 'ed25519',
-          'sig': self.__make_pseudo_signature(targets, timestamp, version)
+          'sig': self.__make_pseudo_signature(sorted(targets), timestamp,
+                                              version)
         } for keyid in keyids
       ],
       'signed': {
@@ -305,11 +973,18 @@ class MetadataWriter:
     raise NotImplementedError()
 
 
+  # Return the value of this project in signed.meta of snapshot metadata.
+  def snapshot_meta_entry(self, project_name):
+    raise NotImplementedError()
+
+
   def reset_metadata(self):
     # str_of_project_name: dict_of_targets_metadata
     self.project_developer_metadata = {}
     # str_of_project_name: json.dumps(dict_of_targets_metadata)
     self.project_developer_metadata_json = {}
+    # str_of_project_name: sha256(json.dumps(dict_of_targets_metadata))
+    self.project_developer_metadata_sha256 = {}
 
     # dict_of_targets_metadata
     self.projects_administrator_metadata = {}
@@ -322,12 +997,40 @@ class MetadataWriter:
     # str_of_role_name: json.dumps(dict_of_targets_metadata)
     self.projects_subordinates_metadata_json = {}
 
+    # (str (target relpath), str (sha256), int (length)): Fragment (JSON of
+    # the target metadata)
+    self.__target_fragments = canonicaljson.FragmentCache()
+    # str (project name): {(str (target relpath), str (sha256), int (length))}
+    # (the keys of the Fragments of the targets of every project)
+    self.__project_target_fragment_keys = {}
+
+    # str (project metadata relpath): snapshot_meta_entry (e.g. sha256)
+    # NOTE: signed.meta of snapshot metadata is kept between releases, and
+    # updated only for dirty or removed projects.
+    self.snapshot_meta = {}
+    # str (project metadata relpath): snapshot_meta_entry (only the entries
+    # added or changed by the last snapshot metadata)
+    self.snapshot_meta_changes = {}
+    # [str (project metadata relpath)] (only the entries removed by the last
+    # snapshot metadata)
+    self.snapshot_meta_removals = []
+    # str (project metadata relpath): bytes (JSON of the entry in signed.meta)
+    self.__snapshot_meta_json = {}
+    # [str (project metadata relpath)] (sorted)
+    self.__snapshot_meta_relpaths = []
+
     # dict_of_snapshot_metadata
     self.snapshot_administrator_metadata = {}
     # json.dumps(dict_of_snapshot_metadata)
     self.snapshot_administrator_metadata_json = \
                   self.jsonify(self.snapshot_administrator_metadata)
 
+    # The relpath of the last stored snapshot metadata, and everything in it
+    # but signed.meta, which the next delta is made from.
+    self.__prev_snapshot_metadata = None
+    # Number of snapshot metadata stored as deltas since the last keyframe.
+    self.__number_of_snapshot_deltas = 0
+
 
   def rmdir(self, directory):
     try:
@@ -346,7 +1049,7 @@ class MetadataWriter:
     self.make_project_developer_metadata(timestamp)
 
     # TODO: best place to do this?
-    if len(self.repository.projects.dirty) > 0:
+    if self.repository.projects.number_of_dirty_projects > 0:
       self.repository.release()
 
     #logging.info('...done. Making projects administrator metadata...')
@@ -364,6 +1067,112 @@ class MetadataWriter:
     logging.info('...done.')
 
 
+  def share_project_developer_metadata(self, metadata_writer):
+    '''Use the project developer metadata that this other writer of the same
+    repository makes, instead of making it.'''
+
+    assert metadata_writer.repository is self.repository
+    self.project_developer_metadata = \
+                                  metadata_writer.project_developer_metadata
+    self.project_developer_metadata_json = \
+                              metadata_writer.project_developer_metadata_json
+    self.project_developer_metadata_sha256 = \
+                            metadata_writer.project_developer_metadata_sha256
+
+
+  def update_snapshot_meta(self, unmark=True):
+    projects = self.repository.projects
+    self.snapshot_meta_changes = {}
+    self.snapshot_meta_removals = []
+
+    for project_name in projects.removed:
+      self.__discard_target_fragments(project_name)
+
+      # TODO: Really should not be hardcoding file paths. Instead, each
+      # metadata object should know where it lives on disk.
+      project_metadata_relpath = 'packages/{}.json'.format(project_name)
+
+      if project_metadata_relpath in self.snapshot_meta:
+        del self.snapshot_meta[project_metadata_relpath]
+        del self.__snapshot_meta_json[project_metadata_relpath]
+        self.snapshot_meta_removals.append(project_metadata_relpath)
+        i = bisect.bisect_left(self.__snapshot_meta_relpaths,
+                               project_metadata_relpath)
+        del self.__snapshot_meta_relpaths[i]
+
+      if unmark:
+        projects.unmark_project_as_removed(project_name)
+
+    for project_name in projects.dirty:
+      project_metadata_relpath = 'packages/{}.json'.format(project_name)
+      entry = self.snapshot_meta_entry(project_name)
+
+      if project_metadata_relpath not in self.snapshot_meta:
+        bisect.insort(self.__snapshot_meta_relpaths, project_metadata_relpath)
+      elif self.snapshot_meta[project_metadata_relpath] == entry:
+        continue
+
+      self.snapshot_meta[project_metadata_relpath] = entry
+      self.snapshot_meta_changes[project_metadata_relpath] = entry
+      self.__snapshot_meta_json[project_metadata_relpath] = \
+                  self.__jsonify_snapshot_meta_entry(project_metadata_relpath)
+
+
+  def rewind(self):
+    '''Delete every version of metadata, and every entry in the caches of
+    patch lengths and dirty projects, that was written after this writer was
+    checkpointed, so that it resumes right from the checkpoint. Also delete
+    whatever was derived from metadata or projects, so that nothing stale
+    outlives them.'''
+
+    assert self.__journal_offset is not None
+
+    if self.__packfile is not None:
+      metadata_relpaths = self.__packfile.truncate(self.__journal_offset)
+
+    else:
+      with self.__journal_lock:
+        self.__journal_file.flush()
+        with open(self.__journal_file.name, 'rb') as journal_file:
+          journal_file.seek(self.__journal_offset)
+          metadata_relpaths = journal_file.read().decode('utf-8').splitlines()
+
+        for metadata_relpath in metadata_relpaths:
+          metadata_abspath = os.path.join(self.metadata_directory,
+                                          metadata_relpath)
+          # NOTE: A crash may have come before the file was written.
+          if os.path.exists(metadata_abspath):
+            os.remove(metadata_abspath)
+            logging.debug('D {}'.format(metadata_abspath))
+
+        self.__journal_file.truncate(self.__journal_offset)
+
+    # NOTE: Entries stored later may be wrong even about metadata written
+    # earlier (e.g. a project whose version number was reused).
+    if self.__metadata_patch_length_cache is not None:
+      metadata_patch_length_cache_rowid, dirty_projects_cache_rowid = \
+                                                            self.__cache_rowids
+      self.__metadata_patch_length_cache.truncate(
+                                            metadata_patch_length_cache_rowid)
+      self.__dirty_projects_cache.truncate(dirty_projects_cache_rowid)
+
+    # NOTE: Readers would otherwise look up snapshots, and thus project
+    # metadata, that were just deleted.
+    derived_filepaths = [os.path.join(self.metadata_directory,
+                                      SNAPSHOT_INDEX_FILENAME)]
+    if REVERSED_PROJECTS_FILEPATH is not None:
+      derived_filepaths += glob.glob(REVERSED_PROJECTS_FILEPATH.format('*'))
+
+    for derived_filepath in derived_filepaths:
+      if os.path.exists(derived_filepath):
+        os.remove(derived_filepath)
+        logging.info('D {}'.format(derived_filepath))
+
+    logging.info('Rewound {:,} versions of metadata in {}'\
+                 .format(len(metadata_relpaths), self.metadata_directory))
+    self.__journal_offset = self.__cache_rowids = None
+
+
   def write_json_to_disk(self, metadata_path, metadata_version, metadata_json,
                          overwrite=False):
     assert not metadata_path.startswith(self.metadata_directory)
@@ -371,55 +1180,419 @@ class MetadataWriter:
       assert metadata_version > 0
     assert isinstance(metadata_json, bytes)
 
-    metadata_path = os.path.join(self.metadata_directory, metadata_path)
     dirname, basename = os.path.split(metadata_path)
-    self.mkdir(dirname)
-
     assert basename.endswith('.json')
     basename = '{}.{}.json'.format(basename[:-5], metadata_version)
-
     metadata_path = os.path.join(dirname, basename)
 
-    if not os.path.exists(metadata_path) or overwrite:
-      with open(metadata_path, 'wt') as metadata_file:
-        metadata_file.write(metadata_json.decode('utf-8'))
-      logging.debug('W {}'.format(metadata_path))
+    # NOTE: The packfile knows what it has, without asking the file system.
+    if self.__packfile is not None:
+      if metadata_path not in self.__packfile or overwrite:
+        self.__packfile.append(metadata_path, metadata_json)
+        logging.debug('A {}'.format(metadata_path))
 
+    else:
+      metadata_relpath = metadata_path
+      metadata_path = os.path.join(self.metadata_directory, metadata_path)
+      self.mkdir(os.path.dirname(metadata_path))
 
-def write(log_filename, dirty_projects_cache_filepath,
-          metadata_patch_length_cache_filepath, RepositoryClass,
-          MetadataWriterClass, metadata_directory):
-  logging.basicConfig(filename=log_filename, level=logging.DEBUG, filemode='w',
-                      format=LOG_FORMAT)
+      if not os.path.exists(metadata_path) or overwrite:
+        self.__note_in_journal(metadata_relpath)
+        # Write to a temporary file, so that a crash never leaves a partial
+        # file behind.
+        tmp_metadata_path = '{}.{}.tmp'.format(metadata_path, os.getpid())
+        with open(tmp_metadata_path, 'wb') as metadata_file:
+          metadata_file.write(metadata_json)
+        os.replace(tmp_metadata_path, metadata_path)
+        logging.debug('W {}'.format(metadata_path))
+
+
+class MetadataWriters:
+
+
+  '''
+  A fan-out of writers of the same repository (e.g. TUF, Mercury and
+  Mercury-nohash), which releases all of them from a single replay of the
+  change log.
+
+  Project developer metadata is the same for all of them, so only the first
+  writer makes it, and the others share it. Every writer still makes, writes
+  and caches its own snapshot metadata. Projects are unmarked as dirty or
+  removed only after every writer has released them.
+  '''
+
+
+  def __init__(self, repository, metadata_writers, metadata_directory):
+    assert len(metadata_writers) > 0
+
+    self.repository = repository
+    self.metadata_writers = metadata_writers
+    # Where checkpoints of all writers are saved.
+    self.metadata_directory = metadata_directory
+
+    for metadata_writer in self.metadata_writers[1:]:
+      metadata_writer.share_project_developer_metadata(self.metadata_writers[0])
+
+
+  def close(self):
+    for metadata_writer in self.metadata_writers:
+      metadata_writer.close()
+
+
+  def flush(self):
+    for metadata_writer in self.metadata_writers:
+      metadata_writer.flush()
+
+
+  def rewind(self):
+    for metadata_writer in self.metadata_writers:
+      metadata_writer.rewind()
+
+
+  def release(self, timestamp):
+    assert timestamp > 0
+    projects = self.repository.projects
+
+    logging.info('Making project developer metadata...')
+    self.metadata_writers[0].make_project_developer_metadata(timestamp)
+
+    # Release the repository only once for all writers.
+    released = projects.number_of_dirty_projects > 0
+    if released:
+      self.repository.release()
+
+    for metadata_writer in self.metadata_writers:
+      logging.info('...done. Making snapshot administrator metadata in '\
+                   '{}...'.format(metadata_writer.metadata_directory))
+      metadata_writer.make_snapshot_administrator_metadata(timestamp,
+                                                           unmark=False)
+
+      logging.info('...done. Flushing all metadata...')
+      metadata_writer.flush_metadata(timestamp, unmark=False)
+
+    # Like a single writer, keep removed projects marked until a release
+    # with dirty projects drops them from the snapshot metadata.
+    if released:
+      for project_name in projects.dirty:
+        projects.unmark_project_as_dirty(project_name)
+      for project_name in projects.removed:
+        projects.unmark_project_as_removed(project_name)
+
+    logging.info('...done.')
+
+
+# Close the pool of processes that measure patches, once the last writer that
+# uses it is closed.
+def _close_patch_pool():
+  global _NUMBER_OF_PATCH_POOL_USERS, _PATCH_POOL
+
+  assert _NUMBER_OF_PATCH_POOL_USERS > 0
+  _NUMBER_OF_PATCH_POOL_USERS -= 1
+
+  if _NUMBER_OF_PATCH_POOL_USERS == 0:
+    _PATCH_POOL.close()
+    _PATCH_POOL.join()
+    _PATCH_POOL = None
 
-  try:
-    if os.path.isfile(dirty_projects_cache_filepath):
-      os.remove(dirty_projects_cache_filepath)
-    if os.path.isfile(metadata_patch_length_cache_filepath):
-      os.remove(metadata_patch_length_cache_filepath)
 
+# Return the filepath of every checkpoint in this metadata directory, by the
+# timestamp of its last release.
+def _get_checkpoint_filepaths(metadata_directory):
+  checkpoint_filepaths = {}
+
+  for checkpoint_filepath in \
+      glob.glob(os.path.join(metadata_directory, CHECKPOINT_DIRECTORY_NAME,
+                             'checkpoint.*.pickle')):
+    timestamp = int(os.path.basename(checkpoint_filepath).split('.')[1])
+    checkpoint_filepaths[timestamp] = checkpoint_filepath
+
+  return checkpoint_filepaths
+
+
+def _get_patch_length(key, prev_metadata_json, curr_metadata_json):
+  # Either parse the previous metadata, if any, or start from scratch.
+  if prev_metadata_json:
+    prev_metadata = json.loads(prev_metadata_json.decode('utf-8'))
+  else:
+    prev_metadata = {}
+
+  curr_metadata = json.loads(curr_metadata_json.decode('utf-8'))
+  return _measure_patch(key, prev_metadata, curr_metadata)
+
+
+# Make a writer of this class from scratch, along with its caches and
+# packfile, as configured.
+def _make_metadata_writer(MetadataWriterClass, repository, metadata_directory,
+                          metadata_patch_length_cache_filepath,
+                          dirty_projects_cache_filepath):
+  # New metadata invalidates every patch length and dirty project computed
+  # from the old metadata.
+  PersistentCache.remove(dirty_projects_cache_filepath)
+  PersistentCache.remove(metadata_patch_length_cache_filepath)
+
+  if PACK_METADATA:
+    packfile_filepath = os.path.join(metadata_directory, PACKFILE_FILENAME)
+  else:
+    packfile_filepath = None
+
+  if PRECOMPUTE_METADATA_CACHES:
+    return MetadataWriterClass(repository, metadata_directory,
+          metadata_patch_length_cache_filepath=\
+                                          metadata_patch_length_cache_filepath,
+          dirty_projects_cache_filepath=dirty_projects_cache_filepath,
+          packfile_filepath=packfile_filepath)
+  else:
+    return MetadataWriterClass(repository, metadata_directory,
+                               packfile_filepath=packfile_filepath)
+
+
+def _make_project_developer_metadata_slice(args):
+  project_names, timestamp = args
+  return _FORKED_METADATA_WRITER\
+         .make_project_developer_metadata_slice(project_names, timestamp)
+
+
+def _measure_patch(key, prev_metadata, curr_metadata):
+  patch = metadatadiff.make_patch(prev_metadata, curr_metadata)
+  return key, metadatadiff.get_patch_length(patch)
+
+
+# Return the pool of processes that measure patches, which every writer shares
+# instead of starting its own (e.g. three of them in write_all).
+# NOTE: The first writer starts it before it starts any thread, so that forked
+# workers never inherit locks that threads hold.
+def _open_patch_pool():
+  global _NUMBER_OF_PATCH_POOL_USERS, _PATCH_POOL
+
+  if _PATCH_POOL is None:
+    number_of_workers = os.cpu_count() or 1
+    _PATCH_POOL = multiprocessing.get_context('fork').Pool(number_of_workers)
+
+  _NUMBER_OF_PATCH_POOL_USERS += 1
+  return _PATCH_POOL
+
+
+def _release(metadata_writer, first_change_timestamp, timestamp,
+             checkpoint_timestamp):
+  logging.info('Release changes from timestamp {} to {}'\
+               .format(first_change_timestamp, timestamp))
+  metadata_writer.release(timestamp)
+
+  if CHECKPOINT_INTERVAL_IN_SECONDS is not None and \
+     timestamp-checkpoint_timestamp >= CHECKPOINT_INTERVAL_IN_SECONDS:
+    save_checkpoint(metadata_writer, timestamp)
+    checkpoint_timestamp = timestamp
+
+  # Return the timestamp of the latest checkpoint.
+  return checkpoint_timestamp
+
+
+# Replay the changelog into the writer that make_metadata_writer makes for a
+# new repository, unless it resumes from a checkpoint.
+def _replay(log_filename, RepositoryClass, make_metadata_writer,
+            metadata_directory, resume_from, release_policy):
+  if release_policy is None:
+    release_policy = ReleasePolicy()
+
+  logging.basicConfig(filename=log_filename, level=logging.DEBUG,
+                      filemode='a' if resume_from else 'w', format=LOG_FORMAT)
+
+  try:
     changelog_reader = ChangeLogReader()
     changelog_reader.read()
 
-    repository = RepositoryClass(changelog_reader)
+    if resume_from == LATEST_CHECKPOINT:
+      resume_from = get_latest_checkpoint_filepath(metadata_directory)
+
+    if resume_from:
+      prev_timestamp, metadata_writer = load_checkpoint(resume_from)
+      repository = metadata_writer.repository
+      logging.info('Resume from timestamp {}'.format(prev_timestamp))
+
+      # Later checkpoints would resume from what is about to be deleted.
+      for timestamp, checkpoint_filepath in \
+          _get_checkpoint_filepaths(metadata_writer.metadata_directory)\
+                                                                  .items():
+        if timestamp > prev_timestamp:
+          os.remove(checkpoint_filepath)
+          logging.info('D {}'.format(checkpoint_filepath))
+      # Delete whatever was written after the checkpoint, which a different
+      # release policy, for one, would not write again.
+      metadata_writer.rewind()
 
-    metadata_writer = MetadataWriterClass(repository, metadata_directory)
-    # The initial timestamp is right before the midnight of March 21 2014, the
-    # day the log starts.
-    prev_timestamp = unix_timestamp(2014, 3, 21)-1
-    metadata_writer.release(prev_timestamp)
+    else:
+      repository = RepositoryClass(changelog_reader)
+      metadata_writer = make_metadata_writer(repository)
+      # The initial timestamp is right before the midnight of March 21 2014,
+      # the day the log starts.
+      prev_timestamp = unix_timestamp(2014, 3, 21)-1
+      metadata_writer.release(prev_timestamp)
+      # The initial release alone takes a long time.
+      save_checkpoint(metadata_writer, prev_timestamp)
+
+    resume_timestamp = checkpoint_timestamp = prev_timestamp
+    logging.info('Release with {}'.format(release_policy))
+    # The timestamp of the oldest change buffered in the repository, if any.
+    # NOTE: Checkpoints are saved only right after releases, so there is never
+    # any buffered change to resume.
+    first_change_timestamp = None
 
     # Instead of writing a snapshot every few minutes, just write a snapshot
-    # whenever something actually changes.  Also, batch updates by timestamp.
+    # whenever something actually changes.  Also, batch updates by timestamp,
+    # and then by the release policy.
     for curr_timestamp, changes in changelog_reader.aggregate().items():
+      # Skip whatever was replayed before the checkpoint.
+      if curr_timestamp <= resume_timestamp:
+        continue
+
       assert prev_timestamp < curr_timestamp
+
+      # Release the buffered changes, if their deadline passed before these
+      # changes.
+      if first_change_timestamp is not None:
+        deadline = release_policy.get_deadline(first_change_timestamp)
+        if deadline is not None and deadline < curr_timestamp:
+          checkpoint_timestamp = _release(metadata_writer,
+                                          first_change_timestamp, deadline,
+                                          checkpoint_timestamp)
+          first_change_timestamp = None
+
       for change in changes:
         logging.info('Change {} at timestamp {}'.format(change,
                                                         curr_timestamp))
         repository.update(change)
-      metadata_writer.release(curr_timestamp)
       prev_timestamp = curr_timestamp
 
+      if first_change_timestamp is None:
+        first_change_timestamp = curr_timestamp
+
+      deadline = release_policy.get_deadline(first_change_timestamp)
+      if (deadline is not None and deadline <= curr_timestamp) or \
+         release_policy.is_full(repository):
+        checkpoint_timestamp = _release(metadata_writer,
+                                        first_change_timestamp, curr_timestamp,
+                                        checkpoint_timestamp)
+        first_change_timestamp = None
+
+    # Release whatever is still buffered at the end of the changelog.
+    if first_change_timestamp is not None:
+      _release(metadata_writer, first_change_timestamp, prev_timestamp,
+               checkpoint_timestamp)
+
+    metadata_writer.close()
+
   except:
     logging.exception('WHAM!')
     raise
+
+
+def get_latest_checkpoint_filepath(metadata_directory):
+  '''Return the filepath of the latest checkpoint of the writer of this
+  metadata directory, or None if there is none.'''
+
+  checkpoint_filepaths = _get_checkpoint_filepaths(metadata_directory)
+
+  if len(checkpoint_filepaths) == 0:
+    return None
+  else:
+    # Sort by timestamp, and not by string.
+    return checkpoint_filepaths[max(checkpoint_filepaths)]
+
+
+def load_checkpoint(checkpoint_filepath):
+  '''Return the timestamp of the last release in this checkpoint, and the
+  writer, along with its repository, right after that release.'''
+
+  with open(checkpoint_filepath, 'rb') as checkpoint_file:
+    timestamp, metadata_writer = pickle.load(checkpoint_file)
+
+  logging.info('R {}'.format(checkpoint_filepath))
+  return timestamp, metadata_writer
+
+
+def save_checkpoint(metadata_writer, timestamp):
+  '''Save the writer, along with its repository, right after the release at
+  this timestamp, into the metadata directory of the writer.'''
+
+  # Everything up to this release must be on disk before the checkpoint is.
+  metadata_writer.flush()
+
+  checkpoint_directory = os.path.join(metadata_writer.metadata_directory,
+                                      CHECKPOINT_DIRECTORY_NAME)
+  os.makedirs(checkpoint_directory, exist_ok=True)
+  checkpoint_filepath = os.path.join(checkpoint_directory,
+                                     'checkpoint.{}.pickle'.format(timestamp))
+
+  # Write to a temporary file, so that a crash never leaves a partial
+  # checkpoint behind.
+  tmp_checkpoint_filepath = checkpoint_filepath+'.tmp'
+  with open(tmp_checkpoint_filepath, 'wb') as checkpoint_file:
+    pickle.dump((timestamp, metadata_writer), checkpoint_file,
+                protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_checkpoint_filepath, checkpoint_filepath)
+  logging.info('W {}'.format(checkpoint_filepath))
+
+  # Keep the checkpoint of the initial release, and only the latest others.
+  if NUMBER_OF_CHECKPOINTS_TO_KEEP is not None:
+    checkpoint_filepaths = \
+            _get_checkpoint_filepaths(metadata_writer.metadata_directory)
+    timestamps = sorted(checkpoint_filepaths)
+    for timestamp in timestamps[1:-NUMBER_OF_CHECKPOINTS_TO_KEEP or None]:
+      os.remove(checkpoint_filepaths[timestamp])
+      logging.info('D {}'.format(checkpoint_filepaths[timestamp]))
+
+
+def write(log_filename, dirty_projects_cache_filepath,
+          metadata_patch_length_cache_filepath, RepositoryClass,
+          MetadataWriterClass, metadata_directory, resume_from=None,
+          release_policy=None):
+  '''Replay the changelog, and write the metadata of every release, which the
+  release policy (by default, ReleasePolicy()) decides.
+
+  If resume_from is LATEST_CHECKPOINT, resume from the latest checkpoint in
+  the metadata directory, if there is one. If it is the filepath of a
+  checkpoint, resume from that checkpoint instead (e.g. to try a different
+  release policy without replaying everything before it). Either way, the
+  metadata, cache entries and checkpoints written after the checkpoint are
+  deleted first, and the rest are kept.'''
+
+  def make_metadata_writer(repository):
+    return _make_metadata_writer(MetadataWriterClass, repository,
+                                 metadata_directory,
+                                 metadata_patch_length_cache_filepath,
+                                 dirty_projects_cache_filepath)
+
+  _replay(log_filename, RepositoryClass, make_metadata_writer,
+          metadata_directory, resume_from, release_policy)
+
+
+def write_all(log_filename, RepositoryClass, schemes, metadata_directory,
+              resume_from=None, release_policy=None):
+  '''Replay the changelog only once for every scheme, i.e. (writer class,
+  metadata directory, metadata patch length cache filepath, dirty projects
+  cache filepath), and write the metadata of every scheme into the same
+  directories and caches as its own write-*.py script would.
+
+  Checkpoints of all writers are saved together into this metadata directory,
+  which resume_from refers to just as it does for write().'''
+
+  def make_metadata_writers(repository):
+    # Checkpoints of previous writers would resume from the wrong metadata.
+    shutil.rmtree(os.path.join(metadata_directory, CHECKPOINT_DIRECTORY_NAME),
+                  ignore_errors=True)
+
+    metadata_writers = []
+
+    for MetadataWriterClass, scheme_metadata_directory, \
+        metadata_patch_length_cache_filepath, dirty_projects_cache_filepath \
+        in schemes:
+      metadata_writers.append(
+                  _make_metadata_writer(MetadataWriterClass, repository,
+                                        scheme_metadata_directory,
+                                        metadata_patch_length_cache_filepath,
+                                        dirty_projects_cache_filepath))
+
+    return MetadataWriters(repository, metadata_writers, metadata_directory)
+
+  _replay(log_filename, RepositoryClass, make_metadata_writers,
+          metadata_directory, resume_from, release_policy)
@@ -0,0 +1,341 @@
+'''
+A module to index the packages of every project on a PyPI mirror in a single
+walk of its packages directory, instead of globbing for the packages of every
+project one after another.
+
+The packages directory has this layout:
+
+  <pyversion>/<first letter of project>/<project>/<package>
+
+so the packages of a project may be under any pyversion. Like glob, the walk
+skips any name that starts with a dot.
+
+The index may be saved to a manifest, so that later runs load it instead of
+walking the mirror again, or even run without the mirror. Refreshing the
+index lists directories again, but only lists the packages of project
+directories whose mtime changed, which is whenever a package was added to or
+removed from them. Loading a manifest refreshes it only if asked to, or if
+its shallow fingerprint no longer matches the mirror: the mtimes of the simple
+directory and of the directories above project directories, which change
+whenever a project directory is added or removed.
+'''
+
+
+# 1st-party
+import concurrent.futures
+import hashlib
+import logging
+import os
+import pickle
+
+
+# 2nd-party
+import nouns
+
+
+# Bump whenever the layout of manifests changes.
+MANIFEST_VERSION = 3
+
+
+# Return the SHA-256 hex digest of the mtimes of the simple directory, and of
+# the pyversion and letter directories of the packages directory, which is
+# cheap enough to compute whenever a manifest is loaded.
+def _get_shallow_fingerprint(packages_directory, simple_directory):
+  fingerprint = hashlib.sha256()
+  fingerprint.update('{} {}\n'.format(simple_directory,
+                                      os.stat(simple_directory).st_mtime_ns)\
+                     .encode('utf-8'))
+
+  for pyversion_entry in sorted(_scan_directory(packages_directory),
+                                key=lambda entry: entry.name):
+    for entry in [pyversion_entry]+\
+                 sorted(_scan_directory(pyversion_entry.path),
+                        key=lambda entry: entry.name):
+      fingerprint.update('{} {}\n'.format(entry.path, entry.stat().st_mtime_ns)\
+                         .encode('utf-8'))
+
+  return fingerprint.hexdigest()
+
+
+# Return the entries of this directory that glob would match with '*'.
+def _scan_directory(directory, directories_only=True):
+  with os.scandir(directory) as entries:
+    return [entry for entry in entries \
+            if not entry.name.startswith('.') and \
+               (not directories_only or entry.is_dir())]
+
+
+# Return the packages of this project directory.
+def _scan_project_directory(project_directory):
+  # str (filename): (int (length), bytes[32] (SHA-256 digest))
+  packages = {}
+
+  for package_entry in _scan_directory(project_directory,
+                                       directories_only=False):
+    # NOTE: Follows symlinks, like os.path.getsize.
+    packages[package_entry.name] = (package_entry.stat().st_size,
+                                    get_package_digest(package_entry.path))
+
+  return packages
+
+
+class Mirror:
+
+
+  '''
+  An index of the packages of every project on a mirror, along with their
+  lengths and digests, and of the project names of its simple directory.
+  '''
+
+
+  def __init__(self, packages_directory=nouns.PACKAGES_DIRECTORY,
+               simple_directory=nouns.SIMPLE_DIRECTORY,
+               number_of_threads=nouns.NUMBER_OF_MIRROR_SCANNER_THREADS):
+    self.__packages_directory = packages_directory
+    self.__simple_directory = simple_directory
+
+    # [str] (sorted project names)
+    self.__project_names = []
+    # str (project name):
+    #   {str (relpath of project directory):
+    #     (int (mtime in ns),
+    #      {str (filename): (int (length), bytes[32] (SHA-256 digest))})}
+    self.__project_to_directories = {}
+    # str (see _get_shallow_fingerprint), as of the last refresh
+    self.__shallow_fingerprint = None
+
+    self.refresh(number_of_threads=number_of_threads)
+
+
+  # Return every project directory under this pyversion directory, along
+  # with its packages, unless its mtime did not change.
+  def __scan_pyversion_directory(self, pyversion_entry):
+    project_directories = []
+    number_of_scanned_directories = 0
+
+    for letter_entry in _scan_directory(pyversion_entry.path):
+      for project_entry in _scan_directory(letter_entry.path):
+        relpath = os.path.join(pyversion_entry.name, letter_entry.name,
+                               project_entry.name)
+        mtime = project_entry.stat().st_mtime_ns
+        known_directory = \
+              self.__project_to_directories.get(project_entry.name, {})\
+                                           .get(relpath)
+
+        if known_directory is not None and known_directory[0] == mtime:
+          packages = None
+        else:
+          packages = _scan_project_directory(project_entry.path)
+          number_of_scanned_directories += 1
+
+        project_directories.append((project_entry.name, relpath, mtime,
+                                    packages))
+
+    logging.debug('Scanned {:,} of {:,} project directories in {}'\
+                  .format(number_of_scanned_directories,
+                          len(project_directories), pyversion_entry.path))
+    return project_directories
+
+
+  def __contains__(self, project_name):
+    return project_name in self.__project_to_directories
+
+
+  def __iter__(self):
+    return iter(self.__project_to_directories)
+
+
+  def __len__(self):
+    return len(self.__project_to_directories)
+
+
+  def get_packages(self, project_name):
+    '''Return the sorted packages of this project on the mirror, along with
+    their lengths and digests, or nothing if it has none.'''
+
+    packages = []
+
+    for relpath, (_, filename_to_package) in \
+        self.__project_to_directories.get(project_name, {}).items():
+      project_directory = os.path.join(self.__packages_directory, relpath)
+      for filename, (length, digest) in filename_to_package.items():
+        packages.append((os.path.join(project_directory, filename), length,
+                         digest))
+
+    return sorted(packages)
+
+
+  def get_fingerprint(self):
+    '''Return the SHA-256 hex digest of the project names and project
+    directories of this mirror, along with their mtimes, which changes
+    whenever a refresh finds that anything changed.'''
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update('{}\n'.format(self.__packages_directory)\
+                       .encode('utf-8'))
+
+    for project_name in self.__project_names:
+      fingerprint.update('{}\n'.format(project_name).encode('utf-8'))
+
+    for project_name in sorted(self.__project_to_directories):
+      directories = self.__project_to_directories[project_name]
+      for relpath in sorted(directories):
+        mtime = directories[relpath][0]
+        fingerprint.update('{} {}\n'.format(relpath, mtime).encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
+  def is_stale(self):
+    '''Return whether a project directory was added to or removed from the
+    mirror since the last refresh, without walking it.'''
+
+    return self.__shallow_fingerprint != \
+           _get_shallow_fingerprint(self.__packages_directory,
+                                    self.__simple_directory)
+
+
+  @classmethod
+  def load(cls, manifest_filepath):
+    '''Return the mirror saved to this manifest.'''
+
+    with open(manifest_filepath, 'rb') as manifest_file:
+      manifest = pickle.load(manifest_file)
+
+    version, packages_directory, simple_directory, shallow_fingerprint, \
+                            project_names, project_to_directories = manifest
+    assert version == MANIFEST_VERSION, version
+
+    mirror = cls.__new__(cls)
+    mirror.__packages_directory = packages_directory
+    mirror.__simple_directory = simple_directory
+    mirror.__shallow_fingerprint = shallow_fingerprint
+    mirror.__project_names = project_names
+    mirror.__project_to_directories = project_to_directories
+
+    logging.info('R {}'.format(manifest_filepath))
+    return mirror
+
+
+  @property
+  def packages_directory(self):
+    return self.__packages_directory
+
+
+  @property
+  def project_names(self):
+    return self.__project_names
+
+
+  def refresh(self,
+              number_of_threads=nouns.NUMBER_OF_MIRROR_SCANNER_THREADS):
+    '''Walk the mirror again, and return whether anything changed.'''
+
+    logging.debug('Scanning {}...'.format(self.__packages_directory))
+
+    # NOTE: Take it before walking, lest it miss changes made meanwhile.
+    shallow_fingerprint = _get_shallow_fingerprint(self.__packages_directory,
+                                                   self.__simple_directory)
+
+    # NOTE: Unlike packages, hidden projects are not skipped.
+    with os.scandir(self.__simple_directory) as entries:
+      project_names = sorted(entry.name for entry in entries \
+                             if entry.is_dir())
+    changed = project_names != self.__project_names
+
+    pyversion_entries = _scan_directory(self.__packages_directory)
+
+    # Walk every pyversion directory at once, because it is mostly waiting on
+    # the filesystem anyway.
+    if number_of_threads > 0:
+      with concurrent.futures.ThreadPoolExecutor(number_of_threads) \
+           as executor:
+        scans = list(executor.map(self.__scan_pyversion_directory,
+                                  pyversion_entries))
+    else:
+      scans = [self.__scan_pyversion_directory(pyversion_entry) \
+               for pyversion_entry in pyversion_entries]
+
+    project_to_directories = {}
+    number_of_directories = 0
+
+    for project_directories in scans:
+      for project_name, relpath, mtime, packages in project_directories:
+        if packages is None:
+          packages = self.__project_to_directories[project_name][relpath][1]
+        else:
+          changed = True
+
+        project_to_directories.setdefault(project_name, {})[relpath] = \
+                                                              (mtime, packages)
+        number_of_directories += 1
+
+    # Project directories may also have been removed.
+    changed = changed or number_of_directories != \
+              sum(len(directories) for directories in \
+                  self.__project_to_directories.values())
+
+    self.__project_names = project_names
+    self.__project_to_directories = project_to_directories
+    self.__shallow_fingerprint = shallow_fingerprint
+
+    logging.debug('...done: {:,} projects.'\
+                  .format(len(self.__project_to_directories)))
+    return changed
+
+
+  def save(self, manifest_filepath):
+    '''Save this mirror to this manifest.'''
+
+    manifest = (MANIFEST_VERSION, self.__packages_directory,
+                self.__simple_directory, self.__shallow_fingerprint,
+                self.__project_names, self.__project_to_directories)
+
+    # Write to a temporary file, so that a crash, or other writers saving the
+    # same manifest, never leave a partial manifest behind.
+    tmp_manifest_filepath = '{}.{}.tmp'.format(manifest_filepath, os.getpid())
+    with open(tmp_manifest_filepath, 'wb') as manifest_file:
+      pickle.dump(manifest, manifest_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_manifest_filepath, manifest_filepath)
+
+    logging.info('W {}'.format(manifest_filepath))
+
+
+# Return a *deterministic* "digest" for this package.
+# WARNING: Do *NOT* reuse this value anywhere else!
+def get_package_digest(package):
+  # Return the SHA-256 digest of the package path.
+  return hashlib.sha256(package.encode('utf-8')).digest()
+
+
+def get_mirror(manifest_filepath=nouns.MIRROR_MANIFEST_FILEPATH,
+               refresh=nouns.REFRESH_MIRROR_MANIFEST):
+  '''Return the mirror saved to this manifest, refreshed if asked to or if it
+  is stale, or walk the mirror and save it to this manifest, if there is none
+  yet. Without a manifest, always walk the mirror.'''
+
+  if manifest_filepath is None:
+    return Mirror()
+
+  elif os.path.exists(manifest_filepath):
+    mirror = Mirror.load(manifest_filepath)
+
+    # Machines without the mirror use the manifest as it is.
+    if os.path.isdir(mirror.packages_directory):
+      is_stale = mirror.is_stale()
+
+      if refresh or is_stale:
+        # NOTE: Save it even if no package changed, lest it look stale again.
+        if mirror.refresh() or is_stale:
+          mirror.save(manifest_filepath)
+
+    elif refresh:
+      logging.warning('Could not refresh {} without {}'\
+                      .format(manifest_filepath, mirror.packages_directory))
+
+    return mirror
+
+  else:
+    mirror = Mirror()
+    mirror.save(manifest_filepath)
+    return mirror
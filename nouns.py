@@ -13,12 +13,30 @@ LOG_FORMAT = '[%(asctime)s UTC] [%(levelname)s] '\
 PYPI_DIRECTORY = '/var/pypi.python.org/web'
 SIMPLE_DIRECTORY = os.path.join(PYPI_DIRECTORY, 'simple')
 PACKAGES_DIRECTORY = os.path.join(PYPI_DIRECTORY, 'packages')
+# Number of threads that walk the pyversion directories of the packages
+# directory at once. Use 0 to walk them one after another.
+NUMBER_OF_MIRROR_SCANNER_THREADS = 8
 
 EXPERIMENTS_OUTPUT_DIRECTORY = '/var/experiments-output/'
 REQUESTS_FILENAME = os.path.join(EXPERIMENTS_OUTPUT_DIRECTORY,
                                  'simple/sorted.mercury.log.new')
 METADATA_DIRECTORY = os.path.join(EXPERIMENTS_OUTPUT_DIRECTORY, 'metadata')
 
+# Writers load the packages of every project on the mirror from this manifest,
+# instead of walking the mirror, and refresh it only if asked to, or if a
+# project directory was added or removed since, and only if the mirror is
+# there. Use None to always walk the mirror. Set REFRESH_MIRROR_MANIFEST to
+# True to pick up packages added to or removed from existing projects, too.
+MIRROR_MANIFEST_FILEPATH = os.path.join(METADATA_DIRECTORY, 'mirror.manifest')
+REFRESH_MIRROR_MANIFEST = False
+
+# Writers save the projects of the mirror, as they were right before the
+# change log, to this file, named after the fingerprint of both the mirror and
+# the change log, so that later writers load them instead of reversing the
+# change log again. Use None to always reverse the change log.
+REVERSED_PROJECTS_FILEPATH = os.path.join(METADATA_DIRECTORY,
+                                          'reversed-projects.{}.pickle')
+
 # Frequency f > 0 of project creation or update.
 # Set f < 1 to speed up snapshots, f=1 to run them in realtime, and f > 1 to
 # slow them down.
@@ -30,11 +48,98 @@ FREQUENCY_OF_PROJECT_CREATION_OR_UPDATE = 2**0
 #TIME_LIMIT_IN_SECONDS = 1655
 TIME_LIMIT_IN_SECONDS = None
 
+# Budget of the in-memory cache of metadata for every metadata directory,
+# measured in bytes of JSON on disk. The least recently used metadata is
+# evicted beyond it. NOTE: Decoded JSON takes several times as much RAM.
+METADATA_CACHE_SIZE_IN_BYTES = 2**30
+
+# Amount of time between writes of the running totals of package costs, which
+# must evenly divide a day. Set it to an hour or a minute for finer cost curves.
+# Either way, the daily totals are summarized from these at the end.
+RESULTS_INTERVAL_IN_SECONDS = 24*60*60
+
+# Whether writers should also fill the caches of metadata patch lengths and
+# dirty projects, so that readers do not have to compute them: from the
+# previous and from no project metadata, and from the initial snapshot
+# metadata, to every new one. NOTE: Patches to TUF-version project metadata
+# (i.e. *.json.version) are left to readers.
+PRECOMPUTE_METADATA_CACHES = False
+
+# Whether writers should write metadata as compact canonical JSON, instead of
+# indented JSON that is easier to debug. NOTE: This changes every metadata
+# length, and thus every cost.
+COMPACT_METADATA = False
+
+# Number of processes among which to shard users when replaying package
+# requests. Use 1 to replay every user in a single process.
+NUMBER_OF_SHARDS = 1
+
+# Binary index of snapshot metadata, written into every metadata directory by
+# index-snapshot-metadata.py, which readers use instead of snapshot metadata
+# files, if it exists.
+SNAPSHOT_INDEX_FILENAME = 'snapshot.index'
+
+# Whether writers should append every version of metadata to a single
+# packfile in every metadata directory, instead of writing it to its own file.
+# Readers use the packfile instead of metadata files, if it exists, and
+# export-packfile-metadata.py writes the files from the packfile, if need be.
+PACK_METADATA = False
+PACKFILE_FILENAME = 'metadata.pack'
+
+# Writers without packfiles note the relpath of every file in this journal of
+# their metadata directory before they write the file, so that they can delete
+# whatever was written after the checkpoint they resume from.
+JOURNAL_FILENAME = 'metadata.journal'
+
+# Number of threads that write the metadata of a release to disk, while the
+# next release is made. Use 0 to write metadata before making the next release.
+NUMBER_OF_WRITER_THREADS = 8
+
+# Minimum number of dirty projects whose metadata writers make in worker
+# processes, instead of one after another (e.g. in the initial release, where
+# every project is dirty). Use None to never make it in worker processes.
+MIN_DIRTY_PROJECTS_TO_PARALLELIZE = 10000
+
+# Writers store snapshot metadata in full only every this many releases, and
+# otherwise only as a delta from the previous snapshot metadata, which readers
+# rebuild on demand. Use None to store all snapshot metadata in full.
+SNAPSHOT_KEYFRAME_INTERVAL = None
+
+# Writers save a checkpoint of their state and that of their repository into
+# this directory of their metadata directory, after the initial release and
+# then at least this many seconds of the changelog apart, so that they can
+# resume from it. Use None to save only the checkpoint of the initial release.
+# Every checkpoint holds all of the metadata in memory, so only the checkpoint
+# of the initial release, which takes the longest to make, and this many of
+# the latest checkpoints are kept. Use None to keep every checkpoint.
+CHECKPOINT_DIRECTORY_NAME = 'checkpoints'
+CHECKPOINT_INTERVAL_IN_SECONDS = 24*60*60
+NUMBER_OF_CHECKPOINTS_TO_KEEP = 2
+
+# Writers release the changes buffered in their repository as soon as any of
+# these is reached: the end of a fixed window of this many seconds of the
+# changelog (e.g. 5*60 releases at most every 5 minutes), the oldest buffered
+# change being this many seconds old, or this many dirty projects. Use None
+# for all of them to release at every timestamp of the changelog.
+RELEASE_INTERVAL_IN_SECONDS = None
+MAX_RELEASE_STALENESS_IN_SECONDS = None
+MAX_DIRTY_PROJECTS_PER_RELEASE = None
+
+# All schemes, read in a single pass over package requests.
+ALL_LOG_FILENAME = \
+                  os.path.join(METADATA_DIRECTORY,
+                               'read-all-metadata.f{}.log'\
+                               .format(FREQUENCY_OF_PROJECT_CREATION_OR_UPDATE))
+# All schemes, written in a single replay of the change log.
+WRITE_ALL_LOG_FILENAME = os.path.join(METADATA_DIRECTORY,
+                                      'write-all-metadata.log')
+
 # Mercury
 MERCURY_DIRTY_PROJECTS_CACHE_FILEPATH = \
-          os.path.join(METADATA_DIRECTORY, 'MERCURY-DIRTY-PROJECTS-CACHE.json')
+        os.path.join(METADATA_DIRECTORY, 'MERCURY-DIRTY-PROJECTS-CACHE.sqlite')
 MERCURY_METADATA_PATCH_LENGTH_CACHE_FILEPATH = \
-    os.path.join(METADATA_DIRECTORY, 'MERCURY-METADATA-PATCH-LENGTH-CACHE.json')
+                      os.path.join(METADATA_DIRECTORY,
+                                   'MERCURY-METADATA-PATCH-LENGTH-CACHE.sqlite')
 
 MERCURY_BEST_LOG_FILENAME = \
                   os.path.join(METADATA_DIRECTORY,
@@ -58,10 +163,11 @@ MERCURY_DIRECTORY = os.path.join(METADATA_DIRECTORY, 'mercury/')
 
 # Mercury-nohash
 MERCURY_NOHASH_DIRTY_PROJECTS_CACHE_FILEPATH = \
-    os.path.join(METADATA_DIRECTORY, 'MERCURY-NOHASH-DIRTY-PROJECTS-CACHE.json')
+                      os.path.join(METADATA_DIRECTORY,
+                                   'MERCURY-NOHASH-DIRTY-PROJECTS-CACHE.sqlite')
 MERCURY_NOHASH_METADATA_PATCH_LENGTH_CACHE_FILEPATH = \
-                 os.path.join(METADATA_DIRECTORY,
-                              'MERCURY-NOHASH-METADATA-PATCH-LENGTH-CACHE.json')
+               os.path.join(METADATA_DIRECTORY,
+                            'MERCURY-NOHASH-METADATA-PATCH-LENGTH-CACHE.sqlite')
 
 MERCURY_NOHASH_BEST_LOG_FILENAME = \
                   os.path.join(METADATA_DIRECTORY,
@@ -85,9 +191,9 @@ MERCURY_NOHASH_DIRECTORY = os.path.join(METADATA_DIRECTORY, 'mercury-nohash/')
 
 # TUF
 TUF_DIRTY_PROJECTS_CACHE_FILEPATH = \
-              os.path.join(METADATA_DIRECTORY, 'TUF-DIRTY-PROJECTS-CACHE.json')
+            os.path.join(METADATA_DIRECTORY, 'TUF-DIRTY-PROJECTS-CACHE.sqlite')
 TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH = \
-        os.path.join(METADATA_DIRECTORY, 'TUF-METADATA-PATCH-LENGTH-CACHE.json')
+      os.path.join(METADATA_DIRECTORY, 'TUF-METADATA-PATCH-LENGTH-CACHE.sqlite')
 
 TUF_COST_FOR_NEW_USERS_FILEPATH = \
                 os.path.join(METADATA_DIRECTORY, 'TUF-COST-FOR-NEW-USERS.json')
@@ -0,0 +1,316 @@
+'''
+A module featuring packfiles: single append-only files that store every
+version of metadata written by a writer (e.g. TUF or Mercury), instead of one
+small file per version (e.g. packages/X.<identifier>.json).
+
+A packfile has this layout:
+
+  1. MAGIC.
+  2. For every version of metadata, in order of writing, a record of:
+     a. the length of its relpath, as a little-endian uint16;
+     b. the length of its JSON, as a little-endian uint32;
+     c. its relpath in UTF-8 (e.g. snapshot.<timestamp>.json);
+     d. its JSON.
+
+When a writer closes a packfile, it saves the index of relpaths to offsets
+and lengths next to it (i.e. <packfile>.index), along with how much of the
+packfile it covers, so that opening the packfile reads only the index instead
+of every record header, which would touch nearly every page of the packfile.
+Records past the end of the index (e.g. because a writer crashed before it
+could save the index) are indexed by skipping from one record header to the
+next, and so is the whole packfile, if the index is missing or does not match
+it. A partial record at the end is ignored, and then overwritten by the next
+writer. If a relpath was written more than once, the last one wins.
+'''
+
+
+# 1st-party
+import fcntl
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+
+# 2nd-party
+from nouns import PACKFILE_FILENAME
+
+
+# Bump whenever the layout of saved indexes changes.
+INDEX_VERSION = 1
+MAGIC = b'METAPAK\x01'
+RECORD_HEADER = struct.Struct('<HI')
+
+
+def _get_index_filepath(filepath):
+  return filepath+'.index'
+
+
+# Return the index saved for the packfile in this buffer, where the last
+# record it covers ends, and the relpath of that record, or an empty index if
+# it is missing or stale.
+def _load_index(filepath, buffer):
+  index_filepath = _get_index_filepath(filepath)
+
+  try:
+    with open(index_filepath, 'rb') as index_file:
+      version, end_offset, last_relpath, index = pickle.load(index_file)
+  except FileNotFoundError:
+    return {}, len(MAGIC), None
+
+  # The packfile must still have the last record that the index covers where
+  # the index says it is.
+  if version == INDEX_VERSION and end_offset <= len(buffer):
+    if last_relpath is None:
+      if end_offset == len(MAGIC):
+        return index, end_offset, last_relpath
+    else:
+      last_relpath_bytes = last_relpath.encode('utf-8')
+      json_offset, json_length = index[last_relpath]
+      relpath_offset = json_offset-len(last_relpath_bytes)
+      if json_offset+json_length == end_offset and \
+         buffer[relpath_offset:json_offset] == last_relpath_bytes:
+        logging.debug('R {}'.format(index_filepath))
+        return index, end_offset, last_relpath
+
+  logging.warning('Ignore stale {}'.format(index_filepath))
+  return {}, len(MAGIC), None
+
+
+# Return the index of every complete record in this buffer, where the last one
+# ends, and its relpath, by extending this index of every record before this
+# offset, the last of which has this relpath.
+def _read_index(buffer, index=None, offset=len(MAGIC), last_relpath=None):
+  assert buffer[:len(MAGIC)] == MAGIC
+
+  # str (metadata relpath): (int (offset of JSON), int (length of JSON))
+  if index is None:
+    index = {}
+  number_of_records = 0
+
+  while offset+RECORD_HEADER.size <= len(buffer):
+    relpath_length, json_length = RECORD_HEADER.unpack_from(buffer, offset)
+    relpath_offset = offset+RECORD_HEADER.size
+    json_offset = relpath_offset+relpath_length
+    end_offset = json_offset+json_length
+
+    if end_offset > len(buffer):
+      break
+    else:
+      relpath = bytes(buffer[relpath_offset:json_offset]).decode('utf-8')
+      index[relpath] = (json_offset, json_length)
+      offset = end_offset
+      last_relpath = relpath
+      number_of_records += 1
+
+  if number_of_records > 0:
+    logging.debug('Indexed {:,} records'.format(number_of_records))
+  return index, offset, last_relpath
+
+
+# Save this index of every record before this offset next to this packfile.
+def _save_index(filepath, index, end_offset, last_relpath):
+  index_filepath = _get_index_filepath(filepath)
+  saved_index = (INDEX_VERSION, end_offset, last_relpath, index)
+
+  # Write to a temporary file, so that a crash never leaves a partial index
+  # behind.
+  tmp_index_filepath = '{}.{}.tmp'.format(index_filepath, os.getpid())
+  with open(tmp_index_filepath, 'wb') as index_file:
+    pickle.dump(saved_index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_index_filepath, index_filepath)
+
+  logging.debug('W {}'.format(index_filepath))
+
+
+class PackfileReader:
+
+
+  '''
+  A read-only, dict-like packfile of metadata JSON, memory-mapped from disk.
+  '''
+
+
+  def __init__(self, filepath):
+    self.__filepath = filepath
+
+    with open(filepath, 'rb') as packfile:
+      self.__mmap = mmap.mmap(packfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # str (metadata relpath): (int (offset), int (length))
+    self.__index, _, _ = _read_index(self.__mmap,
+                                     *_load_index(filepath, self.__mmap))
+    logging.debug('OPEN {}'.format(self.__filepath))
+
+
+  def __contains__(self, metadata_relpath):
+    return metadata_relpath in self.__index
+
+
+  def __getitem__(self, metadata_relpath):
+    offset, length = self.__index[metadata_relpath]
+    return self.__mmap[offset:offset+length]
+
+
+  def __iter__(self):
+    return iter(self.__index)
+
+
+  def __len__(self):
+    return len(self.__index)
+
+
+  def close(self):
+    self.__mmap.close()
+    logging.debug('CLOSE {}'.format(self.__filepath))
+
+
+  def get(self, metadata_relpath, default=None):
+    try:
+      return self[metadata_relpath]
+    except KeyError:
+      return default
+
+
+class PackfileWriter:
+
+
+  '''
+  An append-only packfile of metadata JSON.
+
+  Only one writer may append to a packfile at a time, so it is locked until
+  the writer is closed. Threads may share a writer.
+  '''
+
+
+  def __init__(self, filepath):
+    self.__filepath = filepath
+    self.__packfile = open(filepath, 'a+b')
+    fcntl.flock(self.__packfile.fileno(), fcntl.LOCK_EX)
+
+    self.__packfile.seek(0, os.SEEK_END)
+    if self.__packfile.tell() == 0:
+      self.__packfile.write(MAGIC)
+      self.__packfile.flush()
+
+    with mmap.mmap(self.__packfile.fileno(), 0,
+                   access=mmap.ACCESS_READ) as buffer:
+      # str (metadata relpath): (int (offset of JSON), int (length of JSON))
+      # The relpath of the last record is saved along with the index, so that
+      # readers can tell whether it still matches the packfile.
+      self.__index, self.__end_offset, self.__last_relpath = \
+                        _read_index(buffer, *_load_index(filepath, buffer))
+      length = len(buffer)
+
+    # Drop a partial record left by a writer that crashed.
+    if self.__end_offset < length:
+      logging.warning('Truncate {} from {:,} to {:,} bytes'\
+                      .format(self.__filepath, length, self.__end_offset))
+      self.__packfile.truncate(self.__end_offset)
+
+    # Keeps the records of threads from interleaving.
+    self.__lock = threading.Lock()
+    logging.debug('OPEN {}'.format(self.__filepath))
+
+
+  def __contains__(self, metadata_relpath):
+    return metadata_relpath in self.__index
+
+
+  def __len__(self):
+    return len(self.__index)
+
+
+  @property
+  def end_offset(self):
+    with self.__lock:
+      return self.__end_offset
+
+
+  def append(self, metadata_relpath, metadata_json):
+    assert isinstance(metadata_json, bytes)
+    metadata_relpath_bytes = metadata_relpath.encode('utf-8')
+
+    # NOTE: Append mode always writes at the end of the packfile.
+    with self.__lock:
+      self.__packfile.write(RECORD_HEADER.pack(len(metadata_relpath_bytes),
+                                               len(metadata_json)))
+      self.__packfile.write(metadata_relpath_bytes)
+      self.__packfile.write(metadata_json)
+
+      json_offset = self.__end_offset+RECORD_HEADER.size+\
+                    len(metadata_relpath_bytes)
+      self.__index[metadata_relpath] = (json_offset, len(metadata_json))
+      self.__end_offset = json_offset+len(metadata_json)
+      self.__last_relpath = metadata_relpath
+
+
+  def close(self):
+    self.flush()
+    _save_index(self.__filepath, self.__index, self.__end_offset,
+                self.__last_relpath)
+    # Closing the file also releases the lock.
+    self.__packfile.close()
+    logging.debug('CLOSE {}'.format(self.__filepath))
+
+
+  def flush(self):
+    with self.__lock:
+      self.__packfile.flush()
+
+
+  def truncate(self, end_offset):
+    '''Drop every record past this offset (e.g. an earlier end_offset), and
+    return their relpaths.
+
+    NOTE: A relpath appended again past this offset is dropped altogether,
+    even if an older record of it is kept.'''
+
+    with self.__lock:
+      assert len(MAGIC) <= end_offset <= self.__end_offset
+      self.__packfile.flush()
+
+      # Read only the records to drop.
+      with mmap.mmap(self.__packfile.fileno(), 0,
+                     access=mmap.ACCESS_READ) as buffer:
+        dropped_index, _, _ = _read_index(buffer, offset=end_offset)
+
+      for metadata_relpath in dropped_index:
+        del self.__index[metadata_relpath]
+      self.__packfile.truncate(end_offset)
+      self.__end_offset = end_offset
+      self.__last_relpath = None
+      if len(self.__index) > 0:
+        self.__last_relpath = max(self.__index,
+                                  key=lambda relpath: self.__index[relpath][0])
+
+      # The saved index no longer matches the packfile.
+      index_filepath = _get_index_filepath(self.__filepath)
+      if os.path.exists(index_filepath):
+        os.remove(index_filepath)
+
+    logging.warning('Truncate {} to {:,} bytes, dropping {:,} records'\
+                    .format(self.__filepath, end_offset, len(dropped_index)))
+    return list(dropped_index)
+
+
+def export(metadata_directory, packfile_filename=PACKFILE_FILENAME):
+  '''Write every version of metadata in the packfile of this metadata
+  directory to its own file, exactly as writers without packfiles would.'''
+
+  packfile = PackfileReader(os.path.join(metadata_directory,
+                                         packfile_filename))
+
+  try:
+    for metadata_relpath in packfile:
+      metadata_abspath = os.path.join(metadata_directory, metadata_relpath)
+      os.makedirs(os.path.dirname(metadata_abspath), exist_ok=True)
+
+      with open(metadata_abspath, 'wb') as metadata_file:
+        metadata_file.write(packfile[metadata_relpath])
+      logging.debug('W {}'.format(metadata_abspath))
+
+  finally:
+    packfile.close()
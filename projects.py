@@ -1,17 +1,58 @@
 
 
 # 1st-party
+import array
+import binascii
+import bisect
+import fnmatch
+import functools
 import glob
+import hashlib
 import logging
 import os
+import pickle
 import re
 
 # 2nd-party
 import changelog
 from metadatawriter import MetadataWriter
+import mirror
 import nouns
 
 
+# Bump whenever the layout of Projects changes, so that reversed projects
+# saved with the old layout are never loaded.
+REVERSED_PROJECTS_VERSION = 2
+
+
+# Return the segments of this glob pattern of packages, along with their
+# matchers.
+@functools.lru_cache(maxsize=1024)
+def _compile_package_pattern(pattern):
+  return tuple((segment, re.compile(fnmatch.translate(segment))) \
+               for segment in pattern.split('/'))
+
+
+# Return whether this relpath of a package matches this glob pattern, exactly
+# as if glob had matched it on disk.
+def _match_package(package_relpath, pattern):
+  package_segments = package_relpath.split('/')
+  pattern_segments = _compile_package_pattern(pattern)
+
+  if len(package_segments) != len(pattern_segments):
+    return False
+
+  for package_segment, (pattern_segment, matcher) in \
+      zip(package_segments, pattern_segments):
+    # Like glob, wildcards do not match hidden names.
+    if package_segment.startswith('.') and not pattern_segment.startswith('.'):
+      return False
+    elif not matcher.match(package_segment):
+      return False
+
+  return True
+
+
 class Projects:
 
 
@@ -19,45 +60,128 @@ class Projects:
 
 
   def __init__(self, changelog_reader):
-    # str: str[64]
-    self.__project_to_keyid = {}
-    # str: {str (absolute package filename)}
+    # NOTE: Keyids are not kept, because they are made of project names.
+    # str: array('q') (package ids)
     self.__project_to_packages = {}
     # str: int > 0
     self.__project_to_version = {}
-    # str: bool
-    self.__project_to_dirty = {}
-
-    # str[64]: str[64]
+    # [str] (sorted project names)
+    self.__names = []
+    # {str} (projects whose metadata changed since they were last unmarked)
+    self.__dirty_projects = set()
+    # {str} (projects removed since they were last unmarked)
+    self.__removed_projects = set()
+
+    # bytes[32]: bytes[32]
     self.__keyid_to_keyval = {}
 
-    # str (absolute package filename): str[64]
-    self.__package_to_sha256 = {}
-    # str (absolute package filename): int > 0
-    self.__package_to_length = {}
+    # Every package on the mirror is interned once and for all as an id into
+    # these tables, whether or not its project has it right now, so that
+    # there is only one, relative, path for every package, and so that the
+    # mirror itself need not be kept around to add a package back.
+    # str (package relpath from PYPI_DIRECTORY): int (package id)
+    self.__package_to_id = {}
+    # [str] (package relpath of every package id)
+    self.__package_relpaths = []
+    # int (package id): int > 0
+    self.__package_lengths = array.array('q')
+    # int (package id): bytes[32] (SHA-256 digest), one after another
+    self.__package_digests = bytearray()
+    # str (project name): range (consecutive ids of its packages on the mirror)
+    self.__project_to_mirror_packages = {}
+
+    # The packages of every project on the mirror, walked at most once, and
+    # dropped as soon as they are interned.
+    mirror_index = mirror.get_mirror(nouns.MIRROR_MANIFEST_FILEPATH,
+                                     refresh=nouns.REFRESH_MIRROR_MANIFEST)
+
+    # Reversing the change log depends only on the mirror and the change log,
+    # so every writer may reuse the same reversed projects.
+    reversed_projects_filepath = \
+          self.__get_reversed_projects_filepath(changelog_reader, mirror_index)
+
+    if reversed_projects_filepath is not None and \
+       os.path.exists(reversed_projects_filepath):
+      del mirror_index
+      self.__load_reversed_projects(reversed_projects_filepath)
 
-    self.__setup()
-    self.__reverse(changelog_reader)
+    else:
+      self.__setup(mirror_index)
+      del mirror_index
+      self.__reverse(changelog_reader)
+
+      if reversed_projects_filepath is not None:
+        self.__save_reversed_projects(reversed_projects_filepath)
 
 
   def __add_project_and_packages(self, project_name):
     logging.debug(project_name)
     self.add_project(project_name)
 
-    packages_directory = os.path.join(nouns.PACKAGES_DIRECTORY,
-                                      '*/*/{}/*'.format(project_name))
     # NOTE: With PyPI renaming/canonical-ization of project names,
     # simple names may not directly correspond to package names. What this
     # means is that there may seem to be no packages for renamed projects.
-    for package in sorted(glob.glob(packages_directory)):
-      self.add_package(package)
+    for package_id in self.__project_to_mirror_packages.get(project_name, ()):
+      self.__add_package_id(project_name, package_id)
 
 
-  # Return a *deterministic* "hash" for this package.
-  # WARNING: Do *NOT* reuse this value anywhere else!
-  def __make_hash_for_package(self, package):
-    # Return the hash of the package path.
-    return MetadataWriter.get_sha256(package.encode('utf-8'))
+  def __add_package_id(self, project_name, package_id):
+    package_ids = self.__project_to_packages[project_name]
+
+    if package_id not in package_ids:
+      package_ids.append(package_id)
+
+    self.__mark_project_as_dirty(project_name)
+    logging.info('Added package: {}'\
+                 .format(os.path.join(nouns.PYPI_DIRECTORY,
+                                      self.__package_relpaths[package_id])))
+
+
+  # Return the packages of this project that match this glob pattern of
+  # packages, relative to the packages directory.
+  def __find_packages(self, project_name, pattern):
+    # e.g. packages/
+    prefix = os.path.relpath(nouns.PACKAGES_DIRECTORY,
+                             nouns.PYPI_DIRECTORY)+'/'
+    pattern = prefix+pattern
+    return sorted(os.path.join(nouns.PYPI_DIRECTORY, relpath) \
+                  for relpath in self.__get_package_relpaths(project_name) \
+                  if _match_package(relpath, pattern))
+
+
+  # Return the relpath from PYPI_DIRECTORY of this absolute package filename.
+  def __get_package_relpath(self, package):
+    assert package.startswith(nouns.PYPI_DIRECTORY+'/')
+    return package[len(nouns.PYPI_DIRECTORY)+1:]
+
+
+  def __get_package_relpaths(self, project_name):
+    return [self.__package_relpaths[package_id] \
+            for package_id in self.__project_to_packages[project_name]]
+
+
+  # Return the filepath of the reversed projects of this mirror and change
+  # log, or None if they are never saved.
+  def __get_reversed_projects_filepath(self, changelog_reader, mirror_index):
+    if nouns.REVERSED_PROJECTS_FILEPATH is None:
+      return None
+
+    else:
+      fingerprint = hashlib.sha256()
+      fingerprint.update('{}\n{}\n{}\n'\
+                         .format(REVERSED_PROJECTS_VERSION,
+                                 mirror_index.get_fingerprint(),
+                                 changelog_reader.get_fingerprint())\
+                         .encode('utf-8'))
+      return nouns.REVERSED_PROJECTS_FILEPATH.format(fingerprint.hexdigest())
+
+
+  def __load_reversed_projects(self, reversed_projects_filepath):
+    with open(reversed_projects_filepath, 'rb') as reversed_projects_file:
+      state = pickle.load(reversed_projects_file)
+
+    vars(self).update(state)
+    logging.info('R {}'.format(reversed_projects_filepath))
 
 
   # Return a *deterministic* "keyid" for this project.
@@ -69,7 +193,7 @@ class Projects:
 
   def __mark_project_as_dirty(self, project_name):
     assert self.__project_exists(project_name)
-    self.__project_to_dirty[project_name] = True
+    self.__dirty_projects.add(project_name)
     logging.debug('Marked project as dirty: {}'.format(project_name))
 
 
@@ -78,17 +202,14 @@ class Projects:
     # Do NOT call this function without ensuring the existence of the project.
     assert self.__project_exists(project_name)
 
-    if package in self.__project_to_packages[project_name]:
-      assert package in self.__package_to_length
-      assert package in self.__package_to_sha256
-      return True
-    else:
-      return False
+    package_id = self.__package_to_id.get(self.__get_package_relpath(package))
+
+    return package_id is not None and \
+           package_id in self.__project_to_packages[project_name]
 
 
   def __project_exists(self, project_name):
-    return project_name in self.__project_to_keyid or \
-           project_name in self.__project_to_packages or \
+    return project_name in self.__project_to_packages or \
            project_name in self.__project_to_version
 
 
@@ -136,49 +257,85 @@ class Projects:
     logging.debug('...done.')
 
 
-  def __setup(self):
-    project_names = \
-      sorted(d for d in os.listdir(nouns.SIMPLE_DIRECTORY) \
-             if os.path.isdir(os.path.join(nouns.SIMPLE_DIRECTORY, d)))
+  def __save_reversed_projects(self, reversed_projects_filepath):
+    state = vars(self)
+
+    # Write to a temporary file, so that a crash, or other writers saving the
+    # same projects, never leave partial projects behind.
+    tmp_reversed_projects_filepath = \
+                  '{}.{}.tmp'.format(reversed_projects_filepath, os.getpid())
+    with open(tmp_reversed_projects_filepath, 'wb') as reversed_projects_file:
+      pickle.dump(state, reversed_projects_file,
+                  protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_reversed_projects_filepath, reversed_projects_filepath)
+
+    logging.info('W {}'.format(reversed_projects_filepath))
+
+    # Keep only the projects of the current mirror and change log, which
+    # replace those of any other.
+    for stale_reversed_projects_filepath in \
+        glob.glob(nouns.REVERSED_PROJECTS_FILEPATH.format('*')):
+      if stale_reversed_projects_filepath != reversed_projects_filepath:
+        os.remove(stale_reversed_projects_filepath)
+        logging.info('D {}'.format(stale_reversed_projects_filepath))
+
 
-    for project_name in project_names:
+  def __setup(self, mirror_index):
+    for project_name in sorted(mirror_index):
+      first_package_id = len(self.__package_relpaths)
+
+      for package, length, digest in mirror_index.get_packages(project_name):
+        assert len(digest) == 32
+        relpath = self.__get_package_relpath(package)
+        self.__package_to_id[relpath] = len(self.__package_relpaths)
+        self.__package_relpaths.append(relpath)
+        self.__package_lengths.append(length)
+        self.__package_digests.extend(digest)
+
+      self.__project_to_mirror_packages[project_name] = \
+                          range(first_package_id, len(self.__package_relpaths))
+
+    for project_name in mirror_index.project_names:
       self.__add_project_and_packages(project_name)
 
 
   def add_package(self, package):
     project_name = self.get_project_name_from_package(package)
     assert self.__project_exists(project_name)
-    self.__project_to_packages[project_name].add(package)
-    self.__package_to_sha256[package] = self.__make_hash_for_package(package)
-    self.__package_to_length[package] = os.path.getsize(package)
-    self.__mark_project_as_dirty(project_name)
-    logging.info('Added package: {}'.format(package))
+
+    package_id = self.__package_to_id.get(self.__get_package_relpath(package))
+    assert package_id is not None, package
+    self.__add_package_id(project_name, package_id)
 
 
   def add_project(self, project_name):
     assert not self.__project_exists(project_name)
 
     keyid = self.__make_keyid_for_project(project_name)
-    self.__keyid_to_keyval[keyid] = MetadataWriter.get_random_ed25519_keyval()
-    self.__project_to_keyid[project_name] = keyid
-    self.__project_to_packages[project_name] = set()
+    keyval = MetadataWriter.get_random_ed25519_keyval()
+    self.__keyid_to_keyval[binascii.a2b_hex(keyid)] = binascii.a2b_hex(keyval)
+    self.__project_to_packages[project_name] = array.array('q')
     self.__project_to_version[project_name] = 1
+    # NOTE: Projects are mostly added in order, i.e. appended.
+    bisect.insort(self.__names, project_name)
     self.__mark_project_as_dirty(project_name)
     logging.info('Added project: {}'.format(project_name))
 
 
   @property
   def dirty(self):
-    return [name for name in self.names if self.__project_to_dirty[name]]
+    # NOTE: A new list, so that callers may unmark projects while iterating.
+    return sorted(self.__dirty_projects)
 
 
   def get_keyids_for_project(self, project_name):
     assert self.__project_exists(project_name)
-    return (self.__project_to_keyid[project_name],)
+    return (self.__make_keyid_for_project(project_name),)
 
 
   def get_keyval_for_keyid(self, keyid):
-    return self.__keyid_to_keyval[keyid]
+    keyval = self.__keyid_to_keyval[binascii.a2b_hex(keyid)]
+    return binascii.b2a_hex(keyval).decode('utf-8')
 
 
   @staticmethod
@@ -194,16 +351,16 @@ class Projects:
 
 
   def get_targets_metadata_for_project(self, project_name):
-    def get_relpath(package):
-      assert package.startswith(nouns.PYPI_DIRECTORY)
-      return package[len(nouns.PYPI_DIRECTORY)+1:]
+    def get_target_metadata(package_id):
+      digest = self.__package_digests[package_id*32:(package_id+1)*32]
+      return MetadataWriter.get_target_metadata(
+                                      binascii.b2a_hex(digest).decode('utf-8'),
+                                      self.__package_lengths[package_id])
 
     assert self.__project_exists(project_name)
     return {
-      get_relpath(package):
-        MetadataWriter.get_target_metadata(self.__package_to_sha256[package],
-                                           self.__package_to_length[package])
-      for package in self.__project_to_packages[project_name]
+      self.__package_relpaths[package_id]: get_target_metadata(package_id)
+      for package_id in self.__project_to_packages[project_name]
     }
 
 
@@ -216,21 +373,23 @@ class Projects:
 
   @property
   def names(self):
-    assert self.__project_to_keyid.keys() == self.__project_to_packages.keys()
-    assert self.__project_to_keyid.keys() == self.__project_to_version.keys()
-    return sorted(self.__project_to_keyid.keys())
+    # WARNING: Do *NOT* modify this list!
+    assert len(self.__names) == len(self.__project_to_version)
+    return self.__names
+
+
+  @property
+  def number_of_dirty_projects(self):
+    return len(self.__dirty_projects)
 
 
   def remove_package(self, package):
     project_name = self.get_project_name_from_package(package)
     assert self.__project_exists(project_name)
-    assert package in self.__project_to_packages[project_name]
-    assert package in self.__package_to_length
-    assert package in self.__package_to_sha256
 
-    self.__project_to_packages[project_name].discard(package)
-    del self.__package_to_length[package]
-    del self.__package_to_sha256[package]
+    # NOTE: The package stays interned, in case it is added back later.
+    package_id = self.__package_to_id[self.__get_package_relpath(package)]
+    self.__project_to_packages[project_name].remove(package_id)
     self.__mark_project_as_dirty(project_name)
 
     logging.info('Removed package: {}'.format(package))
@@ -239,25 +398,39 @@ class Projects:
   def remove_project(self, project_name):
     assert self.__project_exists(project_name)
 
-    del self.__keyid_to_keyval[self.__project_to_keyid[project_name]]
-    del self.__project_to_dirty[project_name]
-    del self.__project_to_keyid[project_name]
+    keyid = self.__make_keyid_for_project(project_name)
+    del self.__keyid_to_keyval[binascii.a2b_hex(keyid)]
     del self.__project_to_version[project_name]
 
-    packages = self.__project_to_packages[project_name].copy()
+    packages = [os.path.join(nouns.PYPI_DIRECTORY, relpath) \
+                for relpath in self.__get_package_relpaths(project_name)]
     for package in packages:
       self.remove_package(package)
     del self.__project_to_packages[project_name]
+    # Removing its packages marked it as dirty again.
+    self.__dirty_projects.discard(project_name)
+    del self.__names[bisect.bisect_left(self.__names, project_name)]
+    self.__removed_projects.add(project_name)
 
     logging.info('Removed project: {}'.format(project_name))
 
 
+  @property
+  def removed(self):
+    return sorted(self.__removed_projects)
+
+
   def unmark_project_as_dirty(self, project_name):
     assert self.__project_exists(project_name)
-    self.__project_to_dirty[project_name] = False
+    self.__dirty_projects.discard(project_name)
     logging.debug('Unmarked project as dirty: {}'.format(project_name))
 
 
+  def unmark_project_as_removed(self, project_name):
+    self.__removed_projects.discard(project_name)
+    logging.debug('Unmarked project as removed: {}'.format(project_name))
+
+
   def update(self, change):
     if isinstance(change, changelog.AddPackage):
       package = os.path.join(nouns.PACKAGES_DIRECTORY, change.name)
@@ -269,8 +442,8 @@ class Projects:
                      'for added package {}'.format(project_name, package))
         self.add_project(project_name)
       else:
-        # Add the package if it still exists on disk.
-        if os.path.exists(package):
+        # Add the package if it still exists on the mirror.
+        if self.__get_package_relpath(package) in self.__package_to_id:
           self.add_package(package)
           self.inc_project_version(project_name)
         else:
@@ -285,13 +458,17 @@ class Projects:
 
       # Remove the package only if the project itself still exists.
       if self.__project_exists(project_name):
-        for package in sorted(glob.glob(packages)):
-          if self.__package_exists(package):
-            self.remove_package(package)
-            self.inc_project_version(project_name)
-          else:
-            logging.warn('Could not remove non-existent package {} '\
-                         'from project {}'.format(package, project_name))
+        # NOTE: Every package of the project on the mirror is in memory, so
+        # there is no need to glob the mirror itself.
+        removed_packages = self.__find_packages(project_name, change.name)
+
+        for package in removed_packages:
+          self.remove_package(package)
+          self.inc_project_version(project_name)
+
+        if len(removed_packages) == 0:
+          logging.warn('Could not remove non-existent packages {} '\
+                       'from project {}'.format(packages, project_name))
       else:
         logging.warn('Could not remove packages {} '\
                      'for non-existent project {}'.format(packages,
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+'''
+Read package requests only once for Mercury, Mercury-nohash, TUF and
+TUF-version, in both their best and worst cases, and write the costs of every
+scheme into the same output files as their separate read-*.py scripts.
+'''
+
+
+# 1st-party
+import importlib
+
+
+# 2nd-party
+from metadatareader import read_all
+from nouns import ALL_LOG_FILENAME, \
+                  MERCURY_BEST_OUTPUT_FILENAME, \
+                  MERCURY_DIRECTORY, \
+                  MERCURY_DIRTY_PROJECTS_CACHE_FILEPATH, \
+                  MERCURY_METADATA_PATCH_LENGTH_CACHE_FILEPATH, \
+                  MERCURY_NOHASH_BEST_OUTPUT_FILENAME, \
+                  MERCURY_NOHASH_DIRECTORY, \
+                  MERCURY_NOHASH_DIRTY_PROJECTS_CACHE_FILEPATH, \
+                  MERCURY_NOHASH_METADATA_PATCH_LENGTH_CACHE_FILEPATH, \
+                  MERCURY_NOHASH_WORST_OUTPUT_FILENAME, \
+                  MERCURY_WORST_OUTPUT_FILENAME, \
+                  TUF_BEST_OUTPUT_FILENAME, \
+                  TUF_DIRECTORY, \
+                  TUF_DIRTY_PROJECTS_CACHE_FILEPATH, \
+                  TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH, \
+                  TUF_VERSION_BEST_OUTPUT_FILENAME, \
+                  TUF_VERSION_WORST_OUTPUT_FILENAME, \
+                  TUF_WORST_OUTPUT_FILENAME
+
+
+# script name: (reader class name, metadata directory,
+#               metadata patch length cache filepath,
+#               dirty projects cache filepath, output filename)
+SCHEMES = (
+  ('read-mercury-metadata-best', 'MercuryMetadataReader', MERCURY_DIRECTORY,
+   MERCURY_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   MERCURY_DIRTY_PROJECTS_CACHE_FILEPATH, MERCURY_BEST_OUTPUT_FILENAME),
+  ('read-mercury-metadata-worst', 'MercuryMetadataReader', MERCURY_DIRECTORY,
+   MERCURY_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   MERCURY_DIRTY_PROJECTS_CACHE_FILEPATH, MERCURY_WORST_OUTPUT_FILENAME),
+  ('read-mercury-nohash-metadata-best', 'MercuryNoHashMetadataReader',
+   MERCURY_NOHASH_DIRECTORY,
+   MERCURY_NOHASH_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   MERCURY_NOHASH_DIRTY_PROJECTS_CACHE_FILEPATH,
+   MERCURY_NOHASH_BEST_OUTPUT_FILENAME),
+  ('read-mercury-nohash-metadata-worst', 'MercuryNoHashMetadataReader',
+   MERCURY_NOHASH_DIRECTORY,
+   MERCURY_NOHASH_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   MERCURY_NOHASH_DIRTY_PROJECTS_CACHE_FILEPATH,
+   MERCURY_NOHASH_WORST_OUTPUT_FILENAME),
+  ('read-tuf-metadata-best', 'TUFMetadataReader', TUF_DIRECTORY,
+   TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   TUF_DIRTY_PROJECTS_CACHE_FILEPATH, TUF_BEST_OUTPUT_FILENAME),
+  ('read-tuf-metadata-worst', 'TUFMetadataReader', TUF_DIRECTORY,
+   TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   TUF_DIRTY_PROJECTS_CACHE_FILEPATH, TUF_WORST_OUTPUT_FILENAME),
+  ('read-tuf-version-metadata-best', 'TUFMetadataReader', TUF_DIRECTORY,
+   TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   TUF_DIRTY_PROJECTS_CACHE_FILEPATH, TUF_VERSION_BEST_OUTPUT_FILENAME),
+  ('read-tuf-version-metadata-worst', 'TUFMetadataReader', TUF_DIRECTORY,
+   TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   TUF_DIRTY_PROJECTS_CACHE_FILEPATH, TUF_VERSION_WORST_OUTPUT_FILENAME),
+)
+
+
+def get_schemes():
+  schemes = []
+
+  for script_name, class_name, metadata_directory, \
+      metadata_patch_length_cache_filepath, dirty_projects_cache_filepath, \
+      output_filename in SCHEMES:
+    # NOTE: Every script defines its own class of readers, even when two
+    # scripts give their classes the same name.
+    MetadataReaderClass = getattr(importlib.import_module(script_name),
+                                  class_name)
+    schemes.append((MetadataReaderClass, metadata_directory,
+                    metadata_patch_length_cache_filepath,
+                    dirty_projects_cache_filepath, output_filename))
+
+  return schemes
+
+
+if __name__ == '__main__':
+  read_all(ALL_LOG_FILENAME, get_schemes())
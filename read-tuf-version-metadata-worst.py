@@ -162,23 +162,9 @@ class TUFMetadataReader(MetadataReader):
     # previous snapshot metadata relpath before the previous snapshot metadata
     # relpath.
     prev_snapshot_metadata_relpath = self._prev_prev_snapshot_metadata_relpath
-    prev_snapshot_metadata = \
-                        self._read_snapshot(prev_snapshot_metadata_relpath)
-
-    # NOTE: This computation would be stupid for Mercury, because it would
-    # just be packages/project.1.json anyway, except for one thing: the
-    # project itself could be missing in the previous snapshot.
-    if project_metadata_relpath in prev_snapshot_metadata:
-      prev_project_metadata_identifier = \
-                      prev_snapshot_metadata.get(project_metadata_relpath)
-      prev_project_metadata_relpath = \
-            'packages/{}.{}.json'.format(project_name,
-                                         prev_project_metadata_identifier)
-    # Project did not exist in previous snapshot!
-    else:
-      prev_project_metadata_relpath = None
-
-    return prev_project_metadata_relpath
+    return self._get_project_metadata_relpath_at(prev_snapshot_metadata_relpath,
+                                                 project_metadata_relpath,
+                                                 project_name)
 
 
   def _load_dirty_projects(self, curr_metadata_relpath, key):
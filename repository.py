@@ -127,7 +127,7 @@ class Repository:
 
 
   def release(self):
-    if len(self.projects.dirty) > 0:
+    if self.projects.number_of_dirty_projects > 0:
       #self.inc_projects_administrator_version()
       self.inc_snapshot_administrator_version()
 
@@ -0,0 +1,44 @@
+'''
+A module to store snapshot metadata as deltas. Every few releases, writers
+store snapshot metadata in full as a keyframe (i.e. snapshot.<timestamp>.json),
+and in between only as a delta (i.e. snapshot-delta.<timestamp>.json) from the
+previous snapshot metadata, which readers rebuild on demand.
+
+A delta is a JSON object with:
+
+  1. base: the relpath of the snapshot metadata that it applies to, which may
+     itself be stored as a delta;
+  2. patch: the RFC 6902 patch from the base to the snapshot metadata.
+'''
+
+
+# 1st-party
+import re
+
+
+# 2nd-party
+import metadatadiff
+
+
+DELTA_RELPATH_PATTERN = re.compile(r'snapshot-delta\.(\d+)\.json')
+
+
+def get_delta_relpath(snapshot_metadata_relpath):
+  assert snapshot_metadata_relpath.startswith('snapshot.')
+  return 'snapshot-delta.'+snapshot_metadata_relpath[len('snapshot.'):]
+
+
+def get_snapshot_metadata_relpath(delta_relpath):
+  assert DELTA_RELPATH_PATTERN.fullmatch(delta_relpath)
+  return 'snapshot.'+delta_relpath[len('snapshot-delta.'):]
+
+
+def make_delta(base_relpath, patch):
+  return {'base': base_relpath, 'patch': patch}
+
+
+def rebuild(delta, base_snapshot_metadata):
+  '''Return the snapshot metadata that this delta stands for, which shares
+  every value the delta does not touch with its base.'''
+
+  return metadatadiff.apply_patch(base_snapshot_metadata, delta['patch'])
@@ -0,0 +1,529 @@
+'''
+A module to index the snapshot metadata written by every writer (e.g. TUF or
+Mercury) in a compact binary file, which readers memory-map instead of parsing
+every snapshot metadata file.
+
+An index is written in one pass over the snapshot metadata, in order of
+timestamps, and has this layout:
+
+  1. MAGIC.
+  2. For every snapshot metadata, an array of little-endian uint32, indexed by
+     project ID. Zero means that the project is absent from the snapshot;
+     otherwise, it is the identifier ID of the project plus one. Project IDs
+     are assigned in order of first appearance, so every array is only as long
+     as the number of projects seen so far.
+  3. A JSON footer with the fingerprint of the snapshot metadata it covers
+     (see get_fingerprint), the table of projects (i.e. packages/X.json), the
+     table of identifiers (i.e. the values of signed.meta), and, for every
+     snapshot metadata, its relpath, the offset and length of its array, and
+     the rest of its document without signed.meta. For every project, it also
+     has a timeline: the sorted timestamps of the snapshot metadata where the
+     project changed, and its identifier ID plus one (or zero) from then on.
+  4. The offset of the footer, as a little-endian uint64.
+'''
+
+
+# 1st-party
+import bisect
+import collections.abc
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+
+
+# 2nd-party
+import metadatadiff
+from nouns import PACKFILE_FILENAME, SNAPSHOT_INDEX_FILENAME
+from packfile import PackfileReader
+import snapshotdelta
+
+
+# 3rd-party
+import numpy
+
+
+ARRAY_DTYPE = numpy.dtype('<u4')
+FOOTER_OFFSET_FORMAT = '<Q'
+MAGIC = b'SNAPIDX\x01'
+SNAPSHOT_METADATA_RELPATH_PATTERN = re.compile(r'snapshot\.(\d+)\.json')
+
+
+class SnapshotIndex:
+
+
+  '''
+  A read-only index of snapshot metadata, memory-mapped from disk.
+  '''
+
+
+  def __init__(self, filepath):
+    self.__filepath = filepath
+
+    with open(filepath, 'rb') as index_file:
+      assert index_file.read(len(MAGIC)) == MAGIC, filepath
+
+      footer_offset_size = struct.calcsize(FOOTER_OFFSET_FORMAT)
+      index_file.seek(-footer_offset_size, os.SEEK_END)
+      footer_offset, = struct.unpack(FOOTER_OFFSET_FORMAT,
+                                     index_file.read(footer_offset_size))
+      index_file.seek(footer_offset)
+      footer = json.loads(index_file.read()[:-footer_offset_size]\
+                          .decode('utf-8'))
+
+    # str (SHA-256 hex digest), or None for indexes written without one
+    self.__fingerprint = footer.get('fingerprint')
+    # [str (project metadata relpath)]
+    self.__projects = footer['projects']
+    # str (project metadata relpath): int (project ID)
+    self.__project_ids = {project_metadata_relpath: project_id \
+                          for project_id, project_metadata_relpath \
+                          in enumerate(self.__projects)}
+    # [str/int/dict (project metadata identifier)]
+    self.__identifiers = footer['identifiers']
+    # [([int (timestamp)], [int (identifier ID+1 > -1)])] (one per project)
+    self.__timelines = footer['timelines']
+    # str (snapshot metadata relpath): (int (offset), int (length),
+    #                                   str (header))
+    self.__snapshots = collections.OrderedDict(
+                                (snapshot[0], tuple(snapshot[1:])) \
+                                for snapshot in footer['snapshots'])
+
+    number_of_items = (footer_offset-len(MAGIC)) // ARRAY_DTYPE.itemsize
+    if number_of_items > 0:
+      self.__arrays = numpy.memmap(filepath, dtype=ARRAY_DTYPE, mode='r',
+                                   offset=len(MAGIC), shape=(number_of_items,))
+    else:
+      self.__arrays = numpy.zeros(0, dtype=ARRAY_DTYPE)
+
+    logging.debug('OPEN {}'.format(filepath))
+
+
+  def __contains__(self, snapshot_metadata_relpath):
+    return snapshot_metadata_relpath in self.__snapshots
+
+
+  def __iter__(self):
+    return iter(self.__snapshots)
+
+
+  def __len__(self):
+    return len(self.__snapshots)
+
+
+  def __get_identifier_id_at(self, project_metadata_relpath, timestamp):
+    project_id = self.__project_ids.get(project_metadata_relpath)
+
+    if project_id is not None:
+      timestamps, identifier_ids = self.__timelines[project_id]
+      # The last change at or before this time.
+      i = bisect.bisect_right(timestamps, timestamp)-1
+      if i > -1 and identifier_ids[i] > 0:
+        return identifier_ids[i]-1
+
+    return None
+
+
+  def __read_header(self, snapshot_metadata_relpath):
+    # NOTE: signed.meta is None in the header, but keeps its place among the
+    # sorted keys of signed.
+    return json.loads(self.__snapshots[snapshot_metadata_relpath][2])
+
+
+  def close(self):
+    self.__arrays = None
+    logging.debug('CLOSE {}'.format(self.__filepath))
+
+
+  def get_fingerprint(self):
+    '''Return the fingerprint of the snapshot metadata that was indexed, so
+    that readers can tell whether it changed since.'''
+
+    return self.__fingerprint
+
+
+  def get_identifier(self, identifier_id):
+    return self.__identifiers[identifier_id]
+
+
+  def get_identifier_at(self, project_metadata_relpath, timestamp):
+    '''Return the identifier of this project in the latest snapshot metadata
+    at or before this time, or None if the project was absent from it.'''
+
+    identifier_id = self.__get_identifier_id_at(project_metadata_relpath,
+                                                timestamp)
+
+    if identifier_id is None:
+      return None
+    else:
+      return self.__identifiers[identifier_id]
+
+
+  def get_meta(self, snapshot_metadata_relpath):
+    '''Return a read-only view of signed.meta in this snapshot metadata.'''
+
+    offset, length, header = self.__snapshots[snapshot_metadata_relpath]
+    return SnapshotMeta(self, self.__arrays[offset:offset+length])
+
+
+  def get_project(self, project_id):
+    return self.__projects[project_id]
+
+
+  def get_project_id(self, project_metadata_relpath):
+    return self.__project_ids.get(project_metadata_relpath)
+
+
+  def make_patch(self, prev_snapshot_metadata_relpath,
+                 curr_snapshot_metadata_relpath):
+    '''Return the same patch as metadatadiff.make_patch between these two
+    snapshot metadata, where the previous one may be None, but compare their
+    signed.meta as arrays.'''
+
+    if prev_snapshot_metadata_relpath is None:
+      curr_metadata = self.read_metadata(curr_snapshot_metadata_relpath)
+      return metadatadiff.make_patch({}, curr_metadata)
+
+    # First, compare everything but signed.meta.
+    patch = metadatadiff.make_patch(
+                          self.__read_header(prev_snapshot_metadata_relpath),
+                          self.__read_header(curr_snapshot_metadata_relpath))
+
+    # Like jsonpatch, operations on the keys in both signed go after those
+    # that add or remove keys of signed, so operations on signed.meta go
+    # right before those on the keys in both that sort after it.
+    position = len(patch)
+    for i, op in enumerate(patch):
+      keys = op['path'].split('/')
+      adds_or_removes_key = op['op'] != 'replace' and \
+                            (len(keys) == 2 or \
+                             (len(keys) == 3 and keys[1] == 'signed'))
+      if not adds_or_removes_key and \
+         (keys[1] > 'signed' or \
+          (keys[1] == 'signed' and len(keys) > 2 and keys[2] > 'meta')):
+        position = i
+        break
+
+    # Likewise, remove projects first, then add projects, and only then
+    # change the projects in both.
+    removals, additions, changes = [], [], []
+    prev_meta = self.get_meta(prev_snapshot_metadata_relpath)
+    curr_meta = self.get_meta(curr_snapshot_metadata_relpath)
+
+    for project_id in prev_meta.get_dirty_project_ids(curr_meta):
+      project_metadata_relpath = self.__projects[project_id]
+      path = metadatadiff.get_path('signed', 'meta', project_metadata_relpath)
+      prev_identifier_id = prev_meta.get_identifier_id(project_id)
+      curr_identifier_id = curr_meta.get_identifier_id(project_id)
+
+      if prev_identifier_id is None:
+        additions.append({'op': 'add', 'path': path,
+                          'value': self.__identifiers[curr_identifier_id]})
+      elif curr_identifier_id is None:
+        removals.append({'op': 'remove', 'path': path})
+      else:
+        metadatadiff.extend_patch(changes, path,
+                                  self.__identifiers[prev_identifier_id],
+                                  self.__identifiers[curr_identifier_id])
+
+    meta_patch = removals+additions+changes
+    patch[position:position] = meta_patch
+    return patch
+
+
+  def read_metadata(self, snapshot_metadata_relpath):
+    '''Return the same document as the snapshot metadata file.'''
+
+    metadata = self.__read_header(snapshot_metadata_relpath)
+    metadata['signed']['meta'] = \
+                          dict(self.get_meta(snapshot_metadata_relpath).items())
+    return metadata
+
+
+class SnapshotMeta(collections.abc.Mapping):
+
+
+  '''
+  A read-only view of signed.meta in one snapshot metadata, which maps project
+  metadata relpaths to their identifiers, and iterates over them in sorted
+  order, like the JSON document does.
+  '''
+
+
+  def __init__(self, snapshot_index, array):
+    self.__snapshot_index = snapshot_index
+    self.__array = array
+
+
+  def __get_identifier_id(self, project_metadata_relpath):
+    project_id = self.__snapshot_index.get_project_id(project_metadata_relpath)
+
+    if project_id is None:
+      return None
+    else:
+      return self.get_identifier_id(project_id)
+
+
+  def __contains__(self, project_metadata_relpath):
+    return self.__get_identifier_id(project_metadata_relpath) is not None
+
+
+  def __getitem__(self, project_metadata_relpath):
+    identifier_id = self.__get_identifier_id(project_metadata_relpath)
+
+    if identifier_id is None:
+      raise KeyError(project_metadata_relpath)
+    else:
+      return self.__snapshot_index.get_identifier(identifier_id)
+
+
+  def __iter__(self):
+    project_metadata_relpaths = [self.__snapshot_index.get_project(project_id) \
+                                 for project_id \
+                                 in numpy.flatnonzero(self.__array)]
+    return iter(sorted(project_metadata_relpaths))
+
+
+  def __len__(self):
+    return int(numpy.count_nonzero(self.__array))
+
+
+  def get_dirty_project_ids(self, other):
+    '''Return the IDs of projects that were added, removed, or changed in the
+    other snapshot metadata, in sorted order of their relpaths.'''
+
+    src, dst = self.__array, other.__array
+    length = min(len(src), len(dst))
+    # Projects beyond the shorter array are absent from its snapshot.
+    project_ids = numpy.flatnonzero(src[:length] != dst[:length]).tolist()
+    longer = src if len(src) > len(dst) else dst
+    project_ids.extend((length+numpy.flatnonzero(longer[length:])).tolist())
+    return sorted(project_ids, key=self.__snapshot_index.get_project)
+
+
+  def get_identifier_id(self, project_id):
+    if project_id < len(self.__array):
+      identifier_id = int(self.__array[project_id])
+      if identifier_id > 0:
+        return identifier_id-1
+    return None
+
+
+def get_fingerprint(metadata_directory, packfile=None):
+  '''Return the SHA-256 hex digest of the relpath where every snapshot
+  metadata is stored, which changes whenever snapshot metadata is written,
+  deleted (e.g. by rewinding a writer), or stored differently.'''
+
+  fingerprint = hashlib.sha256()
+
+  for _, stored_metadata_relpath in \
+      get_stored_snapshot_metadata_relpaths(metadata_directory, packfile):
+    fingerprint.update('{}\n'.format(stored_metadata_relpath).encode('utf-8'))
+
+  return fingerprint.hexdigest()
+
+
+def get_snapshot_metadata_relpaths(metadata_directory, packfile=None):
+  return [snapshot_metadata_relpath \
+          for snapshot_metadata_relpath, _ \
+          in get_stored_snapshot_metadata_relpaths(metadata_directory,
+                                                   packfile)]
+
+
+def get_stored_snapshot_metadata_relpaths(metadata_directory, packfile=None):
+  '''Return the relpath of every snapshot metadata, sorted by timestamp,
+  along with the relpath where it is stored (i.e. itself, or its delta).'''
+
+  if packfile is not None:
+    metadata_relpaths = list(packfile)
+  else:
+    metadata_relpaths = \
+          [os.path.basename(metadata_abspath) \
+           for pattern in ('snapshot.*.json', 'snapshot-delta.*.json') \
+           for metadata_abspath \
+           in glob.glob(os.path.join(metadata_directory, pattern))]
+
+  stored_snapshot_metadata_relpaths = []
+  for metadata_relpath in metadata_relpaths:
+    if SNAPSHOT_METADATA_RELPATH_PATTERN.fullmatch(metadata_relpath):
+      stored_snapshot_metadata_relpaths.append((metadata_relpath,
+                                                metadata_relpath))
+    elif snapshotdelta.DELTA_RELPATH_PATTERN.fullmatch(metadata_relpath):
+      stored_snapshot_metadata_relpaths.append(
+                (snapshotdelta.get_snapshot_metadata_relpath(metadata_relpath),
+                 metadata_relpath))
+
+  # Sort by timestamp, and not by string.
+  return sorted(stored_snapshot_metadata_relpaths,
+                key=lambda relpaths: get_timestamp(relpaths[0]))
+
+
+def get_timestamp(snapshot_metadata_relpath):
+  return int(SNAPSHOT_METADATA_RELPATH_PATTERN.match(snapshot_metadata_relpath)\
+             .group(1))
+
+
+def iter_snapshot_metadata(metadata_directory, packfile=None):
+  '''Yield the relpath of every snapshot metadata, sorted by timestamp, along
+  with the snapshot metadata itself, rebuilt from the previous one if it is
+  stored as a delta.'''
+
+  # The previous snapshot metadata, which the next delta applies to.
+  prev_snapshot_metadata_relpath, prev_snapshot_metadata = None, None
+
+  for snapshot_metadata_relpath, stored_metadata_relpath in \
+      get_stored_snapshot_metadata_relpaths(metadata_directory, packfile):
+    stored_metadata = json.loads(read_metadata_str(metadata_directory,
+                                                   stored_metadata_relpath,
+                                                   packfile))
+
+    if stored_metadata_relpath == snapshot_metadata_relpath:
+      snapshot_metadata = stored_metadata
+    else:
+      # NOTE: Writers always make deltas from the previous snapshot metadata.
+      assert stored_metadata['base'] == prev_snapshot_metadata_relpath
+      snapshot_metadata = snapshotdelta.rebuild(stored_metadata,
+                                                prev_snapshot_metadata)
+    prev_snapshot_metadata_relpath, prev_snapshot_metadata = \
+                                  snapshot_metadata_relpath, snapshot_metadata
+
+    yield snapshot_metadata_relpath, snapshot_metadata
+
+
+def open_packfile(metadata_directory):
+  '''Return the packfile of this metadata directory, if the metadata has been
+  packed, or None.'''
+
+  packfile_filepath = os.path.join(metadata_directory, PACKFILE_FILENAME)
+  if os.path.isfile(packfile_filepath):
+    return PackfileReader(packfile_filepath)
+  else:
+    return None
+
+
+def read_metadata_str(metadata_directory, metadata_relpath, packfile=None):
+  '''Return the JSON of this version of metadata, as it is stored in this
+  metadata directory, or in its packfile.'''
+
+  if packfile is not None:
+    return packfile[metadata_relpath].decode('utf-8')
+  else:
+    with open(os.path.join(metadata_directory, metadata_relpath)) \
+         as metadata_file:
+      return metadata_file.read()
+
+
+def read_snapshot_metadata(metadata_directory, snapshot_metadata_relpath,
+                           packfile=None):
+  '''Return this snapshot metadata, rebuilt from the nearest keyframe if it is
+  stored as a delta.'''
+
+  # Walk back to the keyframe, and then apply every delta on the way forward.
+  deltas = []
+  metadata_relpath = snapshot_metadata_relpath
+
+  while True:
+    if packfile is not None:
+      is_keyframe = metadata_relpath in packfile
+    else:
+      is_keyframe = os.path.isfile(os.path.join(metadata_directory,
+                                                metadata_relpath))
+    if is_keyframe:
+      break
+
+    delta_relpath = snapshotdelta.get_delta_relpath(metadata_relpath)
+    delta = json.loads(read_metadata_str(metadata_directory, delta_relpath,
+                                         packfile))
+    deltas.append(delta)
+    metadata_relpath = delta['base']
+
+  snapshot_metadata = json.loads(read_metadata_str(metadata_directory,
+                                                   metadata_relpath, packfile))
+  for delta in reversed(deltas):
+    snapshot_metadata = snapshotdelta.rebuild(delta, snapshot_metadata)
+  return snapshot_metadata
+
+
+def write(metadata_directory, index_filename=SNAPSHOT_INDEX_FILENAME):
+  '''Index every snapshot metadata file in this metadata directory.'''
+
+  index_filepath = os.path.join(metadata_directory, index_filename)
+  # Write to a temporary file, so that readers never see a partial index.
+  tmp_index_filepath = index_filepath+'.tmp'
+
+  # str (project metadata relpath): int (project ID)
+  project_ids = {}
+  projects = []
+  # str (JSON of identifier): int (identifier ID)
+  identifier_ids = {}
+  identifiers = []
+  snapshots = []
+  # [([int (timestamp)], [int (identifier ID+1 > -1)])] (one per project)
+  timelines = []
+  prev_array = numpy.zeros(0, dtype=ARRAY_DTYPE)
+  offset = 0
+
+  # Read snapshot metadata from the packfile, if the metadata has been packed.
+  packfile = open_packfile(metadata_directory)
+  fingerprint = get_fingerprint(metadata_directory, packfile)
+
+  with open(tmp_index_filepath, 'wb') as index_file:
+    index_file.write(MAGIC)
+
+    for snapshot_metadata_relpath, snapshot_metadata in \
+        iter_snapshot_metadata(metadata_directory, packfile):
+      meta = snapshot_metadata['signed']['meta']
+      # NOTE: Leave the snapshot metadata intact for the next delta.
+      snapshot_metadata = dict(snapshot_metadata,
+                               signed=dict(snapshot_metadata['signed'],
+                                           meta=None))
+
+      for project_metadata_relpath in meta:
+        if project_metadata_relpath not in project_ids:
+          project_ids[project_metadata_relpath] = len(projects)
+          projects.append(project_metadata_relpath)
+          timelines.append(([], []))
+
+      array = numpy.zeros(len(projects), dtype=ARRAY_DTYPE)
+
+      for project_metadata_relpath, identifier in meta.items():
+        identifier_key = json.dumps(identifier, sort_keys=True)
+        identifier_id = identifier_ids.get(identifier_key)
+        if identifier_id is None:
+          identifier_id = identifier_ids[identifier_key] = len(identifiers)
+          identifiers.append(identifier)
+        array[project_ids[project_metadata_relpath]] = identifier_id+1
+
+      # Note every project that changed since the previous snapshot metadata.
+      timestamp = get_timestamp(snapshot_metadata_relpath)
+      prev_array = numpy.concatenate((prev_array,
+                                      numpy.zeros(len(array)-len(prev_array),
+                                                  dtype=ARRAY_DTYPE)))
+      for project_id in numpy.flatnonzero(prev_array != array).tolist():
+        timeline_timestamps, timeline_identifier_ids = timelines[project_id]
+        timeline_timestamps.append(timestamp)
+        timeline_identifier_ids.append(int(array[project_id]))
+      prev_array = array
+
+      index_file.write(array.tobytes())
+      snapshots.append((snapshot_metadata_relpath, offset, len(array),
+                        json.dumps(snapshot_metadata)))
+      offset += len(array)
+      logging.info('Indexed {}'.format(snapshot_metadata_relpath))
+
+    footer_offset = index_file.tell()
+    footer = {'fingerprint': fingerprint, 'identifiers': identifiers,
+              'projects': projects, 'snapshots': snapshots,
+              'timelines': timelines}
+    index_file.write(json.dumps(footer).encode('utf-8'))
+    index_file.write(struct.pack(FOOTER_OFFSET_FORMAT, footer_offset))
+
+  if packfile is not None:
+    packfile.close()
+
+  os.replace(tmp_index_filepath, index_filepath)
+  logging.info('W {}'.format(index_filepath))
+  return index_filepath
@@ -3,34 +3,37 @@
 
 # 1st-party
 import bz2
-import glob
 import json
-import os
 
 
 # 2nd-party
+import canonicaljson
+from metadatawriter import MetadataWriter
 from nouns import METADATA_DIRECTORY, TUF_VERSION_COST_FOR_NEW_USERS_FILEPATH, \
                   TUF_DIRECTORY
-
-
-SNAPSHOTS_FILEPATH = os.path.join(TUF_DIRECTORY, 'snapshot.*.json')
+import snapshotindex
 
 
 def precompute():
-  # Cache of all project version metadata (identified by hashes).
+  # Cache of the JSON of all project version metadata (identified by
+  # hashes).
   PROJECT_METADATA = {}
 
   # 1. C = {}
   COST = {}
 
-  # 2. For every version S of snapshot metadata:
-  SNAPSHOTS = sorted(glob.glob(SNAPSHOTS_FILEPATH))
-  for SNAPSHOT in SNAPSHOTS:
-    # 2.1. s = the compressed size of S
-    with open(SNAPSHOT) as snapshot_file:
-      snapshot_json = snapshot_file.read()
-    snapshot_metadata_size = len(bz2.compress(snapshot_json.encode('utf-8')))
-    PROJECTS = json.loads(snapshot_json)['signed']['meta']
+  # Read metadata from the packfile, if the metadata has been packed.
+  packfile = snapshotindex.open_packfile(TUF_DIRECTORY)
+
+  # 2. For every version S of snapshot metadata, even if it is stored as a
+  # delta:
+  for SNAPSHOT, snapshot_metadata in \
+      snapshotindex.iter_snapshot_metadata(TUF_DIRECTORY, packfile):
+    # 2.1. s = the compressed size of S, exactly as writers would store it in
+    # full
+    snapshot_json = MetadataWriter.jsonify(snapshot_metadata)
+    snapshot_metadata_size = len(bz2.compress(snapshot_json))
+    PROJECTS = snapshot_metadata['signed']['meta']
 
     # 2.2. Collect all project version metadata in a dictionary.
     projects_metadata = {}
@@ -43,13 +46,11 @@ def precompute():
       project_metadata = PROJECT_METADATA.get(project_metadata_filepath)
 
       if not project_metadata:
-        project_metadata_filepath = os.path.join(TUF_DIRECTORY,
-                                                 project_metadata_filepath)
-        with open(project_metadata_filepath) as project_metadata_file:
-          project_metadata = json.load(project_metadata_file)
-        assert TUF_DIRECTORY.endswith('/')
-        project_metadata_filepath = \
-                                  project_metadata_filepath[len(TUF_DIRECTORY):]
+        project_metadata_json = \
+                    snapshotindex.read_metadata_str(TUF_DIRECTORY,
+                                                    project_metadata_filepath,
+                                                    packfile)
+        project_metadata = json.loads(project_metadata_json)
 
         # NOTE: Approximate the project version metadata file (i.e., a version
         # of the project metadata file that contains only the version number of
@@ -60,16 +61,18 @@ def precompute():
         del project_metadata['signed']['delegations']
         del project_metadata['signed']['expires']
         del project_metadata['signed']['targets']
+        # Encode every project metadata only once, and then reuse its JSON
+        # in every bundle of project metadata.
+        project_metadata = \
+                  canonicaljson.Fragment(canonicaljson.encode(project_metadata))
         PROJECT_METADATA[project_metadata_filepath] = project_metadata
 
       assert project_metadata
       projects_metadata[PROJECT] = project_metadata
 
     # 2.4. c = The compression of all project version metadata in one shot.
-    projects_metadata_json = json.dumps(projects_metadata, indent=None,
-                                        separators=(',', ':'), sort_keys=True)
-    projects_metadata_size = \
-                      len(bz2.compress(projects_metadata_json.encode('utf-8')))
+    projects_metadata_json = canonicaljson.encode(projects_metadata)
+    projects_metadata_size = len(bz2.compress(projects_metadata_json))
     # c = s + p
     metadata_size = {
       'project_metadata_length': projects_metadata_size,
@@ -77,9 +80,11 @@ def precompute():
     }
 
     # 2.5. C[S] = c
-    snapshot_filename = os.path.basename(SNAPSHOT)
-    COST[snapshot_filename] = metadata_size
-    print('{}: {}'.format(snapshot_filename, metadata_size))
+    COST[SNAPSHOT] = metadata_size
+    print('{}: {}'.format(SNAPSHOT, metadata_size))
+
+  if packfile is not None:
+    packfile.close()
 
   # 3. Write C as JSON to file
   with open(TUF_VERSION_COST_FOR_NEW_USERS_FILEPATH, 'w') as cost_json_file:
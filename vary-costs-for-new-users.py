@@ -10,8 +10,10 @@ import random
 
 
 # 2nd-party
+import canonicaljson
 from nouns import MERCURY_DIRECTORY, MERCURY_NOHASH_DIRECTORY, \
                   METADATA_DIRECTORY, TUF_DIRECTORY
+import snapshotindex
 
 
 def avg_bz2_len_json(projects_metadata):
@@ -51,8 +53,7 @@ def tuf_version_bz2_len_json(projects_metadata):
 
 
 def jsonify(metadata):
-  return json.dumps(metadata, indent=None, separators=(',', ':'),
-                    sort_keys=True).encode('utf-8')
+  return canonicaljson.encode(metadata)
 
 
 def compute(LAST_TIMESTAMP, NUMBER_OF_PROJECTS, SNAPSHOT_FILEPATH,
@@ -63,11 +64,17 @@ def compute(LAST_TIMESTAMP, NUMBER_OF_PROJECTS, SNAPSHOT_FILEPATH,
   # 1. C = {}
   COST = {}
 
+  # Read metadata from the packfile, if the metadata has been packed.
+  metadata_directory, snapshot_metadata_relpath = \
+                                                os.path.split(SNAPSHOT_FILEPATH)
+  packfile = snapshotindex.open_packfile(metadata_directory)
+
   # 2. For every desired number of projects...
   for number_of_projects in NUMBER_OF_PROJECTS:
-    # 2.1. s = the compressed size of S
-    with open(SNAPSHOT_FILEPATH) as snapshot_file:
-      snapshot = json.load(snapshot_file)
+    # 2.1. s = the compressed size of S, even if it is stored as a delta
+    snapshot = snapshotindex.read_snapshot_metadata(metadata_directory,
+                                                    snapshot_metadata_relpath,
+                                                    packfile)
 
     # Trim the snapshot down to the number of projects.
     snapshot_meta = snapshot['signed']['meta']
@@ -89,7 +96,6 @@ def compute(LAST_TIMESTAMP, NUMBER_OF_PROJECTS, SNAPSHOT_FILEPATH,
     projects_metadata = {}
 
     # 2.3. Read every project metadata P in S.
-    metadata_directory = os.path.dirname(SNAPSHOT_FILEPATH)
     for project in preserved_projects:
       assert project.endswith('.json')
       project_metadata_identifier = snapshot_meta[project]
@@ -103,10 +109,11 @@ def compute(LAST_TIMESTAMP, NUMBER_OF_PROJECTS, SNAPSHOT_FILEPATH,
       project_metadata_filepath = '{}.{}{}'.format(project[:-5],
                                                    project_metadata_identifier,
                                                    project[-5:])
-      project_metadata_filepath = os.path.join(metadata_directory,
-                                               project_metadata_filepath)
-      with open(project_metadata_filepath) as project_metadata_file:
-        project_metadata = json.load(project_metadata_file)
+      project_metadata_json = \
+                    snapshotindex.read_metadata_str(metadata_directory,
+                                                    project_metadata_filepath,
+                                                    packfile)
+      project_metadata = json.loads(project_metadata_json)
 
       projects_metadata[project] = project_metadata
 
@@ -122,6 +129,9 @@ def compute(LAST_TIMESTAMP, NUMBER_OF_PROJECTS, SNAPSHOT_FILEPATH,
     COST[number_of_projects] = metadata_size
     print('{}: {}'.format(number_of_projects, metadata_size))
 
+  if packfile is not None:
+    packfile.close()
+
   # 3. Write C as JSON to file
   with open(COST_FOR_NEW_USERS_FILEPATH, 'w') as cost_json_file:
     json.dump(COST, cost_json_file, indent=1, sort_keys=True)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+Replay the change log only once for Mercury, Mercury-nohash and TUF, and
+write the metadata of every scheme into the same directories and caches as
+their separate write-*.py scripts.
+'''
+
+
+# 1st-party
+import importlib
+import sys
+
+
+# 2nd-party
+from metadatawriter import write_all
+from nouns import MERCURY_DIRECTORY, MERCURY_DIRTY_PROJECTS_CACHE_FILEPATH, \
+                  MERCURY_METADATA_PATCH_LENGTH_CACHE_FILEPATH, \
+                  MERCURY_NOHASH_DIRECTORY, \
+                  MERCURY_NOHASH_DIRTY_PROJECTS_CACHE_FILEPATH, \
+                  MERCURY_NOHASH_METADATA_PATCH_LENGTH_CACHE_FILEPATH, \
+                  METADATA_DIRECTORY, TUF_DIRECTORY, \
+                  TUF_DIRTY_PROJECTS_CACHE_FILEPATH, \
+                  TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH, \
+                  WRITE_ALL_LOG_FILENAME
+# NOTE: MercuryAlphabeticalRepository is no different, so every scheme may
+# share this repository.
+from repository import TUFAlphabeticalRepository
+
+
+# script name: (writer class name, metadata directory,
+#               metadata patch length cache filepath,
+#               dirty projects cache filepath)
+SCHEMES = (
+  ('write-tuf-metadata', 'TUFMetadataWriter', TUF_DIRECTORY,
+   TUF_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   TUF_DIRTY_PROJECTS_CACHE_FILEPATH),
+  ('write-mercury-metadata', 'MercuryMetadataWriter', MERCURY_DIRECTORY,
+   MERCURY_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   MERCURY_DIRTY_PROJECTS_CACHE_FILEPATH),
+  ('write-mercury-nohash-metadata', 'MercuryMetadataWriter',
+   MERCURY_NOHASH_DIRECTORY,
+   MERCURY_NOHASH_METADATA_PATCH_LENGTH_CACHE_FILEPATH,
+   MERCURY_NOHASH_DIRTY_PROJECTS_CACHE_FILEPATH),
+)
+
+
+def get_schemes():
+  schemes = []
+
+  for script_name, class_name, metadata_directory, \
+      metadata_patch_length_cache_filepath, \
+      dirty_projects_cache_filepath in SCHEMES:
+    # NOTE: Every script defines its own class of writers, even when two
+    # scripts give their classes the same name.
+    MetadataWriterClass = getattr(importlib.import_module(script_name),
+                                  class_name)
+    schemes.append((MetadataWriterClass, metadata_directory,
+                    metadata_patch_length_cache_filepath,
+                    dirty_projects_cache_filepath))
+
+  return schemes
+
+
+if __name__ == '__main__':
+  # Optionally, resume from the latest checkpoint (i.e. "latest"), or from
+  # the filepath of a checkpoint.
+  resume_from = sys.argv[1] if len(sys.argv) > 1 else None
+  write_all(WRITE_ALL_LOG_FILENAME, TUFAlphabeticalRepository, get_schemes(),
+            METADATA_DIRECTORY, resume_from=resume_from)